@@ -4,15 +4,53 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import plotly.express as px
 import plotly.graph_objects as go
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date, timezone
 import calendar
 import os
 import tempfile
 import random
 import io
 import base64
-from PIL import Image
+import sqlite3
+import hashlib
+import hmac
+import secrets
+import queue
+import threading
+import multiprocessing
+import pickle
+import time
+import json
+import logging
+import cProfile
+import pstats
+import sys
+import tarfile
+import heapq
+import dataclasses
+import difflib
+import types
+import getpass
+import zlib
+import smtplib
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.message import EmailMessage
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from PIL import Image, ImageOps
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import numpy as np
+from models import Document, Deadline, Subscription, CategoryTaxonomy, CategoryIndex
+import templates
+import ocr
+import similarity
+import search
+
+# Errori delle attività in background (OCR, promemoria, feed): finiscono nel log del processo
+logger = logging.getLogger("contractme")
 
 # Configurazione iniziale dell'app
 st.set_page_config(
@@ -24,7 +62,7 @@ st.set_page_config(
 
 # Funzioni di utilità
 def load_css():
-    st.markdown("""
+    send_html(templates.minify_css("""
     <style>
         /* Stile generale */
         .main {
@@ -150,79 +188,3371 @@ def load_css():
             animation: spin 2s linear infinite;
         }
         
-        @keyframes spin {
-            0% { transform: rotate(0deg); }
-            100% { transform: rotate(360deg); }
-        }
-    </style>
-    """, unsafe_allow_html=True)
+        @keyframes spin {
+            0% { transform: rotate(0deg); }
+            100% { transform: rotate(360deg); }
+        }
+        
+        /* Schede compatte della dashboard */
+        .card-compact {
+            margin-bottom: 10px;
+            padding: 10px;
+        }
+        
+        .row-between {
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+        }
+        
+        .muted {
+            color: #7b8a8b;
+        }
+        
+        .category-tag {
+            color: #4e73df;
+            font-size: 13px;
+        }
+        
+        /* Anteprime dei documenti */
+        .preview-image {
+            max-width: 100%;
+            max-height: 300px;
+            display: block;
+            margin: 0 auto;
+        }
+        
+        .preview-text {
+            background-color: #f5f5f5;
+            padding: 10px;
+            border-radius: 5px;
+            max-height: 300px;
+            overflow-y: auto;
+            font-family: monospace;
+        }
+        
+        /* Tabella delle scadenze */
+        .deadline-table {
+            font-family: Arial, sans-serif;
+            border-collapse: collapse;
+            width: 100%;
+        }
+        
+        .deadline-table th {
+            background-color: #4e73df;
+            color: white;
+            padding: 12px;
+            text-align: left;
+        }
+        
+        .deadline-table td {
+            padding: 10px;
+            border-bottom: 1px solid #ddd;
+        }
+        
+        .deadline-table tr:nth-child(even) {
+            background-color: #f9f9f9;
+        }
+        
+        .deadline-table tr:hover {
+            background-color: #f1f1f1;
+        }
+        
+        .status-expired {
+            color: #e74a3b;
+            font-weight: bold;
+        }
+        
+        .status-imminent {
+            color: #f6c23e;
+            font-weight: bold;
+        }
+        
+        .status-future {
+            color: #1cc88a;
+        }
+        
+        .status-done {
+            color: #858796;
+        }
+        
+        /* Calendario: giorno corrente, titolo e legenda */
+        .calendar td.today {
+            background-color: #e8f4f8;
+            font-weight: bold;
+        }
+        
+        .calendar-title {
+            text-align: center;
+        }
+        
+        .calendar-legend {
+            margin-top: 20px;
+        }
+        
+        .calendar-legend .calendar-event {
+            display: inline-block;
+            margin-right: 10px;
+        }
+        
+        /* Sidebar */
+        .sidebar-logo h1 {
+            color: #4e73df;
+        }
+        
+        .sidebar-footer {
+            text-align: center;
+            margin-top: 20px;
+            font-size: small;
+        }
+    """ + STATUS_RULES + """
+    </style>
+    """))
+
+# Archivio persistente multi-tenant
+DATA_DIR = os.environ.get("CONTRACTME_DATA_DIR",
+                          os.path.join(os.path.dirname(os.path.abspath(__file__)), "contractme_data"))
+DB_PATH = os.path.join(DATA_DIR, "contractme.db")
+DB_POOL_SIZE = int(os.environ.get("CONTRACTME_DB_POOL_SIZE", "8"))
+
+DEFAULT_CATEGORIES = ["Casa", "Lavoro", "Salute", "Finanza", "Istruzione", "Altro"]
+
+# Ogni tabella di dati è partizionata per tenant: la chiave primaria e gli indici
+# iniziano sempre con tenant_id, quindi ogni query di un tenant legge solo la sua partizione
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tenants (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    version INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+    username TEXT NOT NULL UNIQUE,
+    password_hash TEXT NOT NULL,
+    salt TEXT NOT NULL,
+    role TEXT NOT NULL DEFAULT 'member',
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_users_tenant ON users(tenant_id);
+
+CREATE TABLE IF NOT EXISTS categories (
+    tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+    name TEXT NOT NULL,
+    PRIMARY KEY (tenant_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS blobs (
+    tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+    sha256 TEXT NOT NULL,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (tenant_id, sha256)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS documents (
+    tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    category TEXT NOT NULL,
+    type TEXT NOT NULL,
+    blob_sha256 TEXT,
+    upload_date TEXT NOT NULL,
+    expiry_date TEXT,
+    filename TEXT NOT NULL,
+    PRIMARY KEY (tenant_id, id)
+);
+CREATE INDEX IF NOT EXISTS idx_documents_category ON documents(tenant_id, category);
+
+CREATE TABLE IF NOT EXISTS deadlines (
+    tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+    id INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    date TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    category TEXT NOT NULL,
+    document_id INTEGER,
+    subscription_id INTEGER,
+    PRIMARY KEY (tenant_id, id)
+);
+CREATE INDEX IF NOT EXISTS idx_deadlines_date ON deadlines(tenant_id, date);
+CREATE INDEX IF NOT EXISTS idx_deadlines_document ON deadlines(tenant_id, document_id);
+CREATE INDEX IF NOT EXISTS idx_deadlines_subscription ON deadlines(tenant_id, subscription_id);
+
+CREATE TABLE IF NOT EXISTS subscriptions (
+    tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    renewal_date TEXT NOT NULL,
+    cost REAL NOT NULL DEFAULT 0,
+    description TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (tenant_id, id)
+);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_renewal ON subscriptions(tenant_id, renewal_date);
+
+-- Testo riconosciuto (OCR) per hash della pagina: una pagina già vista non viene riconosciuta di nuovo
+CREATE TABLE IF NOT EXISTS ocr_pages (
+    tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+    sha256 TEXT NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (tenant_id, sha256)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS document_pages (
+    tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+    document_id INTEGER NOT NULL,
+    page INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (tenant_id, document_id, page)
+) WITHOUT ROWID;
+
+-- Firme per il rilevamento dei quasi duplicati (vedi similarity.py)
+CREATE TABLE IF NOT EXISTS document_fingerprints (
+    tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+    document_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    signature BLOB NOT NULL,
+    PRIMARY KEY (tenant_id, document_id)
+) WITHOUT ROWID;
+
+-- Revisioni precedenti dei documenti: la revisione corrente è sempre in documents, per intero.
+-- Dei testi si conserva solo il delta che ricostruisce la revisione dalla successiva (delta),
+-- dei file binari il riferimento al contenuto, deduplicato per hash (blob_sha256)
+CREATE TABLE IF NOT EXISTS document_versions (
+    tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+    document_id INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    upload_date TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    blob_sha256 TEXT,
+    delta TEXT,
+    PRIMARY KEY (tenant_id, document_id, version)
+) WITHOUT ROWID;
+
+-- Registro delle modifiche, in sola aggiunta: ogni inserimento, modifica o eliminazione dei dati
+-- del tenant (non di quelli derivati: stati, firme, testo OCR) scritto da un trigger nella stessa
+-- transazione, con la chiave della riga e i suoi valori dopo la modifica (vedi event_log_triggers).
+-- seq è il rowid: cresce sempre, perché dal registro non si elimina nulla
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY,
+    tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+    at TEXT NOT NULL,
+    tbl TEXT NOT NULL,
+    op TEXT NOT NULL,
+    key TEXT NOT NULL,
+    row TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_events_tenant ON events(tenant_id, seq);
+CREATE INDEX IF NOT EXISTS idx_events_at ON events(tenant_id, at);
+
+CREATE TRIGGER IF NOT EXISTS events_no_update BEFORE UPDATE ON events
+BEGIN SELECT RAISE(ABORT, 'Il registro delle modifiche non si può modificare'); END;
+CREATE TRIGGER IF NOT EXISTS events_no_delete BEFORE DELETE ON events
+BEGIN SELECT RAISE(ABORT, 'Il registro delle modifiche non si può modificare'); END;
+
+-- Istantanee compattate dei dati del tenant fino all'evento seq (JSON compresso con zlib):
+-- lo stato a un dato istante è l'ultima istantanea precedente più gli eventi successivi
+CREATE TABLE IF NOT EXISTS snapshots (
+    tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+    seq INTEGER NOT NULL,
+    at TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (tenant_id, seq)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS reminders_sent (
+    tenant_id INTEGER NOT NULL REFERENCES tenants(id),
+    deadline_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    lead_days INTEGER NOT NULL,
+    sent_at TEXT NOT NULL,
+    PRIMARY KEY (tenant_id, deadline_id, date, lead_days)
+);
+"""
+
+# Colonne aggiunte dopo la prima versione dello schema, create anche sui database esistenti:
+# (tabella, colonna, definizione)
+SCHEMA_COLUMNS = [
+    ("tenants", "status_day", "TEXT"),
+    ("deadlines", "status", "TEXT"),
+    ("subscriptions", "status", "TEXT"),
+    ("categories", "parent", "TEXT"),
+    ("tenants", "ics_token", "TEXT"),
+    ("documents", "original_sha256", "TEXT"),
+    ("documents", "original_size", "INTEGER"),
+    ("documents", "version", "INTEGER NOT NULL DEFAULT 1"),
+    ("deadlines", "done_at", "TEXT"),
+    ("blobs", "released_at", "TEXT")
+]
+
+SCHEMA_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_deadlines_unclassified ON deadlines(tenant_id) WHERE status IS NULL;
+CREATE INDEX IF NOT EXISTS idx_subscriptions_unclassified ON subscriptions(tenant_id) WHERE status IS NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_tenants_ics_token ON tenants(ics_token) WHERE ics_token IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_blobs_released ON blobs(tenant_id, released_at) WHERE released_at IS NOT NULL;
+"""
+
+# Classificazione dello stato di scadenze e abbonamenti, unica per tutte le pagine
+STATUS_URGENT_DAYS = 3
+STATUS_IMMINENT_DAYS = 7
+
+STATUS_STYLES = {
+    "expired": {"label": "⚠️ Scaduta", "color": "#e74a3b", "css": "status-expired"},
+    "urgent": {"label": "🔄 Imminente", "color": "#e74a3b", "css": "status-imminent"},
+    "imminent": {"label": "🔄 Imminente", "color": "#f6c23e", "css": "status-imminent"},
+    "future": {"label": "✅ Futura", "color": "#1cc88a", "css": "status-future"},
+    "done": {"label": "✔️ Completata", "color": "#858796", "css": "status-done"}
+}
+
+STATUS_CSS = {style["label"]: style["css"] for style in STATUS_STYLES.values()}
+
+# Bordo (edge-*) e colore del testo (tone-*) di ogni stato, usati dai template delle schede
+STATUS_RULES = "".join(
+    f".edge-{key} {{ border-left: 5px solid {style['color']}; }} "
+    f".tone-{key} {{ color: {style['color']}; font-weight: bold; }} "
+    for key, style in STATUS_STYLES.items()
+)
+
+# Operazioni in blocco: filtro sugli id scelti, colonna della categoria e (colonna della data,
+# colonna delle scadenze collegate) di ogni tabella
+SELECTED_IDS = "(SELECT value FROM json_each(?))"
+BULK_CATEGORY_COLUMNS = {"documents": "category", "deadlines": "category", "subscriptions": "type"}
+BULK_DATE_COLUMNS = {"documents": ("expiry_date", "document_id"), "deadlines": ("date", None),
+                     "subscriptions": ("renewal_date", "subscription_id")}
+
+# Tabelle con uno stato e colonna della data da cui dipende
+STATUS_COLUMNS = [("deadlines", "date"), ("subscriptions", "renewal_date")]
+
+def classify_status(item_date, today):
+    days_left = (item_date - today).days
+    if days_left < 0:
+        return "expired"
+    if days_left <= STATUS_URGENT_DAYS:
+        return "urgent"
+    if days_left <= STATUS_IMMINENT_DAYS:
+        return "imminent"
+    return "future"
+
+# Le anteprime fino a PREVIEW_INLINE_BYTES restano nei documenti in sessione, le altre
+# nell'archivio e nella cache condivisa (vedi document_preview)
+PREVIEW_INLINE_BYTES = int(os.environ.get("CONTRACTME_PREVIEW_INLINE_BYTES", str(32 * 1024)))
+
+def encode_preview(doc_type, data):
+    """Anteprima come la usano le pagine: il testo dei documenti di testo, il base64 degli altri"""
+    if data is None:
+        return None
+    return data.decode() if doc_type == "text" else base64.b64encode(data).decode()
+
+def parse_date(value):
+    return date.fromisoformat(value) if value else None
+
+def format_date(value):
+    return value.isoformat() if value else None
+
+# Delta di righe tra due revisioni di un testo: una lista in JSON di intervalli [inizio, fine]
+# da copiare dal testo di partenza e di stringhe da inserire
+def text_delta(source, target):
+    """Delta che ricostruisce target a partire da source"""
+    source_lines = source.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, source_lines, target_lines, autojunk=False).get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append("".join(target_lines[j1:j2]))
+    return json.dumps(ops, ensure_ascii=False, separators=(",", ":"))
+
+def apply_text_delta(source, delta):
+    source_lines = source.splitlines(keepends=True)
+    return "".join(op if isinstance(op, str) else "".join(source_lines[op[0]:op[1]]) for op in json.loads(delta))
+
+def sql_statements(script):
+    """Istruzioni di uno script SQL, da eseguire una alla volta: executescript chiuderebbe la transazione"""
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ""
+
+def hash_password(password, salt=None):
+    salt = salt or secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), 200_000)
+    return digest.hex(), salt
+
+class ConnectionPool:
+    """Pool di connessioni SQLite condiviso da tutte le sessioni di un processo"""
+
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=size)
+        # Le connessioni vengono aperte solo al primo utilizzo
+        for _ in range(size):
+            self._idle.put(None)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        # In modalità WAL i lettori non bloccano gli scrittori (e viceversa),
+        # anche tra più processi Streamlit che condividono lo stesso file
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        conn = self._idle.get()
+        if conn is None:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    @contextmanager
+    def transaction(self, attach=None):
+        """attach: nome -> percorso dei database da collegare per la durata della transazione"""
+        # BEGIN IMMEDIATE serializza solo le scritture; le letture restano senza lock
+        with self.connection() as conn:
+            # ATTACH e DETACH non sono ammessi dentro una transazione
+            for name, path in (attach or {}).items():
+                conn.execute("ATTACH DATABASE ? AS " + name, (path,))
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    yield conn
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                conn.execute("COMMIT")
+            finally:
+                for name in attach or {}:
+                    conn.execute("DETACH DATABASE " + name)
+
+    @contextmanager
+    def snapshot(self):
+        # Transazione di sola lettura: vede uno stato coerente del database
+        with self.connection() as conn:
+            conn.execute("BEGIN")
+            try:
+                yield conn
+            finally:
+                conn.execute("COMMIT")
+
+class DataStore:
+    """Archivio dei dati di tutti i tenant, condivisibile tra più processi"""
+
+    def __init__(self, path=DB_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.pool = ConnectionPool(path)
+        # Schema, migrazioni e trigger in un'unica transazione: un altro processo che scrive intanto
+        # aspetta la fine e non trova mai le tabelle senza i trigger del registro
+        with self.pool.transaction() as conn:
+            for statement in sql_statements(SCHEMA):
+                conn.execute(statement)
+            for table, column, definition in SCHEMA_COLUMNS:
+                existing = [row["name"] for row in conn.execute(f"PRAGMA table_info({table})")]
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                    # Prima della tassonomia persistente le categorie predefinite e quelle
+                    # usate dai record non erano salvate: si registrano una volta sola
+                    if (table, column) == ("categories", "parent"):
+                        for (tenant_id,) in conn.execute("SELECT id FROM tenants").fetchall():
+                            self._register_categories(conn, tenant_id, DEFAULT_CATEGORIES)
+                            self._register_used_categories(conn, tenant_id)
+            for statement in sql_statements(SCHEMA_INDEXES):
+                conn.execute(statement)
+            install_event_log_triggers(conn)
+            # I tenant creati prima del registro partono da un'istantanea dei dati che hanno già
+            for (tenant_id,) in conn.execute("SELECT id FROM tenants WHERE id NOT IN "
+                                             "(SELECT tenant_id FROM snapshots)").fetchall():
+                self._take_snapshot(conn, tenant_id)
+        # Funzioni chiamate con (tenant_id, scadenze) dopo ogni scrittura che aggiunge scadenze;
+        # scadenze = None significa che i dati del tenant vanno riletti per intero
+        self.listeners = []
+
+    def _notify(self, tenant_id, deadlines):
+        for listener in self.listeners:
+            listener(tenant_id, deadlines)
+
+    # Utenti e tenant
+    def _user_from_row(self, row):
+        return {
+            "id": row["id"],
+            "tenant_id": row["tenant_id"],
+            "tenant_name": row["tenant_name"],
+            "username": row["username"],
+            "role": row["role"]
+        }
+
+    def _insert_user(self, conn, tenant_id, username, password, role):
+        password_hash, salt = hash_password(password)
+        conn.execute(
+            "INSERT INTO users (tenant_id, username, password_hash, salt, role, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (tenant_id, username, password_hash, salt, role, datetime.now().isoformat())
+        )
+
+    def create_tenant(self, tenant_name, username, password):
+        """Crea un nuovo spazio di lavoro con il suo proprietario"""
+        with self.pool.transaction() as conn:
+            if conn.execute("SELECT 1 FROM tenants WHERE name = ?", (tenant_name,)).fetchone():
+                raise ValueError(f"Lo spazio di lavoro '{tenant_name}' esiste già.")
+            if conn.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone():
+                raise ValueError(f"L'utente '{username}' esiste già.")
+            cursor = conn.execute("INSERT INTO tenants (name, created_at) VALUES (?, ?)",
+                                  (tenant_name, datetime.now().isoformat()))
+            self._insert_user(conn, cursor.lastrowid, username, password, "owner")
+            self._register_categories(conn, cursor.lastrowid, DEFAULT_CATEGORIES)
+            self._take_snapshot(conn, cursor.lastrowid)
+        return self.authenticate(username, password)
+
+    def add_user(self, tenant_id, username, password, role="member"):
+        with self.pool.transaction() as conn:
+            if conn.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone():
+                raise ValueError(f"L'utente '{username}' esiste già.")
+            self._insert_user(conn, tenant_id, username, password, role)
+
+    def authenticate(self, username, password):
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT u.*, t.name AS tenant_name FROM users u JOIN tenants t ON t.id = u.tenant_id WHERE u.username = ?",
+                (username,)
+            ).fetchone()
+        if row is None:
+            return None
+        password_hash, _ = hash_password(password, row["salt"])
+        if not hmac.compare_digest(password_hash, row["password_hash"]):
+            return None
+        return self._user_from_row(row)
+
+    def find_tenant(self, tenant_name):
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT id FROM tenants WHERE name = ?", (tenant_name,)).fetchone()
+        return row["id"] if row else None
+
+    def list_users(self, tenant_id):
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT u.*, t.name AS tenant_name FROM users u JOIN tenants t ON t.id = u.tenant_id "
+                "WHERE u.tenant_id = ? ORDER BY u.username",
+                (tenant_id,)
+            ).fetchall()
+        return [self._user_from_row(row) for row in rows]
+
+    # Versione dei dati del tenant: viene incrementata a ogni scrittura,
+    # così le sessioni aperte (anche su altri dispositivi) sanno quando ricaricare
+    def tenant_version(self, tenant_id):
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT version FROM tenants WHERE id = ?", (tenant_id,)).fetchone()
+        return row["version"] if row else 0
+
+    def _bump_version(self, conn, tenant_id):
+        conn.execute("UPDATE tenants SET version = version + 1 WHERE id = ?", (tenant_id,))
+        self._maybe_snapshot(conn, tenant_id)
+        return conn.execute("SELECT version FROM tenants WHERE id = ?", (tenant_id,)).fetchone()["version"]
+
+    # Registro delle modifiche e istantanee
+    def _tenant_rows(self, conn, tenant_id):
+        """Righe registrate del tenant come frammenti JSON, tabella per tabella"""
+        return {table: [row[0] for row in conn.execute(f"SELECT {_json_object(columns)} FROM {table} "
+                                                       "WHERE tenant_id = ?", (tenant_id,))]
+                for table, columns in ARCHIVE_TABLES.items()}
+
+    def _take_snapshot(self, conn, tenant_id):
+        seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM events WHERE tenant_id = ?", (tenant_id,)).fetchone()[0]
+        # Il JSON si compone dai frammenti prodotti da SQLite, senza decodificarli
+        data = "{" + ", ".join(f'"{table}": [{", ".join(rows)}]'
+                               for table, rows in self._tenant_rows(conn, tenant_id).items()) + "}"
+        conn.execute(f"INSERT OR REPLACE INTO snapshots (tenant_id, seq, at, data) VALUES (?, ?, {EVENT_NOW}, ?)",
+                     (tenant_id, seq, zlib.compress(data.encode())))
+
+    def _maybe_snapshot(self, conn, tenant_id):
+        last = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM snapshots WHERE tenant_id = ?",
+                            (tenant_id,)).fetchone()[0]
+        pending = conn.execute("SELECT COUNT(*) FROM events WHERE tenant_id = ? AND seq > ?",
+                               (tenant_id, last)).fetchone()[0]
+        if pending >= SNAPSHOT_EVERY:
+            # Anche dai thread in background: si registra solo nelle metriche del processo
+            start = time.perf_counter()
+            self._take_snapshot(conn, tenant_id)
+            get_metrics().observe("events.snapshot", time.perf_counter() - start)
+
+    def recent_events(self, tenant_id, limit=100):
+        with self.pool.connection() as conn:
+            return [dict(row) for row in conn.execute(
+                "SELECT seq, at, tbl, op, key, row FROM events WHERE tenant_id = ? ORDER BY seq DESC LIMIT ?",
+                (tenant_id, limit))]
+
+    def event_log_stats(self, tenant_id):
+        with self.pool.connection() as conn:
+            events = conn.execute("SELECT COUNT(*), MIN(at) FROM events WHERE tenant_id = ?", (tenant_id,)).fetchone()
+            snapshots = conn.execute("SELECT COUNT(*), MAX(at), COALESCE(SUM(LENGTH(data)), 0) FROM snapshots "
+                                     "WHERE tenant_id = ?", (tenant_id,)).fetchone()
+        return {"events": events[0], "first_event": events[1], "snapshots": snapshots[0],
+                "last_snapshot": snapshots[1], "snapshot_bytes": snapshots[2]}
+
+    def _next_id(self, conn, table, tenant_id):
+        return conn.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table} WHERE tenant_id = ?",
+                            (tenant_id,)).fetchone()[0]
+
+    # Conversione tra righe e dizionari usati dalle pagine
+    def _document_from_row(self, row, data):
+        return Document(id=row["id"], name=row["name"], category=row["category"], type=row["type"],
+                        preview=encode_preview(row["type"], data), upload_date=parse_date(row["upload_date"]),
+                        expiry_date=parse_date(row["expiry_date"]), filename=row["filename"],
+                        version=row["version"])
+
+    def _deadline_from_row(self, row):
+        return Deadline(id=row["id"], title=row["title"], date=parse_date(row["date"]),
+                        description=row["description"], category=row["category"],
+                        document_id=row["document_id"], subscription_id=row["subscription_id"],
+                        status=row["status"])
+
+    def _subscription_from_row(self, row):
+        return Subscription(id=row["id"], name=row["name"], type=row["type"],
+                            renewal_date=parse_date(row["renewal_date"]), cost=row["cost"],
+                            description=row["description"], status=row["status"])
+
+    def load_tenant(self, tenant_id):
+        """Carica tutti i dati di un tenant da uno snapshot coerente"""
+        with self.pool.snapshot() as conn:
+            version = conn.execute("SELECT version FROM tenants WHERE id = ?", (tenant_id,)).fetchone()["version"]
+            # I contenuti grandi non vengono letti: le pagine li chiedono con document_preview quando servono
+            documents = [
+                self._document_from_row(row, row["data"])
+                for row in conn.execute(
+                    "SELECT d.*, CASE WHEN b.size <= ? THEN b.data END AS data FROM documents d "
+                    "LEFT JOIN blobs b ON b.tenant_id = d.tenant_id AND b.sha256 = d.blob_sha256 "
+                    "WHERE d.tenant_id = ? ORDER BY d.id",
+                    (PREVIEW_INLINE_BYTES, tenant_id)
+                )
+            ]
+            deadlines = [self._deadline_from_row(row) for row in conn.execute(
+                "SELECT * FROM deadlines WHERE tenant_id = ? ORDER BY id", (tenant_id,))]
+            subscriptions = [self._subscription_from_row(row) for row in conn.execute(
+                "SELECT * FROM subscriptions WHERE tenant_id = ? ORDER BY id", (tenant_id,))]
+            categories = [(row["name"], row["parent"]) for row in conn.execute(
+                "SELECT name, parent FROM categories WHERE tenant_id = ? ORDER BY rowid", (tenant_id,))]
+        return {
+            "version": version,
+            "documents": documents,
+            "deadlines": deadlines,
+            "subscriptions": subscriptions,
+            "categories": categories
+        }
+
+    def document_preview(self, tenant_id, doc_id):
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT d.type, b.data FROM documents d "
+                               "JOIN blobs b ON b.tenant_id = d.tenant_id AND b.sha256 = d.blob_sha256 "
+                               "WHERE d.tenant_id = ? AND d.id = ?", (tenant_id, doc_id)).fetchone()
+        return encode_preview(row["type"], row["data"]) if row else None
+
+    # Scritture: ognuna è una transazione e restituisce la nuova versione del tenant
+    # Tassonomia delle categorie: ogni categoria usata da un record è registrata nella stessa transazione
+    def _register_categories(self, conn, tenant_id, names):
+        conn.executemany("INSERT OR IGNORE INTO categories (tenant_id, name) VALUES (?, ?)",
+                         [(tenant_id, name) for name in names])
+
+    def _register_used_categories(self, conn, tenant_id):
+        conn.execute(
+            "INSERT OR IGNORE INTO categories (tenant_id, name) "
+            "SELECT DISTINCT tenant_id, category FROM documents WHERE tenant_id = ? "
+            "UNION SELECT DISTINCT tenant_id, category FROM deadlines WHERE tenant_id = ?",
+            (tenant_id, tenant_id)
+        )
+
+    def _category_subtree(self, conn, tenant_id, name):
+        return {row[0] for row in conn.execute(
+            "WITH RECURSIVE subtree(name) AS (SELECT ? UNION "
+            "SELECT c.name FROM categories c JOIN subtree s ON c.parent = s.name WHERE c.tenant_id = ?) "
+            "SELECT name FROM subtree", (name, tenant_id))}
+
+    def add_category(self, tenant_id, name, parent=None):
+        with self.pool.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO categories (tenant_id, name, parent) VALUES (?, ?, ?)",
+                         (tenant_id, name, parent))
+            return self._bump_version(conn, tenant_id)
+
+    def move_category(self, tenant_id, name, parent):
+        """Sposta una categoria sotto un'altra (o tra le radici con parent = None)"""
+        with self.pool.transaction() as conn:
+            if parent is not None and parent in self._category_subtree(conn, tenant_id, name):
+                raise ValueError(f"'{parent}' è una sottocategoria di '{name}'.")
+            conn.execute("UPDATE categories SET parent = ? WHERE tenant_id = ? AND name = ?", (parent, tenant_id, name))
+            return self._bump_version(conn, tenant_id)
+
+    def rename_category(self, tenant_id, old, new):
+        """Rinomina una categoria; se la nuova esiste già, le due vengono unite"""
+        if new == old:
+            # Senza modifiche: l'unione cancellerebbe la categoria
+            return self.tenant_version(tenant_id)
+        with self.pool.transaction() as conn:
+            if new in self._category_subtree(conn, tenant_id, old) - {old}:
+                raise ValueError(f"'{new}' è una sottocategoria di '{old}'.")
+            if conn.execute("SELECT 1 FROM categories WHERE tenant_id = ? AND name = ?", (tenant_id, new)).fetchone():
+                conn.execute("DELETE FROM categories WHERE tenant_id = ? AND name = ?", (tenant_id, old))
+            else:
+                conn.execute("UPDATE categories SET name = ? WHERE tenant_id = ? AND name = ?", (new, tenant_id, old))
+            conn.execute("UPDATE categories SET parent = ? WHERE tenant_id = ? AND parent = ?", (new, tenant_id, old))
+            for table in ["documents", "deadlines"]:
+                conn.execute(f"UPDATE {table} SET category = ? WHERE tenant_id = ? AND category = ?", (new, tenant_id, old))
+            return self._bump_version(conn, tenant_id)
+
+    def _insert_deadline(self, conn, tenant_id, deadline):
+        self._register_categories(conn, tenant_id, [deadline.category])
+        deadline.id = self._next_id(conn, "deadlines", tenant_id)
+        deadline.status = classify_status(deadline.date, date.today())
+        conn.execute(
+            "INSERT INTO deadlines (tenant_id, id, title, date, description, category, document_id, subscription_id, "
+            "status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (tenant_id, deadline.id, deadline.title, format_date(deadline.date),
+             deadline.description, deadline.category,
+             deadline.document_id, deadline.subscription_id, deadline.status)
+        )
+
+    def _insert_blob(self, conn, tenant_id, content):
+        if content is None:
+            return None
+        sha256 = hashlib.sha256(content).hexdigest()
+        conn.execute("INSERT OR IGNORE INTO blobs (tenant_id, sha256, data, size) VALUES (?, ?, ?, ?)",
+                     (tenant_id, sha256, content, len(content)))
+        return sha256
+
+    def add_document(self, tenant_id, document, content, deadline=None, original_size=None, original=None,
+                     fingerprint=None):
+        """Salva un documento, il suo contenuto e l'eventuale scadenza collegata"""
+        document.validate()
+        if deadline is not None:
+            deadline.validate()
+        with self.pool.transaction() as conn:
+            sha256 = self._insert_blob(conn, tenant_id, content)
+            # Di un'immagine normalizzata si registrano la dimensione del file caricato e, se richiesto, l'originale
+            original_sha256 = self._insert_blob(conn, tenant_id, original)
+            self._register_categories(conn, tenant_id, [document.category])
+            document.id = self._next_id(conn, "documents", tenant_id)
+            conn.execute(
+                "INSERT INTO documents (tenant_id, id, name, category, type, blob_sha256, upload_date, expiry_date, "
+                "filename, original_sha256, original_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (tenant_id, document.id, document.name, document.category, document.type, sha256,
+                 format_date(document.upload_date), format_date(document.expiry_date), document.filename,
+                 original_sha256, original_size)
+            )
+            if fingerprint is not None:
+                self._insert_fingerprint(conn, tenant_id, document.id, fingerprint)
+            if deadline is not None:
+                deadline.document_id = document.id
+                self._insert_deadline(conn, tenant_id, deadline)
+            version = self._bump_version(conn, tenant_id)
+        if deadline is not None:
+            self._notify(tenant_id, [deadline])
+        return version
+
+    def add_deadline(self, tenant_id, deadline):
+        deadline.validate()
+        with self.pool.transaction() as conn:
+            self._insert_deadline(conn, tenant_id, deadline)
+            version = self._bump_version(conn, tenant_id)
+        self._notify(tenant_id, [deadline])
+        return version
+
+    def add_subscription(self, tenant_id, subscription, deadline):
+        subscription.validate()
+        deadline.validate()
+        with self.pool.transaction() as conn:
+            subscription.id = self._next_id(conn, "subscriptions", tenant_id)
+            subscription.status = classify_status(subscription.renewal_date, date.today())
+            conn.execute(
+                "INSERT INTO subscriptions (tenant_id, id, name, type, renewal_date, cost, description, status) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (tenant_id, subscription.id, subscription.name, subscription.type,
+                 format_date(subscription.renewal_date), subscription.cost, subscription.description,
+                 subscription.status)
+            )
+            deadline.subscription_id = subscription.id
+            self._insert_deadline(conn, tenant_id, deadline)
+            version = self._bump_version(conn, tenant_id)
+        self._notify(tenant_id, [deadline])
+        return version
+
+    # Aggiornamento giornaliero degli stati: una sola passata in SQL per tenant e per giorno
+    def roll_statuses(self, tenant_id, today):
+        """Riclassifica le voci del tenant se l'ultima classificazione non è di oggi"""
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT status_day FROM tenants WHERE id = ?", (tenant_id,)).fetchone()
+        if row is None or row["status_day"] == today.isoformat():
+            return None
+        
+        bounds = self._status_bounds(tenant_id, today)
+        with self.pool.transaction() as conn:
+            status_day = conn.execute("SELECT status_day FROM tenants WHERE id = ?", (tenant_id,)).fetchone()[0]
+            if status_day == today.isoformat():
+                return None
+            # Dall'ultima classificazione possono cambiare stato solo le voci con data
+            # tra quel giorno e oggi + 7; le altre restano scadute o future
+            bounds["low"] = status_day or date.min.isoformat()
+            for table, column in STATUS_COLUMNS:
+                conn.execute(f"UPDATE {table} SET status = {self._status_case(table, column)} "
+                             f"WHERE tenant_id = :tenant_id AND {column} BETWEEN :low AND :imminent", bounds)
+            self._classify_unclassified(conn, bounds)
+            conn.execute("UPDATE tenants SET status_day = ? WHERE id = ?", (today.isoformat(), tenant_id))
+            return self._bump_version(conn, tenant_id)
+
+    def _status_bounds(self, tenant_id, today):
+        return {
+            "tenant_id": tenant_id,
+            "today": today.isoformat(),
+            "urgent": (today + timedelta(days=STATUS_URGENT_DAYS)).isoformat(),
+            "imminent": (today + timedelta(days=STATUS_IMMINENT_DAYS)).isoformat()
+        }
+
+    def _status_case(self, table, column):
+        case = (f"CASE WHEN {column} < :today THEN 'expired' WHEN {column} <= :urgent THEN 'urgent' "
+                f"WHEN {column} <= :imminent THEN 'imminent' ELSE 'future' END")
+        # Una scadenza completata resta tale qualunque sia la sua data
+        return f"CASE WHEN done_at IS NOT NULL THEN 'done' ELSE {case} END" if table == "deadlines" else case
+
+    def _classify_unclassified(self, conn, bounds):
+        for table, column in STATUS_COLUMNS:
+            conn.execute(f"UPDATE {table} SET status = {self._status_case(table, column)} "
+                         "WHERE tenant_id = :tenant_id AND status IS NULL", bounds)
+
+    def _collect_orphan_blobs(self, conn, tenant_id):
+        # Un contenuto che non è più referenziato viene segnato con l'istante del rilascio e resta per
+        # EVENT_RETENTION_DAYS giorni da allora: il ripristino a un istante della finestra ritrova
+        # tutto ciò che era referenziato in quell'istante, anche se caricato prima della finestra
+        referenced = (
+            "SELECT blob_sha256 FROM documents WHERE tenant_id = :tenant_id AND blob_sha256 IS NOT NULL "
+            "UNION SELECT original_sha256 FROM documents WHERE tenant_id = :tenant_id AND original_sha256 IS NOT NULL "
+            "UNION SELECT blob_sha256 FROM document_versions WHERE tenant_id = :tenant_id AND blob_sha256 IS NOT NULL"
+        )
+        params = {"tenant_id": tenant_id, "cutoff": retention_cutoff()}
+        conn.execute(f"UPDATE blobs SET released_at = NULL WHERE tenant_id = :tenant_id AND released_at IS NOT NULL "
+                     f"AND sha256 IN ({referenced})", params)
+        conn.execute(f"UPDATE blobs SET released_at = {EVENT_NOW} WHERE tenant_id = :tenant_id AND released_at IS NULL "
+                     f"AND sha256 NOT IN ({referenced})", params)
+        conn.execute("DELETE FROM blobs WHERE tenant_id = :tenant_id AND released_at < :cutoff", params)
+
+    def delete_document(self, tenant_id, doc_id):
+        """Elimina un documento con le scadenze associate"""
+        return self.delete_documents(tenant_id, [doc_id])
+
+    # Operazioni in blocco: una transazione, un solo passaggio sulle tabelle collegate e una sola
+    # nuova versione per tutta la selezione. Gli id sono passati come un unico array JSON
+    def delete_documents(self, tenant_id, doc_ids):
+        selection = json.dumps(list(doc_ids))
+        with self.pool.transaction() as conn:
+            conn.execute(f"DELETE FROM documents WHERE tenant_id = ? AND id IN {SELECTED_IDS}", (tenant_id, selection))
+            for table in ["deadlines", "document_pages", "document_fingerprints", "document_versions"]:
+                conn.execute(f"DELETE FROM {table} WHERE tenant_id = ? AND document_id IN {SELECTED_IDS}",
+                             (tenant_id, selection))
+            self._collect_orphan_blobs(conn, tenant_id)
+            return self._bump_version(conn, tenant_id)
+
+    def delete_deadlines(self, tenant_id, deadline_ids):
+        with self.pool.transaction() as conn:
+            conn.execute(f"DELETE FROM deadlines WHERE tenant_id = ? AND id IN {SELECTED_IDS}",
+                         (tenant_id, json.dumps(list(deadline_ids))))
+            return self._bump_version(conn, tenant_id)
+
+    def delete_subscriptions(self, tenant_id, sub_ids):
+        selection = json.dumps(list(sub_ids))
+        with self.pool.transaction() as conn:
+            conn.execute(f"DELETE FROM subscriptions WHERE tenant_id = ? AND id IN {SELECTED_IDS}", (tenant_id, selection))
+            conn.execute(f"DELETE FROM deadlines WHERE tenant_id = ? AND subscription_id IN {SELECTED_IDS}",
+                         (tenant_id, selection))
+            return self._bump_version(conn, tenant_id)
+
+    def recategorize(self, tenant_id, table, ids, category):
+        """Assegna la categoria (il tipo, per gli abbonamenti) alle voci scelte"""
+        with self.pool.transaction() as conn:
+            if table != "subscriptions":
+                self._register_categories(conn, tenant_id, [category])
+            conn.execute(f"UPDATE {table} SET {BULK_CATEGORY_COLUMNS[table]} = ? "
+                         f"WHERE tenant_id = ? AND id IN {SELECTED_IDS}", (category, tenant_id, json.dumps(list(ids))))
+            return self._bump_version(conn, tenant_id)
+
+    def mark_deadlines_done(self, tenant_id, deadline_ids, done=True):
+        with self.pool.transaction() as conn:
+            conn.execute(f"UPDATE deadlines SET done_at = ?, status = NULL WHERE tenant_id = ? AND id IN {SELECTED_IDS}",
+                         (datetime.now().isoformat() if done else None, tenant_id, json.dumps(list(deadline_ids))))
+            self._classify_unclassified(conn, self._status_bounds(tenant_id, date.today()))
+            return self._bump_version(conn, tenant_id)
+
+    def reschedule(self, tenant_id, table, ids, days):
+        """Sposta di days giorni la data delle voci scelte e delle scadenze collegate.
+        Di un documento si sposta solo la scadenza nel giorno della sua data di scadenza, non le altre collegate"""
+        column, link = BULK_DATE_COLUMNS[table]
+        shift, selection = f"{days:+d} days", json.dumps(list(ids))
+        # Le voci spostate perdono lo stato e vengono riclassificate, con l'indice delle voci senza stato
+        reset = ", status = NULL" if table != "documents" else ""
+        with self.pool.transaction() as conn:
+            linked = selection
+            if link:
+                same_day = (f" AND date = (SELECT expiry_date FROM documents d WHERE d.tenant_id = deadlines.tenant_id "
+                            f"AND d.id = deadlines.document_id)" if table == "documents" else "")
+                linked = json.dumps([row[0] for row in conn.execute(
+                    f"SELECT id FROM deadlines WHERE tenant_id = ? AND {link} IN {SELECTED_IDS}{same_day}",
+                    (tenant_id, selection))])
+                conn.execute(f"UPDATE deadlines SET date = date(date, ?), status = NULL "
+                             f"WHERE tenant_id = ? AND id IN {SELECTED_IDS}", (shift, tenant_id, linked))
+            conn.execute(f"UPDATE {table} SET {column} = date({column}, ?){reset} "
+                         f"WHERE tenant_id = ? AND {column} IS NOT NULL AND id IN {SELECTED_IDS}",
+                         (shift, tenant_id, selection))
+            self._classify_unclassified(conn, self._status_bounds(tenant_id, date.today()))
+            moved = [self._deadline_from_row(row) for row in conn.execute(
+                f"SELECT * FROM deadlines WHERE tenant_id = ? AND id IN {SELECTED_IDS}", (tenant_id, linked))]
+            version = self._bump_version(conn, tenant_id)
+        # Lo scheduler ignora i promemoria delle date vecchie e aggiunge quelli delle nuove
+        self._notify(tenant_id, moved)
+        return version
+
+    # Revisioni dei documenti
+    def add_document_version(self, tenant_id, document, content, original_size=None, original=None, fingerprint=None):
+        """Salva content come nuova revisione del documento; aggiorna document (versione, file, data)"""
+        with self.pool.transaction() as conn:
+            row = conn.execute("SELECT d.*, b.data FROM documents d "
+                               "LEFT JOIN blobs b ON b.tenant_id = d.tenant_id AND b.sha256 = d.blob_sha256 "
+                               "WHERE d.tenant_id = ? AND d.id = ?", (tenant_id, document.id)).fetchone()
+            if row is None:
+                raise ValueError("Il documento non esiste più.")
+            previous = row["data"] or b""
+            if row["type"] == "text":
+                # La revisione precedente diventa un delta rispetto a quella nuova, che resta intera
+                blob_sha256, delta = None, text_delta(content.decode(), previous.decode())
+            else:
+                blob_sha256, delta = row["blob_sha256"], None
+            conn.execute(
+                "INSERT INTO document_versions (tenant_id, document_id, version, filename, upload_date, size, "
+                "blob_sha256, delta) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (tenant_id, document.id, row["version"], row["filename"], row["upload_date"], len(previous),
+                 blob_sha256, delta)
+            )
+            
+            sha256 = self._insert_blob(conn, tenant_id, content)
+            original_sha256 = self._insert_blob(conn, tenant_id, original)
+            document.version = row["version"] + 1
+            conn.execute("UPDATE documents SET blob_sha256 = ?, filename = ?, upload_date = ?, version = ?, "
+                         "original_sha256 = ?, original_size = ? WHERE tenant_id = ? AND id = ?",
+                         (sha256, document.filename, format_date(document.upload_date), document.version,
+                          original_sha256, original_size, tenant_id, document.id))
+            # Le pagine riconosciute e la firma erano quelle della revisione precedente
+            conn.execute("DELETE FROM document_pages WHERE tenant_id = ? AND document_id = ?", (tenant_id, document.id))
+            conn.execute("DELETE FROM document_fingerprints WHERE tenant_id = ? AND document_id = ?",
+                         (tenant_id, document.id))
+            if fingerprint is not None:
+                self._insert_fingerprint(conn, tenant_id, document.id, fingerprint)
+            self._collect_orphan_blobs(conn, tenant_id)
+            return self._bump_version(conn, tenant_id)
+
+    def document_history(self, tenant_id, doc_id):
+        """Tutte le revisioni di un documento, dalla più recente: versione, file, data e dimensione"""
+        with self.pool.snapshot() as conn:
+            current = conn.execute(
+                "SELECT d.version, d.filename, d.upload_date, COALESCE(b.size, 0) AS size FROM documents d "
+                "LEFT JOIN blobs b ON b.tenant_id = d.tenant_id AND b.sha256 = d.blob_sha256 "
+                "WHERE d.tenant_id = ? AND d.id = ?", (tenant_id, doc_id)).fetchall()
+            previous = conn.execute(
+                "SELECT version, filename, upload_date, size FROM document_versions "
+                "WHERE tenant_id = ? AND document_id = ? ORDER BY version DESC", (tenant_id, doc_id)).fetchall()
+        return [{"version": row["version"], "filename": row["filename"], "upload_date": parse_date(row["upload_date"]),
+                 "size": row["size"]} for row in current + previous]
+
+    def document_version_content(self, tenant_id, doc_id, version):
+        """Contenuto di una revisione; i testi sono ricostruiti applicando i delta dalla revisione corrente"""
+        with self.pool.snapshot() as conn:
+            row = conn.execute("SELECT d.version, b.data FROM documents d "
+                               "LEFT JOIN blobs b ON b.tenant_id = d.tenant_id AND b.sha256 = d.blob_sha256 "
+                               "WHERE d.tenant_id = ? AND d.id = ?", (tenant_id, doc_id)).fetchone()
+            if row is None or version > row["version"]:
+                return None
+            content = row["data"] or b""
+            if version == row["version"]:
+                return content
+            text = content.decode()
+            for older in conn.execute(
+                    "SELECT v.version, v.delta, b.data FROM document_versions v "
+                    "LEFT JOIN blobs b ON b.tenant_id = v.tenant_id AND b.sha256 = v.blob_sha256 "
+                    "WHERE v.tenant_id = ? AND v.document_id = ? AND v.version >= ? ORDER BY v.version DESC",
+                    (tenant_id, doc_id, version)):
+                if older["delta"] is None:
+                    if older["version"] == version:
+                        return older["data"]
+                    continue
+                text = apply_text_delta(text, older["delta"])
+            return text.encode()
+
+    def replace_document_content(self, tenant_id, doc_id, content, original_size, original=None, filename=None):
+        """Sostituisce il contenuto di un documento già salvato con la sua versione normalizzata"""
+        with self.pool.transaction() as conn:
+            sha256 = self._insert_blob(conn, tenant_id, content)
+            original_sha256 = self._insert_blob(conn, tenant_id, original)
+            conn.execute("UPDATE documents SET blob_sha256 = ?, original_sha256 = ?, original_size = ?, "
+                         "filename = COALESCE(?, filename) WHERE tenant_id = ? AND id = ?",
+                         (sha256, original_sha256, original_size, filename, tenant_id, doc_id))
+            # Le pagine sono cambiate: il documento tornerà nella coda OCR alla prossima indicizzazione
+            conn.execute("DELETE FROM document_pages WHERE tenant_id = ? AND document_id = ?", (tenant_id, doc_id))
+            self._collect_orphan_blobs(conn, tenant_id)
+            return self._bump_version(conn, tenant_id)
+
+    def delete_subscription(self, tenant_id, sub_id):
+        """Elimina un abbonamento con le scadenze di rinnovo associate"""
+        return self.delete_subscriptions(tenant_id, [sub_id])
+
+    # Testo dei documenti scansionati: le pagine di ogni documento e il testo riconosciuto per hash
+    def set_document_pages(self, tenant_id, doc_id, hashes):
+        with self.pool.transaction() as conn:
+            conn.execute("DELETE FROM document_pages WHERE tenant_id = ? AND document_id = ?", (tenant_id, doc_id))
+            conn.executemany("INSERT INTO document_pages (tenant_id, document_id, page, sha256) VALUES (?, ?, ?, ?)",
+                             [(tenant_id, doc_id, page, sha256) for page, sha256 in enumerate(hashes, 1)])
+
+    def save_page_texts(self, tenant_id, texts):
+        with self.pool.transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO ocr_pages (tenant_id, sha256, text) VALUES (?, ?, ?)",
+                             [(tenant_id, sha256, text) for sha256, text in texts])
+
+    def known_pages(self, tenant_id, hashes):
+        """Gli hash, tra quelli dati, di cui il testo è già stato riconosciuto"""
+        with self.pool.connection() as conn:
+            return {row[0] for row in conn.execute(
+                f"SELECT sha256 FROM ocr_pages WHERE tenant_id = ? AND sha256 IN ({', '.join('?' * len(hashes))})",
+                (tenant_id, *hashes))}
+
+    def document_text(self, tenant_id, doc_id):
+        """Testo delle pagine già riconosciute di un documento, in ordine di pagina"""
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT o.text FROM document_pages p JOIN ocr_pages o ON o.tenant_id = p.tenant_id AND o.sha256 = p.sha256 "
+                "WHERE p.tenant_id = ? AND p.document_id = ? ORDER BY p.page", (tenant_id, doc_id)).fetchall()
+        return "\n\n".join(row[0] for row in rows if row[0])
+
+    def unindexed_documents(self, tenant_id):
+        """Immagini e PDF le cui pagine non sono ancora state estratte"""
+        with self.pool.connection() as conn:
+            return [(row["id"], row["type"], row["blob_sha256"]) for row in conn.execute(
+                "SELECT id, type, blob_sha256 FROM documents d WHERE tenant_id = ? AND type IN ('image', 'pdf') "
+                "AND blob_sha256 IS NOT NULL AND NOT EXISTS (SELECT 1 FROM document_pages p "
+                "WHERE p.tenant_id = d.tenant_id AND p.document_id = d.id) ORDER BY id", (tenant_id,))]
+
+    # Ricerca rapida (vedi search.py): voci da indicizzare, testi dei documenti e righe cambiate
+    def search_rows(self, tenant_id, changed=None):
+        """Voci di tutto il tenant, o delle sole righe tabella -> id di changed, come
+        (tabella, id, titolo, dettaglio, testo, hash dei testi del documento)"""
+        with self.pool.snapshot() as conn:
+            rows = []
+            for table, (query, id_column) in SEARCH_QUERIES.items():
+                if changed is None:
+                    rows += [(table, *row) for row in conn.execute(query, (tenant_id,))]
+                elif changed.get(table):
+                    rows += [(table, *row) for row in conn.execute(f"{query} AND {id_column} IN {SELECTED_IDS}",
+                                                                   (tenant_id, json.dumps(sorted(changed[table]))))]
+            return rows
+
+    def search_texts(self, tenant_id, hashes):
+        """Testo per hash: pagine riconosciute e, per i documenti di testo, l'inizio del contenuto"""
+        with self.pool.connection() as conn:
+            selected = json.dumps(sorted(hashes))
+            texts = dict(conn.execute(f"SELECT sha256, text FROM ocr_pages WHERE tenant_id = ? AND sha256 IN "
+                                      f"{SELECTED_IDS}", (tenant_id, selected)).fetchall())
+            for sha256, data in conn.execute(f"SELECT sha256, substr(data, 1, ?) FROM blobs WHERE tenant_id = ? "
+                                             f"AND sha256 IN {SELECTED_IDS}", (SEARCH_TEXT_BYTES, tenant_id, selected)):
+                texts.setdefault(sha256, bytes(data).decode(errors="ignore"))
+        return texts
+
+    def search_changes(self, tenant_id, seq=None):
+        """(versione, ultimo evento, tabella -> id cambiati) dopo l'evento seq del registro; senza seq
+        solo la versione e l'ultimo evento"""
+        with self.pool.snapshot() as conn:
+            version = conn.execute("SELECT version FROM tenants WHERE id = ?", (tenant_id,)).fetchone()["version"]
+            changed = {}
+            if seq is None:
+                seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM events WHERE tenant_id = ?",
+                                   (tenant_id,)).fetchone()[0]
+                return version, seq, changed
+            for seq, table, key in conn.execute("SELECT seq, tbl, key FROM events WHERE tenant_id = ? AND seq > ? "
+                                                "ORDER BY seq", (tenant_id, seq)):
+                if table in SEARCH_QUERIES:
+                    changed.setdefault(table, set()).add(json.loads(key)["id"])
+        return version, seq, changed
+
+    def documents_with_pages(self, tenant_id, hashes):
+        with self.pool.connection() as conn:
+            return {row[0] for row in conn.execute(
+                f"SELECT DISTINCT document_id FROM document_pages WHERE tenant_id = ? AND sha256 IN {SELECTED_IDS}",
+                (tenant_id, json.dumps(sorted(hashes))))}
+
+    # Firme dei documenti per il rilevamento dei quasi duplicati
+    def _insert_fingerprint(self, conn, tenant_id, doc_id, fingerprint):
+        kind, signature = fingerprint
+        conn.execute("INSERT OR REPLACE INTO document_fingerprints (tenant_id, document_id, kind, signature) "
+                     "VALUES (?, ?, ?, ?)", (tenant_id, doc_id, kind, similarity.to_bytes(kind, signature)))
+
+    def set_fingerprints(self, tenant_id, fingerprints):
+        """Salva le firme calcolate dopo il caricamento, come (id, (tipo, firma))"""
+        with self.pool.transaction() as conn:
+            for doc_id, fingerprint in fingerprints:
+                self._insert_fingerprint(conn, tenant_id, doc_id, fingerprint)
+            # Le sessioni aperte ricostruiranno il loro indice dei quasi duplicati
+            return self._bump_version(conn, tenant_id)
+
+    def load_fingerprints(self, tenant_id):
+        with self.pool.snapshot() as conn:
+            return [(row["document_id"], row["kind"], similarity.from_bytes(row["kind"], row["signature"]))
+                    for row in conn.execute("SELECT document_id, kind, signature FROM document_fingerprints "
+                                            "WHERE tenant_id = ?", (tenant_id,))]
+
+    def unfingerprinted_documents(self, tenant_id):
+        with self.pool.connection() as conn:
+            return [(row["id"], row["type"], row["blob_sha256"]) for row in conn.execute(
+                "SELECT id, type, blob_sha256 FROM documents d WHERE tenant_id = ? AND blob_sha256 IS NOT NULL "
+                "AND NOT EXISTS (SELECT 1 FROM document_fingerprints f "
+                "WHERE f.tenant_id = d.tenant_id AND f.document_id = d.id) ORDER BY id", (tenant_id,))]
+
+    # Calendario: letture per intervallo di date sugli indici (tenant_id, data)
+    def calendar_events(self, tenant_id, start, end):
+        """Scadenze e rinnovi tra start ed end, ordinati per data"""
+        with self.pool.snapshot() as conn:
+            rows = conn.execute(
+                "SELECT date, 'deadline' AS type, title, NULL AS cost FROM deadlines "
+                "WHERE tenant_id = :tenant_id AND date BETWEEN :start AND :end "
+                "UNION ALL "
+                "SELECT renewal_date, 'subscription', 'Rinnovo ' || name, cost FROM subscriptions "
+                "WHERE tenant_id = :tenant_id AND renewal_date BETWEEN :start AND :end "
+                "ORDER BY 1",
+                {"tenant_id": tenant_id, "start": start.isoformat(), "end": end.isoformat()}
+            ).fetchall()
+        return [{"date": parse_date(row[0]), "type": row["type"], "title": row["title"], "cost": row["cost"]}
+                for row in rows]
+
+    def calendar_summary(self, tenant_id, start, end):
+        """Per ogni giorno tra start ed end con eventi: numero di scadenze, di rinnovi e costo dei rinnovi"""
+        with self.pool.snapshot() as conn:
+            rows = conn.execute(
+                "SELECT day, SUM(deadlines), SUM(renewals), SUM(cost) FROM ("
+                "SELECT date AS day, COUNT(*) AS deadlines, 0 AS renewals, 0 AS cost FROM deadlines "
+                "WHERE tenant_id = :tenant_id AND date BETWEEN :start AND :end GROUP BY date "
+                "UNION ALL "
+                "SELECT renewal_date, 0, COUNT(*), SUM(cost) FROM subscriptions "
+                "WHERE tenant_id = :tenant_id AND renewal_date BETWEEN :start AND :end GROUP BY renewal_date"
+                ") GROUP BY day ORDER BY day",
+                {"tenant_id": tenant_id, "start": start.isoformat(), "end": end.isoformat()}
+            ).fetchall()
+        return {parse_date(day): (deadlines, renewals, cost) for day, deadlines, renewals, cost in rows}
+
+    def calendar_years(self, tenant_id):
+        """Primo e ultimo anno con scadenze o rinnovi (None se non ce ne sono)"""
+        with self.pool.connection() as conn:
+            low, high = conn.execute(
+                "SELECT MIN(day), MAX(day) FROM ("
+                "SELECT MIN(date) AS day FROM deadlines WHERE tenant_id = :tenant_id "
+                "UNION ALL SELECT MAX(date) FROM deadlines WHERE tenant_id = :tenant_id "
+                "UNION ALL SELECT MIN(renewal_date) FROM subscriptions WHERE tenant_id = :tenant_id "
+                "UNION ALL SELECT MAX(renewal_date) FROM subscriptions WHERE tenant_id = :tenant_id)",
+                {"tenant_id": tenant_id}
+            ).fetchone()
+        return (parse_date(low).year, parse_date(high).year) if low else None
+
+    # Feed iCalendar: chi lo conosce può leggere il calendario del tenant senza accedere all'app
+    def ics_token(self, tenant_id):
+        with self.pool.transaction() as conn:
+            token = conn.execute("SELECT ics_token FROM tenants WHERE id = ?", (tenant_id,)).fetchone()[0]
+            if token is None:
+                token = secrets.token_urlsafe(24)
+                conn.execute("UPDATE tenants SET ics_token = ? WHERE id = ?", (token, tenant_id))
+            return token
+
+    def find_tenant_by_ics_token(self, token):
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT id FROM tenants WHERE ics_token = ?", (token,)).fetchone()
+        return row["id"] if row else None
+
+# Un solo archivio (e un solo pool di connessioni) per processo server
+@st.cache_resource
+def get_store():
+    return DataStore()
+
+# Esportazione e importazione dei dati di un tenant in un unico archivio tar in streaming:
+# i metadati sono file NDJSON, i contenuti dei file sono salvati grezzi in blobs/<sha256>
+ARCHIVE_FORMAT_VERSION = 1
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVE_WORKERS = int(os.environ.get("CONTRACTME_ARCHIVE_WORKERS", "4"))
+ARCHIVE_BLOB_BATCH_BYTES = 16 * 1024 * 1024  # contenuti importati salvati in una sola transazione
+
+ARCHIVE_TABLES = {
+    "categories": ["name", "parent"],
+    "documents": ["id", "name", "category", "type", "blob_sha256", "upload_date", "expiry_date", "filename",
+                  "original_sha256", "original_size", "version"],
+    "document_versions": ["document_id", "version", "filename", "upload_date", "size", "blob_sha256", "delta"],
+    "deadlines": ["id", "title", "date", "description", "category", "document_id", "subscription_id", "done_at"],
+    "subscriptions": ["id", "name", "type", "renewal_date", "cost", "description"]
+}
+
+def _add_tar_member(tar, name, fileobj, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    tar.addfile(info, fileobj)
+
+def _read_blob(store, tenant_id, sha256):
+    with store.pool.connection() as conn:
+        row = conn.execute("SELECT data FROM blobs WHERE tenant_id = ? AND sha256 = ?",
+                           (tenant_id, sha256)).fetchone()
+    # Il blob può essere stato eliminato dopo l'inizio dell'esportazione
+    return row["data"] if row else None
+
+def export_tenant(store, tenant_id, fileobj, workers=ARCHIVE_WORKERS):
+    """Scrive tutti i dati del tenant nell'archivio, senza caricarli interamente in memoria"""
+    counts = {}
+    with tarfile.open(fileobj=fileobj, mode="w|") as tar, store.pool.snapshot() as conn:
+        for table, columns in ARCHIVE_TABLES.items():
+            # Le righe vengono scritte su un file temporaneo che resta in memoria solo se piccolo
+            with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as spool:
+                counts[table] = 0
+                cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE tenant_id = ?", (tenant_id,))
+                while True:
+                    rows = cursor.fetchmany(ARCHIVE_BATCH_SIZE)
+                    if not rows:
+                        break
+                    for row in rows:
+                        spool.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False).encode() + b"\n")
+                    counts[table] += len(rows)
+                size = spool.tell()
+                spool.seek(0)
+                _add_tar_member(tar, f"{table}.ndjson", spool, size)
+
+        # I contenuti rilasciati servono solo al ripristino dal registro, non all'archivio
+        hashes = [row["sha256"] for row in conn.execute("SELECT sha256 FROM blobs WHERE tenant_id = ? "
+                                                        "AND released_at IS NULL", (tenant_id,))]
+        counts["blobs"] = len(hashes)
+
+        # I contenuti vengono letti in parallelo, ma con al massimo 2 * workers blob in memoria
+        def write_blob(sha256, future):
+            data = future.result()
+            if data is not None:
+                _add_tar_member(tar, f"blobs/{sha256}", io.BytesIO(data), len(data))
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for sha256 in hashes:
+                pending.append((sha256, executor.submit(_read_blob, store, tenant_id, sha256)))
+                if len(pending) >= 2 * workers:
+                    write_blob(*pending.popleft())
+            while pending:
+                write_blob(*pending.popleft())
+
+        manifest = json.dumps({"format": ARCHIVE_FORMAT_VERSION, "exported_at": datetime.now().isoformat(),
+                               "counts": counts}).encode()
+        _add_tar_member(tar, "manifest.json", io.BytesIO(manifest), len(manifest))
+    return counts
+
+def _verify_blob(name, data):
+    sha256 = name.split("/", 1)[1]
+    if hashlib.sha256(data).hexdigest() != sha256:
+        raise ValueError(f"Contenuto corrotto nell'archivio: {name}")
+    return sha256, data
+
+def import_tenant(store, tenant_id, fileobj, workers=ARCHIVE_WORKERS):
+    """Aggiunge al tenant i dati di un archivio, rinumerando gli id per evitare collisioni"""
+    # Le righe vengono preparate in un database temporaneo e i contenuti salvati a lotti, ognuno nella
+    # sua transazione: le scritture degli altri processi attendono solo la copia finale delle righe
+    with tempfile.TemporaryDirectory(prefix="contractme-import-") as staging_dir:
+        staging_path = os.path.join(staging_dir, "staging.db")
+        try:
+            counts = _stage_archive(store, tenant_id, fileobj, staging_path, workers)
+        except BaseException:
+            # I contenuti già salvati restano senza riferimenti: vengono segnati come rilasciati
+            with store.pool.transaction() as conn:
+                store._collect_orphan_blobs(conn, tenant_id)
+            raise
+
+        with store.pool.transaction(attach={"staging": staging_path}) as conn:
+            offsets = {table: conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table} WHERE tenant_id = ?",
+                                           (tenant_id,)).fetchone()[0]
+                       for table in ["documents", "deadlines", "subscriptions"]}
+            for table, columns in ARCHIVE_TABLES.items():
+                values = ", ".join(ARCHIVE_REMAP.get((table, column), column) for column in columns)
+                conn.execute(f"INSERT OR IGNORE INTO main.{table} (tenant_id, {', '.join(columns)}) "
+                             f"SELECT :tenant_id, {values} FROM staging.{table}", {"tenant_id": tenant_id, **offsets})
+            store._register_used_categories(conn, tenant_id)
+            # I contenuti salvati prima delle righe possono essere stati segnati come rilasciati
+            store._collect_orphan_blobs(conn, tenant_id)
+            # Le voci importate non hanno stato: verranno classificate alla prossima sincronizzazione
+            conn.execute("UPDATE tenants SET status_day = NULL WHERE id = ?", (tenant_id,))
+            store._bump_version(conn, tenant_id)
+    store._notify(tenant_id, None)
+    return counts
+
+# Nuovi id delle righe importate: (tabella, colonna) -> espressione con lo scostamento della tabella di origine
+ARCHIVE_REMAP = {
+    ("documents", "id"): "id + :documents",
+    ("documents", "version"): "COALESCE(version, 1)",  # gli archivi precedenti alle revisioni non l'hanno
+    ("document_versions", "document_id"): "document_id + :documents",
+    ("deadlines", "id"): "id + :deadlines",
+    ("deadlines", "document_id"): "document_id + :documents",
+    ("deadlines", "subscription_id"): "subscription_id + :subscriptions",
+    ("subscriptions", "id"): "id + :subscriptions"
+}
+
+def _stage_archive(store, tenant_id, fileobj, staging_path, workers):
+    """Salva i contenuti dell'archivio nel tenant e ne copia le righe nel database staging_path"""
+    counts = {}
+    staging = sqlite3.connect(staging_path, isolation_level=None)
+    try:
+        for table, columns in ARCHIVE_TABLES.items():
+            staging.execute(f"CREATE TABLE {table} ({', '.join(columns)})")
+        staging.execute("BEGIN")
+        blobs = []
+
+        def save_blobs():
+            with store.pool.transaction() as conn:
+                conn.executemany("INSERT OR IGNORE INTO blobs (tenant_id, sha256, data, size) VALUES (?, ?, ?, ?)",
+                                 [(tenant_id, sha256, data, len(data)) for sha256, data in blobs])
+            counts["blobs"] = counts.get("blobs", 0) + len(blobs)
+            blobs.clear()
+
+        def add_blob(future):
+            blobs.append(future.result())
+            if len(blobs) >= ARCHIVE_BATCH_SIZE or sum(len(data) for _, data in blobs) >= ARCHIVE_BLOB_BATCH_BYTES:
+                save_blobs()
+
+        with tarfile.open(fileobj=fileobj, mode="r|") as tar, ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for member in tar:
+                if not member.isfile():
+                    continue
+                source = tar.extractfile(member)
+
+                if member.name.startswith("blobs/"):
+                    # La verifica dell'hash avviene in parallelo, con al massimo 2 * workers contenuti in attesa
+                    pending.append(executor.submit(_verify_blob, member.name, source.read()))
+                    if len(pending) >= 2 * workers:
+                        add_blob(pending.popleft())
+                    continue
+
+                table = member.name.removesuffix(".ndjson")
+                if table not in ARCHIVE_TABLES:
+                    continue
+                columns = ARCHIVE_TABLES[table]
+                counts[table] = 0
+                batch = []
+                for line in source:
+                    record = json.loads(line)
+                    batch.append([record.get(column) for column in columns])
+                    if len(batch) >= ARCHIVE_BATCH_SIZE:
+                        counts[table] += len(batch)
+                        _insert_archive_rows(staging, table, columns, batch, tenant=False)
+                        batch = []
+                counts[table] += len(batch)
+                _insert_archive_rows(staging, table, columns, batch, tenant=False)
+
+            while pending:
+                add_blob(pending.popleft())
+        if blobs:
+            save_blobs()
+        staging.execute("COMMIT")
+    finally:
+        staging.close()
+    return counts
+
+def _insert_archive_rows(conn, table, columns, rows, tenant=True):
+    # Le righe iniziano con il tenant_id, tranne quelle del database temporaneo dell'importazione
+    if rows:
+        columns = ["tenant_id", *columns] if tenant else columns
+        conn.executemany(f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                         rows)
+
+# Registro delle modifiche: i trigger scrivono un evento per ogni riga inserita, modificata o eliminata
+# nelle tabelle dell'archivio; ogni SNAPSHOT_EVERY eventi si salva un'istantanea compattata del tenant.
+# Gli istanti sono in UTC, con i millisecondi
+EVENT_NOW = "strftime('%Y-%m-%dT%H:%M:%f', 'now')"
+SNAPSHOT_EVERY = int(os.environ.get("CONTRACTME_SNAPSHOT_EVERY", "1000"))
+EVENT_RETENTION_DAYS = int(os.environ.get("CONTRACTME_EVENT_RETENTION_DAYS", "30"))
+
+# Colonne che identificano una riga di ogni tabella registrata (le colonne registrate sono quelle dell'archivio)
+EVENT_KEYS = {
+    "categories": ["name"],
+    "documents": ["id"],
+    "document_versions": ["document_id", "version"],
+    "deadlines": ["id"],
+    "subscriptions": ["id"]
+}
+
+def _json_object(columns, prefix=""):
+    return "json_object(" + ", ".join(f"'{column}', {prefix}{column}" for column in columns) + ")"
+
+def event_log_triggers():
+    """Trigger del registro come nome -> CREATE TRIGGER, costruiti dalle colonne di ARCHIVE_TABLES"""
+    triggers = {}
+    for table, keys in EVENT_KEYS.items():
+        columns = ARCHIVE_TABLES[table]
+        # Le modifiche delle sole colonne non registrate (lo stato) non producono eventi
+        for op, event, source in [("insert", "INSERT", "NEW"), ("update", f"UPDATE OF {', '.join(columns)}", "OLD"),
+                                  ("delete", "DELETE", "OLD")]:
+            row = _json_object(columns, "NEW.") if op != "delete" else "NULL"
+            triggers[f"events_{table}_{op}"] = (
+                f"CREATE TRIGGER events_{table}_{op} AFTER {event} ON {table} BEGIN "
+                f"INSERT INTO events (tenant_id, at, tbl, op, key, row) VALUES ({source}.tenant_id, {EVENT_NOW}, "
+                f"'{table}', '{op}', {_json_object(keys, source + '.')}, {row}); END"
+            )
+    return triggers
+
+def install_event_log_triggers(conn):
+    """Ricrea, nella transazione di conn, solo i trigger mancanti o diversi da quelli attesi"""
+    existing = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall())
+    for name, sql in event_log_triggers().items():
+        if existing.get(name) != sql:
+            conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+            conn.execute(sql)
+
+def event_time(moment):
+    """Istante (datetime, anche locale senza fuso) nel formato UTC del registro"""
+    return moment.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+def retention_cutoff():
+    return event_time(datetime.now() - timedelta(days=EVENT_RETENTION_DAYS))
+
+def _event_key(table, record):
+    return tuple(record[column] for column in EVENT_KEYS[table])
+
+def _event_record(table, row):
+    # Le istantanee e gli eventi precedenti a una nuova colonna non la contengono
+    record = json.loads(row) if isinstance(row, str) else row
+    return {column: record.get(column) for column in ARCHIVE_TABLES[table]}
+
+def replay_tenant(store, tenant_id, until=None):
+    """Dati del tenant all'istante until (o attuali): ultima istantanea precedente più gli eventi successivi"""
+    until = event_time(until) if until else "9999"
+    with store.pool.snapshot() as conn:
+        snapshot = conn.execute("SELECT seq, data FROM snapshots WHERE tenant_id = ? AND at <= ? "
+                                "ORDER BY seq DESC LIMIT 1", (tenant_id, until)).fetchone()
+        if snapshot is None:
+            raise ValueError("Nessuna istantanea precedente all'istante richiesto: "
+                             "il registro delle modifiche inizia dopo.")
+        state = {table: {} for table in EVENT_KEYS}
+        for table, records in json.loads(zlib.decompress(snapshot["data"])).items():
+            for record in records:
+                record = _event_record(table, record)
+                state[table][_event_key(table, record)] = record
+
+        cursor = conn.execute("SELECT tbl, op, key, row FROM events WHERE tenant_id = ? AND seq > ? AND at <= ? "
+                              "ORDER BY seq", (tenant_id, snapshot["seq"], until))
+        for table, op, key, row in cursor:
+            rows = state[table]
+            # Una modifica può cambiare anche la chiave (rinomina di una categoria)
+            rows.pop(_event_key(table, json.loads(key)), None)
+            if op != "delete":
+                record = _event_record(table, row)
+                rows[_event_key(table, record)] = record
+    return {table: list(rows.values()) for table, rows in state.items()}
+
+def verify_event_log(store, tenant_id):
+    """Righe (tabella, chiave) che differiscono tra i dati ricostruiti dal registro e quelli attuali"""
+    replayed = replay_tenant(store, tenant_id)
+    with store.pool.snapshot() as conn:
+        current = store._tenant_rows(conn, tenant_id)
+    differences = []
+    for table in EVENT_KEYS:
+        expected = {_event_key(table, record): record for record in map(json.loads, current[table])}
+        actual = {_event_key(table, record): record for record in replayed[table]}
+        differences += [(table, key) for key in expected.keys() | actual.keys() if expected.get(key) != actual.get(key)]
+    return differences
+
+def restore_tenant(store, tenant_id, until, tenant_name, username, password):
+    """Ricrea in un nuovo spazio di lavoro i dati del tenant all'istante until"""
+    state = replay_tenant(store, tenant_id, until)
+    target = store.create_tenant(tenant_name, username, password)["tenant_id"]
+    hashes = {record.get(column) for table in ["documents", "document_versions"] for record in state[table]
+              for column in ["blob_sha256", "original_sha256"]} - {None}
+    with store.pool.transaction() as conn:
+        conn.execute("DELETE FROM categories WHERE tenant_id = ?", (target,))
+        for table, columns in ARCHIVE_TABLES.items():
+            _insert_archive_rows(conn, table, columns,
+                                 [[target] + [record.get(column) for column in columns] for record in state[table]])
+        conn.executemany("INSERT OR IGNORE INTO blobs (tenant_id, sha256, data, size) "
+                         "SELECT ?, sha256, data, size FROM blobs WHERE tenant_id = ? AND sha256 = ?",
+                         [(target, tenant_id, sha256) for sha256 in hashes])
+        restored = {row[0] for row in conn.execute("SELECT sha256 FROM blobs WHERE tenant_id = ?", (target,))}
+        conn.execute("UPDATE tenants SET status_day = NULL WHERE id = ?", (target,))
+        store._bump_version(conn, target)
+    counts = {table: len(records) for table, records in state.items()}
+    # I contenuti eliminati da più di EVENT_RETENTION_DAYS giorni non sono più disponibili
+    counts["missing_blobs"] = len(hashes - restored)
+    return counts
+
+# Normalizzazione delle immagini caricate: orientamento secondo l'EXIF, metadati rimossi,
+# lato massimo limitato e un formato compresso al posto del PNG senza perdita
+IMAGE_MAX_SIZE = int(os.environ.get("CONTRACTME_IMAGE_MAX_SIZE", "2048"))
+IMAGE_FORMAT = os.environ.get("CONTRACTME_IMAGE_FORMAT", "WEBP").upper()
+IMAGE_QUALITY = int(os.environ.get("CONTRACTME_IMAGE_QUALITY", "80"))
+IMAGE_KEEP_ORIGINAL = os.environ.get("CONTRACTME_IMAGE_KEEP_ORIGINAL") == "1"
+INGEST_WORKERS = int(os.environ.get("CONTRACTME_INGEST_WORKERS", "4"))
+IMAGE_EXTENSION = {"JPEG": "jpg"}.get(IMAGE_FORMAT, IMAGE_FORMAT.lower())
+
+def normalize_image(data):
+    """Restituisce l'immagine raddrizzata, ridimensionata e ricodificata, senza metadati"""
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        image.thumbnail((IMAGE_MAX_SIZE, IMAGE_MAX_SIZE), Image.Resampling.LANCZOS)
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        if IMAGE_FORMAT == "JPEG" and has_alpha:
+            # Il JPEG non ha trasparenza: lo sfondo diventa bianco come sulla pagina
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+            image = background
+        elif image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if has_alpha else "RGB")
+        # Salvando senza exif né icc_profile i metadati del file originale non vengono copiati
+        output = io.BytesIO()
+        image.save(output, format=IMAGE_FORMAT, quality=IMAGE_QUALITY, optimize=True)
+    return output.getvalue()
+
+def normalized_filename(filename):
+    # Il nome del file segue il formato ricodificato, così download e tipo MIME coincidono con il contenuto
+    return f"{os.path.splitext(filename)[0]}.{IMAGE_EXTENSION}"
+
+def ingest_image(data):
+    """Normalizza un'immagine caricata: (contenuto, dimensione originale, originale da conservare)"""
+    content = normalize_image(data)
+    count("ingest.images")
+    count("ingest.bytes_saved", len(data) - len(content))
+    return content, len(data), data if IMAGE_KEEP_ORIGINAL else None
+
+# La decodifica e la codifica di Pillow rilasciano il GIL: le immagini vengono elaborate in parallelo
+# su un pool condiviso dal processo, senza bloccare il thread della rerun
+@st.cache_resource
+def get_ingest_pool():
+    return ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="contractme-ingest")
+
+def normalize_stored_images(store, tenant_id, batch_size=INGEST_WORKERS * 4):
+    """Normalizza le immagini già salvate prima dell'introduzione della normalizzazione"""
+    with store.pool.snapshot() as conn:
+        rows = [(row["id"], row["name"], row["filename"], row["blob_sha256"]) for row in conn.execute(
+            "SELECT id, name, filename, blob_sha256 FROM documents WHERE tenant_id = ? AND type = 'image' "
+            "AND original_size IS NULL AND blob_sha256 IS NOT NULL ORDER BY id", (tenant_id,))]
+    
+    # Al più batch_size immagini in memoria alla volta
+    pool = get_ingest_pool()
+    for i in range(0, len(rows), batch_size):
+        # Un documento eliminato nel frattempo non ha più contenuto
+        batch = [(doc_id, name, filename, data) for doc_id, name, filename, sha256 in rows[i:i + batch_size]
+                 if (data := _read_blob(store, tenant_id, sha256)) is not None]
+        for (doc_id, name, filename, _), result in zip(batch, pool.map(ingest_image, [data for *_, data in batch])):
+            content, original_size, original = result
+            store.replace_document_content(tenant_id, doc_id, content, original_size, original,
+                                           filename=normalized_filename(filename))
+            yield doc_id, name, original_size, len(content)
+
+# OCR dei documenti scansionati (opzionale, vedi ocr.py): ogni pagina è un'attività di un pool di processi
+# e il testo viene salvato per hash della pagina, così nessuna pagina viene riconosciuta due volte
+OCR_ENABLED = os.environ.get("CONTRACTME_OCR", "1") == "1"
+OCR_WORKERS = int(os.environ.get("CONTRACTME_OCR_WORKERS", str(os.cpu_count() or 2)))
+OCR_THROUGHPUT_WINDOW = 300  # secondi su cui si calcolano le pagine al minuto
+
+def ocr_enabled(doc_type):
+    return OCR_ENABLED and ocr.available(doc_type)
+
+class OcrQueue:
+    """Coda delle pagine da riconoscere, condivisa da tutte le sessioni del processo"""
+
+    def __init__(self, store, workers=OCR_WORKERS, on_text=None):
+        self.store = store
+        self.workers = workers
+        # Avvisata con (tenant, hash delle pagine) quando il testo di un documento cambia
+        self.on_text = on_text
+        self.failed = 0
+        # Il server ha già altri thread attivi: i processi vengono avviati con spawn invece di fork
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        # La suddivisione in pagine (il rendering dei PDF) avviene fuori dalla rerun, un documento alla volta
+        self._splitter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="contractme-ocr")
+        # Rientrante: la callback di una pagina già completata viene eseguita subito, dentro submit
+        self._lock = threading.RLock()
+        self._documents = 0    # documenti in attesa di suddivisione
+        self._pending = set()  # (tenant_id, hash) delle pagine in coda o in lavorazione
+        self._finished = deque()  # istanti di completamento delle pagine recenti
+
+    def enqueue(self, tenant_id, doc_id, doc_type, data):
+        with self._lock:
+            self._documents += 1
+        return self._splitter.submit(self._split, tenant_id, doc_id, doc_type, data)
+
+    def _split_stored(self, tenant_id, doc_id, doc_type, sha256):
+        # Il contenuto viene letto solo quando tocca al documento, non per tutta la coda insieme
+        data = _read_blob(self.store, tenant_id, sha256)
+        if data is None:
+            with self._lock:
+                self._documents -= 1
+            return
+        self._split(tenant_id, doc_id, doc_type, data)
+
+    def _split(self, tenant_id, doc_id, doc_type, data):
+        try:
+            pages = ocr.split_pages(doc_type, data)
+        except Exception as e:
+            with self._lock:
+                self._documents -= 1
+                self.failed += 1
+            get_metrics().increment("ocr.failures")
+            logger.warning("Documento %s non leggibile per l'OCR: %s", doc_id, e)
+            return
+        
+        hashes = [sha256 for sha256, _, _ in pages]
+        self.store.save_page_texts(tenant_id, [(sha256, text) for sha256, _, text in pages if text is not None])
+        self.store.set_document_pages(tenant_id, doc_id, hashes)
+        known = self.store.known_pages(tenant_id, hashes)
+        get_metrics().increment("ocr.cache_hits", len(known))
+        if self.on_text:
+            self.on_text(tenant_id, hashes)
+        
+        with self._lock:
+            self._documents -= 1
+            for sha256, image, _ in pages:
+                # Una pagina ripetuta (anche da un altro documento ancora in coda) viene riconosciuta una volta sola
+                if sha256 in known or (tenant_id, sha256) in self._pending:
+                    continue
+                self._pending.add((tenant_id, sha256))
+                future = self._pool.submit(ocr.recognize, image)
+                future.add_done_callback(lambda f, sha256=sha256: self._finish(tenant_id, sha256, f))
+
+    def _finish(self, tenant_id, sha256, future):
+        try:
+            self.store.save_page_texts(tenant_id, [(sha256, future.result())])
+            get_metrics().increment("ocr.pages")
+            if self.on_text:
+                self.on_text(tenant_id, [sha256])
+        except Exception as e:
+            # Una pagina non riconosciuta resta senza testo e non blocca la coda
+            # (anche un processo del pool terminato o un errore dell'archivio)
+            with self._lock:
+                self.failed += 1
+            get_metrics().increment("ocr.failures")
+            logger.warning("OCR della pagina %s fallito: %s", sha256[:12], e)
+        finally:
+            with self._lock:
+                self._pending.discard((tenant_id, sha256))
+                self._finished.append(time.monotonic())
+
+    def shutdown(self):
+        self._splitter.shutdown()
+        self._pool.shutdown()
+
+    def stats(self):
+        horizon = time.monotonic() - OCR_THROUGHPUT_WINDOW
+        with self._lock:
+            while self._finished and self._finished[0] < horizon:
+                self._finished.popleft()
+            return {
+                "workers": self.workers,
+                "documents_waiting": self._documents,
+                "queue_depth": len(self._pending),
+                "pages_per_minute": len(self._finished) * 60 / OCR_THROUGHPUT_WINDOW,
+                "failed": self.failed
+            }
+
+    def reindex(self, tenant_id):
+        """Accoda le immagini e i PDF del tenant di cui non sono ancora state estratte le pagine"""
+        documents = [(doc_id, doc_type, sha256) for doc_id, doc_type, sha256 in
+                     self.store.unindexed_documents(tenant_id) if ocr_enabled(doc_type)]
+        with self._lock:
+            self._documents += len(documents)
+        for doc_id, doc_type, sha256 in documents:
+            self._splitter.submit(self._split_stored, tenant_id, doc_id, doc_type, sha256)
+        return len(documents)
+
+@st.cache_resource
+def get_ocr_queue():
+    queue = OcrQueue(get_store(), on_text=get_search().text_changed)
+    get_metrics().register("ocr", queue)
+    return queue
+
+# Quasi duplicati: firme dei documenti caricati prima del rilevamento e gruppi di documenti simili
+def stored_fingerprint(doc_type, data):
+    try:
+        return similarity.fingerprint(doc_type, data)
+    except (OSError, RuntimeError, Image.DecompressionBombError):
+        return None
+
+def fingerprint_stored_documents(store, tenant_id, batch_size=INGEST_WORKERS * 4):
+    """Calcola sul pool di ingestione le firme mancanti, con al più batch_size contenuti in memoria"""
+    rows = store.unfingerprinted_documents(tenant_id)
+    pool = get_ingest_pool()
+    saved = 0
+    for i in range(0, len(rows), batch_size):
+        batch = [(doc_id, doc_type, data) for doc_id, doc_type, sha256 in rows[i:i + batch_size]
+                 if (data := _read_blob(store, tenant_id, sha256)) is not None]
+        fingerprints = pool.map(stored_fingerprint, [doc_type for _, doc_type, _ in batch], [data for _, _, data in batch])
+        results = [(doc_id, fingerprint) for (doc_id, _, _), fingerprint in zip(batch, fingerprints) if fingerprint]
+        if results:
+            store.set_fingerprints(tenant_id, results)
+        saved += len(results)
+    return saved
+
+def duplicate_groups(store, tenant_id):
+    """Gruppi di documenti collegati da coppie di quasi duplicati"""
+    index = similarity.NearDuplicateIndex(store.load_fingerprints(tenant_id))
+    seen = set()
+    groups = []
+    for doc_id in index.signatures:
+        if doc_id in seen:
+            continue
+        group, stack = set(), [doc_id]
+        while stack:
+            current = stack.pop()
+            if current in group:
+                continue
+            group.add(current)
+            stack.extend(other for other, _ in index.query(*index.signatures[current]) if other not in group)
+        seen |= group
+        if len(group) > 1:
+            groups.append(sorted(group))
+    return groups
+
+# Ricerca rapida dalla sidebar (vedi search.py): un indice per tenant condiviso dalle sessioni del processo.
+# Dopo una scrittura si reindicizzano solo le righe cambiate secondo il registro delle modifiche; il testo
+# riconosciuto dall'OCR, che non cambia la versione del tenant, viene segnalato dalla coda OCR
+SEARCH_RESULTS = 8
+SEARCH_TEXT_BYTES = 256 * 1024  # inizio del contenuto indicizzato dei documenti di testo
+SEARCH_TEXT_BATCH = 500
+
+# Tabella -> (query delle voci, colonna dell'id): titolo, dettaglio mostrato, testo e hash dei testi del documento
+SEARCH_QUERIES = {
+    "documents": ("SELECT d.id, d.name, d.category, d.category || ' ' || d.type || ' ' || d.filename, "
+                  "CASE WHEN d.type = 'text' THEN d.blob_sha256 ELSE (SELECT group_concat(p.sha256, ' ') "
+                  "FROM document_pages p WHERE p.tenant_id = d.tenant_id AND p.document_id = d.id) END "
+                  "FROM documents d WHERE d.tenant_id = ?", "d.id"),
+    "deadlines": ("SELECT id, title, strftime('%d/%m/%Y', date), category || ' ' || description, NULL FROM deadlines "
+                  "WHERE tenant_id = ?", "id"),
+    "subscriptions": ("SELECT id, name, type, type || ' ' || description, NULL FROM subscriptions "
+                      "WHERE tenant_id = ?", "id")
+}
+SEARCH_KINDS = {"documents": "document", "deadlines": "deadline", "subscriptions": "subscription"}
+
+class SearchIndexes:
+    """Indici della ricerca rapida dei tenant, costruiti alla prima ricerca e poi aggiornati"""
+
+    def __init__(self, store):
+        self.store = store
+        # tenant_id -> indice, versione, ultimo evento, termini per hash, hash con testo nuovo,
+        # hash delle pagine di ogni voce e numero di voci che usano ogni hash
+        self._tenants = {}
+        self._lock = threading.Lock()
+
+    def _tenant(self, tenant_id):
+        with self._lock:
+            return self._tenants.setdefault(tenant_id, {"lock": threading.Lock(), "index": None, "version": None,
+                                                        "seq": 0, "texts": {}, "stale": set(), "pages": {},
+                                                        "refs": Counter()})
+
+    def text_changed(self, tenant_id, hashes):
+        """Chiamata dalla coda OCR quando il testo di alcune pagine è stato salvato"""
+        tenant = self._tenant(tenant_id)
+        with self._lock:
+            tenant["stale"].update(hashes)
+
+    def _entries(self, tenant, tenant_id, rows):
+        # I termini di ogni contenuto si estraggono una volta sola, anche se più documenti lo condividono
+        texts = tenant["texts"]
+        missing = sorted({sha256 for row in rows if row[5] for sha256 in row[5].split()} - texts.keys())
+        for i in range(0, len(missing), SEARCH_TEXT_BATCH):
+            batch = missing[i:i + SEARCH_TEXT_BATCH]
+            found = self.store.search_texts(tenant_id, batch)
+            for sha256 in batch:
+                texts[sha256] = frozenset(search.terms(found.get(sha256, "")))
+        for table, record_id, title, detail, text, hashes in rows:
+            hashes = (hashes or "").split()
+            tenant["pages"][SEARCH_KINDS[table], record_id] = hashes
+            tenant["refs"].update(hashes)
+            parts = [frozenset(search.terms(text))] + [texts[sha256] for sha256 in hashes]
+            yield SEARCH_KINDS[table], record_id, title, str(detail), tuple(part for part in parts if part)
+
+    def _release(self, tenant, hashes):
+        # I termini di un contenuto restano finché almeno una voce dell'indice lo usa
+        refs = tenant["refs"]
+        for sha256 in hashes:
+            refs[sha256] -= 1
+            if refs[sha256] <= 0:
+                del refs[sha256]
+                tenant["texts"].pop(sha256, None)
+
+    def _refresh(self, tenant, tenant_id):
+        version, seq, changed = self.store.search_changes(tenant_id, tenant["seq"] if tenant["index"] else None)
+        with self._lock:
+            stale, tenant["stale"] = tenant["stale"], set()
+        if tenant["index"] is None:
+            start = time.perf_counter()
+            tenant["index"] = search.SearchIndex(self._entries(tenant, tenant_id, self.store.search_rows(tenant_id)))
+            get_metrics().observe("search.build", time.perf_counter() - start)
+        else:
+            if stale:
+                for sha256 in stale:
+                    tenant["texts"].pop(sha256, None)
+                changed.setdefault("documents", set()).update(self.store.documents_with_pages(tenant_id, stale))
+            if not changed:
+                tenant.update(version=version, seq=seq)
+                return
+            index = tenant["index"]
+            released = []
+            for table, ids in changed.items():
+                for record_id in ids:
+                    index.remove(SEARCH_KINDS[table], record_id)
+                    released.extend(tenant["pages"].pop((SEARCH_KINDS[table], record_id), ()))
+            for entry in self._entries(tenant, tenant_id, self.store.search_rows(tenant_id, changed)):
+                index.add(*entry)
+            # Dopo le nuove voci: le pagine rimaste uguali non vanno rilette dall'archivio
+            self._release(tenant, released)
+        tenant.update(version=version, seq=seq)
+
+    def search(self, tenant_id, query, limit=SEARCH_RESULTS):
+        """(voci trovate, numero totale) con l'indice aggiornato all'ultima scrittura del tenant"""
+        tenant = self._tenant(tenant_id)
+        with tenant["lock"]:
+            if tenant["index"] is None or tenant["stale"] or tenant["version"] != self.store.tenant_version(tenant_id):
+                self._refresh(tenant, tenant_id)
+            return tenant["index"].search(query, limit)
+
+    def stats(self):
+        with self._lock:
+            tenants = list(self._tenants.values())
+        return {"tenants": sum(tenant["index"] is not None for tenant in tenants),
+                "entries": sum(len(tenant["index"]) for tenant in tenants if tenant["index"] is not None),
+                "texts": sum(len(tenant["texts"]) for tenant in tenants)}
+
+@st.cache_resource
+def get_search():
+    indexes = SearchIndexes(get_store())
+    get_metrics().register("search", indexes)
+    return indexes
+
+# Feed iCalendar (.ics) di scadenze e rinnovi, generato a lotti e inviato in streaming:
+# i calendari esterni si abbonano all'URL del feed senza passare dall'interfaccia
+ICS_PORT = int(os.environ.get("CONTRACTME_ICS_PORT", "0"))
+ICS_BASE_URL = os.environ.get("CONTRACTME_ICS_BASE_URL", f"http://localhost:{ICS_PORT}")
+ICS_TIMEOUT = float(os.environ.get("CONTRACTME_ICS_TIMEOUT", "30"))  # secondi di attesa di un client lento
+
+def _ics_text(value):
+    return value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def _ics_line(line):
+    """Riga terminata da CRLF e ripiegata a 75 byte, come richiede RFC 5545"""
+    data = line.encode()
+    parts = []
+    limit = 75
+    while len(data) > limit:
+        cut = limit
+        # Non si spezza un carattere UTF-8 a metà
+        while data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(data[:cut])
+        data = data[cut:]
+        limit = 74  # le righe di continuazione iniziano con uno spazio
+    parts.append(data)
+    return b"\r\n ".join(parts) + b"\r\n"
+
+def _ics_event(uid, stamp, day, summary, description, rrule=None):
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{uid}",
+        f"DTSTAMP:{stamp}",
+        f"DTSTART;VALUE=DATE:{day:%Y%m%d}",
+        f"DTEND;VALUE=DATE:{day + timedelta(days=1):%Y%m%d}",
+        f"SUMMARY:{_ics_text(summary)}",
+        f"DESCRIPTION:{_ics_text(description)}"
+    ]
+    if rrule:
+        lines.append(f"RRULE:{rrule}")
+    lines.append("END:VEVENT")
+    return b"".join(_ics_line(line) for line in lines)
+
+def _monthly_rule(day):
+    # Come nelle proiezioni dei costi, un rinnovo del 29-31 cade sull'ultimo giorno dei mesi più corti
+    if day.day <= 28:
+        return "FREQ=MONTHLY"
+    return f"FREQ=MONTHLY;BYMONTHDAY={','.join(str(d) for d in range(28, day.day + 1))};BYSETPOS=-1"
+
+def _ics_batches(store, query, params, order, batch_size):
+    """Righe della query a lotti, paginate sulla chiave (order, id)"""
+    # Ogni lotto usa una connessione propria, restituita al pool prima che il lotto venga inviato:
+    # un client lento non tiene occupata una connessione
+    after, key = "", ()
+    while True:
+        with store.pool.snapshot() as conn:
+            rows = conn.execute(f"{query}{after} ORDER BY {order}, id LIMIT ?", (*params, *key, batch_size)).fetchall()
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        after, key = f" AND ({order}, id) > (?, ?)", (rows[-1][order], rows[-1]["id"])
+
+def ics_feed(store, tenant_id, batch_size=ARCHIVE_BATCH_SIZE):
+    """Genera il feed del tenant a blocchi di byte, leggendo le voci a lotti"""
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    yield b"".join(_ics_line(line) for line in [
+        "BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//ContractME//Scadenze//IT", "CALSCALE:GREGORIAN",
+        "X-WR-CALNAME:ContractME"
+    ])
+    # I rinnovi degli abbonamenti sono eventi mensili ricorrenti: le loro scadenze non si ripetono.
+    # Le scadenze completate escono dal feed e spariscono dai calendari al successivo aggiornamento
+    for rows in _ics_batches(store, "SELECT id, title, date, description, category FROM deadlines "
+                                    "WHERE tenant_id = ? AND subscription_id IS NULL AND done_at IS NULL",
+                             (tenant_id,), "date", batch_size):
+        yield b"".join(
+            _ics_event(f"deadline-{tenant_id}-{row['id']}@contractme", stamp, parse_date(row["date"]),
+                       row["title"], f"{row['category']}\n{row['description']}".strip())
+            for row in rows
+        )
+    for rows in _ics_batches(store, "SELECT id, name, type, renewal_date, cost, description FROM subscriptions "
+                                    "WHERE tenant_id = ?", (tenant_id,), "renewal_date", batch_size):
+        yield b"".join(
+            _ics_event(f"subscription-{tenant_id}-{row['id']}@contractme", stamp, parse_date(row["renewal_date"]),
+                       f"Rinnovo {row['name']}",
+                       f"{row['type']} - {row['cost']:.2f} € al mese\n{row['description']}".strip(),
+                       rrule=_monthly_rule(parse_date(row["renewal_date"])))
+            for row in rows
+        )
+    yield _ics_line("END:VCALENDAR")
+
+def ics_url(store, tenant_id):
+    return f"{ICS_BASE_URL}/calendar/{store.ics_token(tenant_id)}.ics"
+
+class IcsRequestHandler(BaseHTTPRequestHandler):
+    """Serve GET /calendar/<token>.ics; la risposta HTTP/1.0 senza lunghezza permette lo streaming"""
+
+    timeout = ICS_TIMEOUT
+
+    def do_GET(self):
+        name = self.path.split("?", 1)[0]
+        if not (name.startswith("/calendar/") and name.endswith(".ics")):
+            self.send_error(404)
+            return
+        tenant_id = self.server.store.find_tenant_by_ics_token(name[len("/calendar/"):-len(".ics")])
+        if tenant_id is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/calendar; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        for chunk in ics_feed(self.server.store, tenant_id):
+            self.wfile.write(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_ics_server(store, port=ICS_PORT):
+    server = ThreadingHTTPServer(("", port), IcsRequestHandler)
+    server.daemon_threads = True
+    server.store = store
+    threading.Thread(target=server.serve_forever, name="contractme-ics", daemon=True).start()
+    return server
+
+# Con CONTRACTME_ICS_PORT il server Streamlit pubblica anche il feed;
+# in alternativa si esegue come processo separato con `python ContractME.py ics-server`
+@st.cache_resource
+def get_ics_server():
+    # Con più processi Streamlit solo il primo ottiene la porta: gli altri lasciano a lui il feed
+    try:
+        return start_ics_server(get_store(), ICS_PORT)
+    except OSError as e:
+        logger.warning("Feed iCalendar non avviato sulla porta %s: %s", ICS_PORT, e)
+        return None
+
+# Promemoria delle scadenze in background: un min-heap degli istanti di invio,
+# il thread dorme fino al prossimo promemoria invece di interrogare periodicamente l'archivio
+REMINDER_DAYS = [int(d) for d in os.environ.get("CONTRACTME_REMINDER_DAYS", "7,1,0").split(",")]
+REMINDER_HOUR = int(os.environ.get("CONTRACTME_REMINDER_HOUR", "9"))
+REMINDER_RETRY = int(os.environ.get("CONTRACTME_REMINDER_RETRY", "300"))  # secondi prima di ritentare un invio fallito
+NOTIFY_CHANNELS = os.environ.get("CONTRACTME_NOTIFY_CHANNELS", "log").split(",")
+NOTIFY_LOG_PATH = os.environ.get("CONTRACTME_NOTIFY_LOG", os.path.join(DATA_DIR, "notifications.log"))
+SMTP_HOST = os.environ.get("CONTRACTME_SMTP_HOST", "localhost")
+SMTP_PORT = int(os.environ.get("CONTRACTME_SMTP_PORT", "1025"))
+SMTP_FROM = os.environ.get("CONTRACTME_SMTP_FROM", "contractme@localhost")
+WEBHOOK_URL = os.environ.get("CONTRACTME_WEBHOOK_URL")
+
+class LogChannel:
+    """Scrive i promemoria in un file di log, una riga JSON per promemoria"""
+
+    def __init__(self, path=NOTIFY_LOG_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, notification, recipients):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(notification, ensure_ascii=False) + "\n")
+
+class SmtpChannel:
+    """Invia i promemoria via SMTP (in locale, ad es. `python -m aiosmtpd -n -l localhost:1025`)"""
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, sender=SMTP_FROM):
+        self.host = host
+        self.port = port
+        self.sender = sender
+
+    def send(self, notification, recipients):
+        if not recipients:
+            return
+        message = EmailMessage()
+        message["Subject"] = f"ContractME: {notification['title']}"
+        message["From"] = self.sender
+        message["To"] = ", ".join(recipients)
+        message.set_content(notification["message"])
+        with smtplib.SMTP(self.host, self.port, timeout=10) as smtp:
+            smtp.send_message(message)
+
+class WebhookChannel:
+    """Invia i promemoria come JSON in POST a un URL"""
+
+    def __init__(self, url=WEBHOOK_URL):
+        self.url = url
+
+    def send(self, notification, recipients):
+        request = urllib.request.Request(self.url, data=json.dumps(notification).encode(),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(request, timeout=10):
+            pass
+
+# Canali disponibili: per aggiungerne uno basta registrare qui una classe con un metodo send()
+CHANNEL_TYPES = {
+    "log": LogChannel,
+    "smtp": SmtpChannel,
+    "webhook": WebhookChannel
+}
+
+@lru_cache(maxsize=4096)
+def _reminder_schedule(deadline_date):
+    # Molte scadenze cadono nello stesso giorno: il calcolo si fa una volta per data
+    return sorted(
+        (datetime.combine(deadline_date - timedelta(days=days), datetime.min.time()).replace(hour=REMINDER_HOUR).timestamp(),
+         days)
+        for days in REMINDER_DAYS
+    )
+
+def reminder_times(deadline_date, now):
+    """Istanti di invio ancora utili per una scadenza, come coppie (timestamp, giorni di anticipo)"""
+    if deadline_date < now.date():
+        return []
+    times = _reminder_schedule(deadline_date)
+    # Dei promemoria già passati (ad es. durante un riavvio) si recupera solo il più recente
+    now_ts = now.timestamp()
+    past = [t for t in times if t[0] <= now_ts]
+    future = [t for t in times if t[0] > now_ts]
+    return past[-1:] + future
+
+class ReminderScheduler:
+    """Invia i promemoria di scadenze e rinnovi di tutti i tenant da un solo thread"""
+
+    def __init__(self, store, channels, refresh_interval=None):
+        self.store = store
+        self.channels = channels
+        # Necessario solo se altri processi scrivono nell'archivio (scheduler da riga di comando)
+        self.refresh_interval = refresh_interval
+        self.sent = 0
+        self._heap = []  # (timestamp, tenant_id, deadline_id, data ISO, giorni di anticipo)
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._versions = None
+        self._delivery = ThreadPoolExecutor(max_workers=4)
+
+    def _push(self, tenant_id, deadline_id, deadline_date, now):
+        for timestamp, days in reminder_times(deadline_date, now):
+            heapq.heappush(self._heap, (timestamp, tenant_id, deadline_id, deadline_date.isoformat(), days))
+
+    def load(self):
+        """Ricostruisce l'heap dalle scadenze future di tutti i tenant"""
+        now = datetime.now()
+        heap = []
+        with self.store.pool.snapshot() as conn:
+            self._versions = conn.execute("SELECT COALESCE(SUM(version), 0) FROM tenants").fetchone()[0]
+            for row in conn.execute("SELECT tenant_id, id, date FROM deadlines WHERE date >= ?",
+                                    (now.date().isoformat(),)):
+                for timestamp, days in reminder_times(parse_date(row["date"]), now):
+                    heap.append((timestamp, row["tenant_id"], row["id"], row["date"], days))
+        heapq.heapify(heap)
+        with self._condition:
+            self._heap = heap
+            self._condition.notify()
+
+    def schedule(self, tenant_id, deadlines):
+        """Listener dell'archivio: aggiunge le nuove scadenze e sveglia il thread se servono prima"""
+        if deadlines is None:
+            self.load()
+            return
+        now = datetime.now()
+        with self._condition:
+            for deadline in deadlines:
+                self._push(tenant_id, deadline.id, deadline.date, now)
+            self._condition.notify()
+
+    def start(self):
+        self.load()
+        self.store.listeners.append(self.schedule)
+        threading.Thread(target=self.run, name="contractme-reminders", daemon=True).start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _external_changes(self):
+        with self.store.pool.connection() as conn:
+            versions = conn.execute("SELECT COALESCE(SUM(version), 0) FROM tenants").fetchone()[0]
+        return versions != self._versions
+
+    def run(self):
+        last_refresh = time.time()
+        while True:
+            with self._condition:
+                # Attesa fino al prossimo promemoria, o finché una nuova scadenza non sveglia il thread
+                if not self._stopped and not self._heap_due():
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    if self.refresh_interval:
+                        timeout = self.refresh_interval if timeout is None else min(timeout, self.refresh_interval)
+                    self._condition.wait(timeout)
+                if self._stopped:
+                    return
+                due = []
+                while self._heap_due():
+                    due.append(heapq.heappop(self._heap))
+            
+            for entry in due:
+                self._fire(*entry)
+            
+            if self.refresh_interval and time.time() - last_refresh >= self.refresh_interval:
+                last_refresh = time.time()
+                if self._external_changes():
+                    self.load()
+
+    def _heap_due(self):
+        return bool(self._heap) and self._heap[0][0] <= time.time()
+
+    def _fire(self, timestamp, tenant_id, deadline_id, deadline_date, days):
+        with self.store.pool.transaction() as conn:
+            # La scadenza potrebbe essere stata eliminata o spostata dopo l'inserimento nell'heap
+            row = conn.execute("SELECT title, date, description, subscription_id, done_at FROM deadlines "
+                               "WHERE tenant_id = ? AND id = ?", (tenant_id, deadline_id)).fetchone()
+            if row is None or row["date"] != deadline_date or row["done_at"]:
+                return
+            # La riga in reminders_sent garantisce un solo invio anche con più scheduler attivi;
+            # viene tolta se nessun canale riesce a consegnare il promemoria
+            claimed = conn.execute("INSERT OR IGNORE INTO reminders_sent (tenant_id, deadline_id, date, lead_days, sent_at) "
+                                   "VALUES (?, ?, ?, ?, ?)",
+                                   (tenant_id, deadline_id, deadline_date, days, datetime.now().isoformat())).rowcount
+            recipients = [r["username"] for r in conn.execute(
+                "SELECT username FROM users WHERE tenant_id = ? AND username LIKE '%@%'", (tenant_id,))]
+        if not claimed:
+            return
+        
+        days_left = (parse_date(deadline_date) - datetime.now().date()).days
+        when = "oggi" if days_left == 0 else "domani" if days_left == 1 else f"tra {days_left} giorni"
+        notification = {
+            "tenant_id": tenant_id,
+            "deadline_id": deadline_id,
+            "kind": "renewal" if row["subscription_id"] is not None else "deadline",
+            "title": row["title"],
+            "date": deadline_date,
+            "lead_days": days,
+            "message": f"{row['title']}: scadenza {when} ({parse_date(deadline_date).strftime('%d/%m/%Y')}). "
+                       f"{row['description']}".strip()
+        }
+        self._delivery.submit(self._deliver, notification, recipients)
+        self.sent += 1
+
+    def _deliver(self, notification, recipients):
+        delivered = False
+        for channel in self.channels:
+            try:
+                channel.send(notification, recipients)
+                get_metrics().increment(f"reminders_sent.{type(channel).__name__}")
+                delivered = True
+            except Exception as e:
+                get_metrics().increment(f"reminders_failed.{type(channel).__name__}")
+                logger.warning("Invio promemoria fallito (%s): %s", type(channel).__name__, e)
+        if delivered or not self.channels:
+            return
+        
+        # Nessun canale ha consegnato: il promemoria torna disponibile e viene ritentato più tardi,
+        # da questo scheduler o da un altro, finché la scadenza non è passata
+        tenant_id, deadline_id = notification["tenant_id"], notification["deadline_id"]
+        deadline_date, days = notification["date"], notification["lead_days"]
+        with self.store.pool.transaction() as conn:
+            conn.execute("DELETE FROM reminders_sent WHERE tenant_id = ? AND deadline_id = ? AND date = ? AND lead_days = ?",
+                         (tenant_id, deadline_id, deadline_date, days))
+        if parse_date(deadline_date) >= datetime.now().date():
+            with self._condition:
+                heapq.heappush(self._heap, (time.time() + REMINDER_RETRY, tenant_id, deadline_id, deadline_date, days))
+                self._condition.notify()
+
+def build_channels(names=NOTIFY_CHANNELS):
+    return [CHANNEL_TYPES[name.strip()]() for name in names if name.strip()]
+
+# Con CONTRACTME_SCHEDULER=thread il server Streamlit avvia lo scheduler al primo accesso;
+# in alternativa si esegue come processo separato con `python ContractME.py scheduler`
+@st.cache_resource
+def get_scheduler():
+    return ReminderScheduler(get_store(), build_channels()).start()
+
+# Cache condivisa tra le sessioni per i dati derivati (aggregati, ordinamenti, frammenti HTML)
+CACHE_MAX_BYTES = int(os.environ.get("CONTRACTME_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_BACKEND = os.environ.get("CONTRACTME_CACHE_BACKEND", "memory")
+CACHE_DISK_PATH = os.path.join(DATA_DIR, "cache.db")
+CACHE_DISK_MAX_BYTES = int(os.environ.get("CONTRACTME_CACHE_DISK_MAX_BYTES", str(256 * 1024 * 1024)))
+
+class MemoryCache:
+    """Cache LRU in memoria limitata in byte, condivisa da tutte le sessioni del processo"""
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # chiave -> (tenant_id, valore, dimensione)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, tenant_id, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self._entries[key] = (tenant_id, value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, tenant_id):
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if entry[0] == tenant_id]:
+                self.size -= self._entries.pop(key)[2]
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.size, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+class DiskCache:
+    """Cache su disco (SQLite) condivisa da più processi server sulla stessa macchina"""
+
+    def __init__(self, path=CACHE_DISK_PATH, max_bytes=CACHE_DISK_MAX_BYTES):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pool = ConnectionPool(path)
+        with self.pool.connection() as conn:
+            conn.executescript("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                tenant_id INTEGER NOT NULL,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_cache_tenant ON cache(tenant_id);
+            CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache(accessed);
+            -- Byte totali delle voci, aggiornati a ogni scrittura: il limite si controlla senza sommare la tabella
+            CREATE TABLE IF NOT EXISTS cache_total (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                size INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO cache_total (id, size) SELECT 1, COALESCE(SUM(size), 0) FROM cache;
+            """)
+
+    def get(self, key):
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT tenant_id, value, size FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        return row["tenant_id"], pickle.loads(row["value"]), row["size"]
+
+    def set(self, tenant_id, key, payload, size):
+        if size > self.max_bytes:
+            return
+        with self.pool.transaction() as conn:
+            old = conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            conn.execute("INSERT OR REPLACE INTO cache (key, tenant_id, value, size, accessed) VALUES (?, ?, ?, ?, ?)",
+                         (key, tenant_id, payload, size, time.time()))
+            conn.execute("UPDATE cache_total SET size = size + ? WHERE id = 1", (size - (old["size"] if old else 0),))
+            total = conn.execute("SELECT size FROM cache_total WHERE id = 1").fetchone()[0]
+            # Eliminazione delle voci usate meno di recente fino a rientrare nel limite
+            evicted = 0
+            while total > self.max_bytes:
+                row = conn.execute("SELECT key, size FROM cache ORDER BY accessed LIMIT 1").fetchone()
+                conn.execute("DELETE FROM cache WHERE key = ?", (row["key"],))
+                total -= row["size"]
+                evicted += 1
+            if evicted:
+                conn.execute("UPDATE cache_total SET size = ? WHERE id = 1", (total,))
+                self.evictions += evicted
+
+    def invalidate(self, tenant_id):
+        with self.pool.transaction() as conn:
+            size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache WHERE tenant_id = ?", (tenant_id,)).fetchone()[0]
+            conn.execute("DELETE FROM cache WHERE tenant_id = ?", (tenant_id,))
+            conn.execute("UPDATE cache_total SET size = size - ? WHERE id = 1", (size,))
+
+    def stats(self):
+        with self.pool.connection() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            size = conn.execute("SELECT size FROM cache_total WHERE id = 1").fetchone()[0]
+        return {"entries": entries, "bytes": size, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+class DerivedDataCache:
+    """Cache a due livelli: memoria del processo e, opzionalmente, disco condiviso"""
+
+    def __init__(self, backend=CACHE_BACKEND):
+        self.memory = MemoryCache()
+        self.disk = DiskCache() if backend == "disk" else None
+
+    def get_or_compute(self, tenant_id, key, compute):
+        entry = self.memory.get(key)
+        if entry is not None:
+            return entry[1]
+        
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.memory.set(tenant_id, key, entry[1], cache_size(entry[1]))
+                return entry[1]
+        
+        value = compute()
+        self.memory.set(tenant_id, key, value, cache_size(value))
+        # La serializzazione serve solo alla cache su disco
+        if self.disk is not None:
+            payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            self.disk.set(tenant_id, key, payload, len(payload))
+        return value
+
+    def invalidate(self, tenant_id):
+        self.memory.invalidate(tenant_id)
+        if self.disk is not None:
+            self.disk.invalidate(tenant_id)
+
+    def stats(self):
+        stats = {"memory": self.memory.stats()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
+
+def cache_size(value):
+    """Byte in memoria di un valore in cache: i DataFrame si misurano con pandas, il resto con estimate_size"""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(index=True, deep=True)))
+    return estimate_size(value, set())
+
+@st.cache_resource
+def get_cache():
+    return DerivedDataCache()
+
+def cached(name, params, compute):
+    """Restituisce un dato derivato del tenant corrente, calcolandolo solo se non è in cache"""
+    # La versione dei dati fa parte della chiave: una scrittura da un altro processo
+    # rende automaticamente obsolete le voci precedenti
+    tenant_id = current_tenant_id()
+    key = f"{tenant_id}:{st.session_state.data_version}:{name}:{params!r}"
+    return get_cache().get_or_compute(tenant_id, key, compute)
+
+def cached_order(name, params, records, select):
+    """Record della sessione scelti e ordinati da select, con l'ordine condiviso in cache come tupla di id"""
+    # In cache non vanno i record: sono modificati sul posto e ogni sessione ha i propri
+    ids = cached(name, params, lambda: tuple(record.id for record in select(records)))
+    by_id = {record.id: record for record in records}
+    return [by_id[record_id] for record_id in ids if record_id in by_id]
+
+# Strumentazione: tempi delle pagine e dei passaggi interni, contatori ed esportazione
+METRICS_FILE = os.environ.get("CONTRACTME_METRICS_FILE")
+METRICS_FILE_INTERVAL = 10  # secondi tra due scritture del file di metriche
+PROFILE_RERUNS = os.environ.get("CONTRACTME_PROFILE") == "1"
+
+class Metrics:
+    """Registro delle metriche del processo, condiviso da tutte le sessioni"""
+
+    def __init__(self, samples=1024):
+        self.samples = samples
+        self.timers = {}    # nome -> {"count", "total", "max", "recent"}
+        self.counters = {}  # nome -> valore
+        self.sources = {}   # nome -> risorsa con stats(), registrata quando viene creata
+        self.last_export = 0.0
+        self._lock = threading.Lock()
+
+    def register(self, name, source):
+        # Le esportazioni leggono solo le risorse già create, senza avviarle come effetto collaterale
+        with self._lock:
+            self.sources[name] = source
+
+    def source_stats(self):
+        with self._lock:
+            sources = list(self.sources.items())
+        return {name: source.stats() for name, source in sources}
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = {"count": 0, "total": 0.0, "max": 0.0,
+                                             "recent": deque(maxlen=self.samples)}
+            timer["count"] += 1
+            timer["total"] += seconds
+            timer["max"] = max(timer["max"], seconds)
+            timer["recent"].append(seconds)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            timers = {}
+            for name, timer in self.timers.items():
+                recent = sorted(timer["recent"])
+                timers[name] = {
+                    "count": timer["count"],
+                    "total_ms": timer["total"] * 1000,
+                    "max_ms": timer["max"] * 1000,
+                    "p50_ms": percentile(recent, 50) * 1000,
+                    "p95_ms": percentile(recent, 95) * 1000,
+                    "p99_ms": percentile(recent, 99) * 1000
+                }
+            return {"timers": timers, "counters": dict(self.counters)}
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+@st.cache_resource
+def get_metrics():
+    return Metrics()
+
+@contextmanager
+def timed(name):
+    """Misura la durata di un blocco e la registra nelle metriche e nella traccia della rerun"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        get_metrics().observe(name, elapsed)
+        if "rerun_trace" in st.session_state:
+            st.session_state.rerun_trace.append((name, elapsed * 1000))
+
+def count(name, value=1):
+    get_metrics().increment(name, value)
+
+def send_html(markup):
+    """Invia un frammento HTML al browser contando i byte trasmessi"""
+    count("html_bytes_sent", len(markup.encode()))
+    st.markdown(markup, unsafe_allow_html=True)
+
+def metrics_json():
+    metrics = get_metrics()
+    data = metrics.snapshot()
+    data["cache"] = get_cache().stats()
+    data["sessions"] = get_sessions().stats()
+    data.update(metrics.source_stats())
+    return json.dumps(data, indent=2)
+
+def metrics_prometheus():
+    """Metriche nel formato testuale di Prometheus"""
+    metrics = get_metrics()
+    data = metrics.snapshot()
+    sources = metrics.source_stats()
+    lines = [
+        "# TYPE contractme_timer_seconds summary",
+    ]
+    for name, timer in sorted(data["timers"].items()):
+        for quantile, key in [("0.5", "p50_ms"), ("0.95", "p95_ms"), ("0.99", "p99_ms")]:
+            lines.append(f'contractme_timer_seconds{{name="{name}",quantile="{quantile}"}} {timer[key] / 1000:.6f}')
+        lines.append(f'contractme_timer_seconds_sum{{name="{name}"}} {timer["total_ms"] / 1000:.6f}')
+        lines.append(f'contractme_timer_seconds_count{{name="{name}"}} {timer["count"]}')
+    lines.append("# TYPE contractme_counter_total counter")
+    for name, value in sorted(data["counters"].items()):
+        lines.append(f'contractme_counter_total{{name="{name}"}} {value}')
+    lines.append("# TYPE contractme_cache gauge")
+    for tier, stats in get_cache().stats().items():
+        for key, value in stats.items():
+            lines.append(f'contractme_cache{{tier="{tier}",stat="{key}"}} {value}')
+    sessions = get_sessions().stats()
+    lines.append("# TYPE contractme_sessions gauge")
+    for key in ["sessions", "evicted", "evictions", "bytes"]:
+        lines.append(f'contractme_sessions{{stat="{key}"}} {sessions[key]}')
+    lines.append("# TYPE contractme_session_memory_bytes gauge")
+    for key, value in sessions["keys"].items():
+        lines.append(f'contractme_session_memory_bytes{{key="{key}"}} {value}')
+    # OCR e ricerca compaiono dopo il primo uso nel processo
+    for name, stats in sorted(sources.items()):
+        lines.append(f"# TYPE contractme_{name} gauge")
+        for key, value in stats.items():
+            lines.append(f'contractme_{name}{{stat="{key}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+def export_metrics_file():
+    # Scrittura atomica per il textfile collector di Prometheus (al massimo ogni METRICS_FILE_INTERVAL secondi)
+    metrics = get_metrics()
+    if not METRICS_FILE or time.time() - metrics.last_export < METRICS_FILE_INTERVAL:
+        return
+    metrics.last_export = time.time()
+    tmp_path = f"{METRICS_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(metrics_prometheus())
+    os.replace(tmp_path, METRICS_FILE)
+
+def run_page(page, render):
+    """Esegue una pagina misurandone il tempo e, se richiesto, profilandola"""
+    if st.session_state.get("profile_reruns", PROFILE_RERUNS):
+        profiler = cProfile.Profile()
+        with timed(f"page.{page}"):
+            profiler.runcall(render)
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(30)
+        st.session_state.last_profile = output.getvalue()
+    else:
+        with timed(f"page.{page}"):
+            render()
+
+# Memoria delle sessioni: ogni sessione misura periodicamente le sue chiavi di stato; i messaggi della chat
+# oltre SESSION_CHAT_TURNS vanno su disco e le sessioni inattive da SESSION_IDLE_SECONDS vengono segnate:
+# all'inizio della loro rerun successiva liberano i dati del tenant (ricaricati dall'archivio) e spostano
+# su disco la chat. Lo stato di una sessione viene modificato solo dalle sue rerun, mai da un altro thread
+SESSION_CHAT_TURNS = int(os.environ.get("CONTRACTME_SESSION_CHAT_TURNS", "40"))
+SESSION_IDLE_SECONDS = int(os.environ.get("CONTRACTME_SESSION_IDLE_SECONDS", "900"))
+SESSION_MEASURE_INTERVAL = 30  # secondi tra due misure della stessa sessione
+SESSION_SWEEP_INTERVAL = 60    # secondi tra due controlli delle sessioni inattive
+SESSION_SPILL_DIR = os.path.join(DATA_DIR, "sessions")
+
+# Dati del tenant che una sessione inattiva può liberare: sync_session_state li ricarica
+SESSION_TENANT_KEYS = ["documents", "deadlines", "subscriptions", "categories", "category_index", "duplicate_index"]
+
+SIZE_SAMPLE = 256  # elementi misurati delle collezioni più grandi
+
+def estimate_size(value, seen):
+    """Byte occupati da un valore e dagli oggetti che contiene; gli oggetti in seen sono già stati contati"""
+    if id(value) in seen or isinstance(value, (type, types.ModuleType, types.FunctionType, types.MethodType)):
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, (str, bytes, int, float, date, np.ndarray)) or value is None:
+        return size
+    if isinstance(value, dict):
+        children = [*value.keys(), *value.values()]
+    elif isinstance(value, (list, tuple, set, frozenset, deque)):
+        children = list(value)
+    else:
+        # I record dei modelli usano __slots__, le altre classi __dict__
+        children = [getattr(value, name) for name in getattr(type(value), "__slots__", ()) if hasattr(value, name)]
+        if hasattr(value, "__dict__"):
+            children.append(vars(value))
+    if len(children) <= SIZE_SAMPLE:
+        return size + sum(estimate_size(child, seen) for child in children)
+    # Le collezioni grandi si stimano da un campione a passo fisso: la misura resta di pochi millisecondi
+    step = len(children) / SIZE_SAMPLE
+    sample = sum(estimate_size(children[int(i * step)], seen) for i in range(SIZE_SAMPLE))
+    # Gli elementi non misurati sono comunque compresi nella stima
+    seen.update(map(id, children))
+    return size + sample * len(children) // SIZE_SAMPLE
+
+class SessionRegistry:
+    """Sessioni del processo: memoria per chiave, ultima attività e rilascio dello stato di quelle inattive"""
+
+    def __init__(self, idle_seconds=SESSION_IDLE_SECONDS, spill_dir=SESSION_SPILL_DIR):
+        self.idle_seconds = idle_seconds
+        self.spill_dir = spill_dir
+        self.evictions = 0
+        self._sessions = {}  # id della sessione -> stato, lock, ultima attività, dimensioni per chiave
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+    def _entry(self, session_id):
+        with self._lock:
+            return self._sessions.setdefault(session_id, {"lock": threading.RLock(), "last_seen": 0,
+                                                          "measured": 0, "sizes": {}, "evict": False})
+
+    @contextmanager
+    def active(self, session_id, state):
+        """Una rerun della sessione: intanto la sessione non può essere segnata come inattiva.
+        Se lo era, libera per prima cosa il proprio stato e restituisce True"""
+        entry = self._entry(session_id)
+        with entry["lock"]:
+            evicted = entry["evict"]
+            if evicted:
+                self._evict(session_id, entry, state)
+            entry["last_seen"] = time.time()
+            try:
+                yield evicted
+            finally:
+                entry["last_seen"] = time.time()
+        if time.time() - self._last_sweep >= SESSION_SWEEP_INTERVAL:
+            self.sweep(exclude=session_id)
+
+    def measure(self, session_id, values, force=False):
+        entry = self._entry(session_id)
+        if not force and time.time() - entry["measured"] < SESSION_MEASURE_INTERVAL:
+            return entry["sizes"]
+        # Gli oggetti condivisi tra più chiavi (i documenti nell'indice delle categorie) contano una volta sola
+        seen = set()
+        entry["sizes"] = {key: estimate_size(value, seen) for key, value in values.items()}
+        entry["measured"] = time.time()
+        return entry["sizes"]
+
+    def spill_path(self, session_id):
+        return os.path.join(self.spill_dir, f"{session_id}.jsonl")
+
+    def sweep(self, exclude=None):
+        """Segna le sessioni inattive (tranne exclude, quella che sta eseguendo) e dimentica quelle chiuse"""
+        self._last_sweep = now = time.time()
+        with self._lock:
+            sessions = [(session_id, entry) for session_id, entry in self._sessions.items() if session_id != exclude]
+        for session_id, entry in sessions:
+            if st.runtime.exists() and not st.runtime.get_instance().is_active_session(session_id):
+                with self._lock:
+                    self._sessions.pop(session_id, None)
+                if os.path.exists(self.spill_path(session_id)):
+                    os.remove(self.spill_path(session_id))
+                continue
+            if entry["evict"] or now - entry["last_seen"] < self.idle_seconds:
+                continue
+            # Una sessione con una rerun in corso non è inattiva: la si salta
+            if entry["lock"].acquire(blocking=False):
+                try:
+                    entry["evict"] = True
+                finally:
+                    entry["lock"].release()
+
+    def _evict(self, session_id, entry, state):
+        # Eseguito dalla rerun della sessione stessa, prima che legga il proprio stato
+        if "chat_history" in state and state["chat_history"]:
+            spill_chat(self.spill_path(session_id), state, len(state["chat_history"]))
+        for key in SESSION_TENANT_KEYS:
+            if key in state:
+                del state[key]
+        state["data_version"] = None
+        entry.update(evict=False, sizes={}, measured=0)
+        self.evictions += 1
+        get_metrics().increment("session.evictions")
+
+    def stats(self):
+        with self._lock:
+            entries = list(self._sessions.values())
+        keys = {}
+        for entry in entries:
+            for key, size in entry["sizes"].items():
+                keys[key] = keys.get(key, 0) + size
+        largest = dict(sorted(keys.items(), key=lambda item: -item[1])[:15])
+        return {"sessions": len(entries), "evicted": sum(entry["evict"] for entry in entries),
+                "evictions": self.evictions, "bytes": sum(keys.values()), "keys": largest}
+
+@st.cache_resource
+def get_sessions():
+    return SessionRegistry()
+
+@contextmanager
+def session_activity():
+    """Registra la rerun della sessione corrente; restituisce se la sessione era stata liberata"""
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        yield False
+        return
+    with get_sessions().active(ctx.session_id, ctx.session_state) as evicted:
+        yield evicted
+
+def account_session_memory(force=False):
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return {}
+    with timed("session.measure"):
+        return get_sessions().measure(ctx.session_id, st.session_state.to_dict(), force)
+
+# Chat della sessione: i messaggi più vecchi vengono aggiunti a un file JSON Lines della sessione
+def spill_chat(path, state, count):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    chat = state["chat_history"]
+    with open(path, "a", encoding="utf-8") as f:
+        f.writelines(json.dumps(message, ensure_ascii=False) + "\n" for message in chat[:count])
+    state["chat_history"] = chat[count:]
+    state["chat_archived"] = state["chat_archived"] + count if "chat_archived" in state else count
+
+def append_chat(message):
+    st.session_state.chat_history.append(message)
+    if len(st.session_state.chat_history) > SESSION_CHAT_TURNS:
+        # A metà soglia, per non scrivere sul file a ogni messaggio
+        ctx = get_script_run_ctx()
+        spill_chat(get_sessions().spill_path(ctx.session_id), st.session_state,
+                   len(st.session_state.chat_history) - SESSION_CHAT_TURNS // 2)
+
+def archived_chat():
+    path = get_sessions().spill_path(get_script_run_ctx().session_id)
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def clear_chat():
+    path = get_sessions().spill_path(get_script_run_ctx().session_id)
+    if os.path.exists(path):
+        os.remove(path)
+    st.session_state.chat_history = []
+    st.session_state.chat_archived = 0
+
+def document_preview(doc):
+    """Anteprima di un documento: quelle grandi non stanno nella sessione ma nella cache condivisa"""
+    if doc.preview is not None:
+        return doc.preview
+    return cached("document_preview", doc.id, lambda: get_store().document_preview(current_tenant_id(), doc.id))
+
+# Rerun parziali: un'interazione dentro un frammento riesegue solo il frammento,
+# non il CSS, la sidebar e il resto della pagina
+def fragment(name):
+    """Come st.fragment, con il tempo di ogni esecuzione registrato come fragment.<name>"""
+    def decorate(render):
+        @wraps(render)
+        def timed_render(*args, **kwargs):
+            with session_activity() as evicted, timed(f"fragment.{name}"):
+                # La sessione liberata mentre era inattiva ricarica i dati del tenant prima del frammento
+                if evicted:
+                    init_session_state()
+                    sync_session_state()
+                return render(*args, **kwargs)
+        return st.fragment(timed_render)
+    return decorate
+
+def rerun_fragment(partial=True):
+    """Riesegue solo il frammento corrente se è in corso una sua rerun parziale, altrimenti tutta l'app"""
+    # Durante una rerun completa Streamlit non ammette scope="fragment"
+    ctx = get_script_run_ctx()
+    st.rerun(scope="fragment" if partial and ctx and ctx.fragment_ids_this_run else "app")
+
+def admin_panel():
+    """Pannello nascosto delle prestazioni, visibile aprendo l'app con ?admin=1"""
+    st.markdown("---")
+    st.markdown("<h2>Prestazioni</h2>", unsafe_allow_html=True)
+    
+    st.session_state.profile_reruns = st.checkbox("Profila ogni rerun con cProfile",
+                                                  value=st.session_state.get("profile_reruns", PROFILE_RERUNS))
+    
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        st.markdown("<h3>Ultima rerun</h3>", unsafe_allow_html=True)
+        trace = st.session_state.get("last_rerun_trace", [])
+        if trace:
+            st.dataframe(pd.DataFrame(trace, columns=["Passaggio", "ms"]), width="stretch")
+        else:
+            st.info("Nessuna misura disponibile.")
+    
+    with col2:
+        st.markdown("<h3>Cache</h3>", unsafe_allow_html=True)
+        st.json(get_cache().stats())
+    
+    snapshot = get_metrics().snapshot()
+    st.markdown("<h3>Tempi del processo</h3>", unsafe_allow_html=True)
+    if snapshot["timers"]:
+        st.dataframe(pd.DataFrame.from_dict(snapshot["timers"], orient="index").round(2), width="stretch")
+    st.markdown("<h3>Contatori</h3>", unsafe_allow_html=True)
+    st.json(snapshot["counters"])
+    
+    st.markdown("<h3>OCR</h3>", unsafe_allow_html=True)
+    if OCR_ENABLED and (ocr.available("image") or ocr.available("pdf")):
+        st.json(get_ocr_queue().stats())
+        if st.button("Estrai il testo dei documenti già caricati"):
+            queued = get_ocr_queue().reindex(current_tenant_id())
+            st.success(f"{queued} documenti in coda per l'OCR.")
+    else:
+        st.info("OCR non disponibile: servono pytesseract e Tesseract (e PyMuPDF per i PDF).")
+    
+    st.markdown("<h3>Memoria delle sessioni</h3>", unsafe_allow_html=True)
+    col1, col2 = st.columns(2)
+    with col1:
+        sizes = account_session_memory(force=True)
+        st.dataframe(pd.DataFrame(sorted(sizes.items(), key=lambda item: -item[1])[:20],
+                                  columns=["Chiave", "Byte"]), width="stretch", hide_index=True)
+    with col2:
+        st.json(get_sessions().stats())
+    
+    st.markdown("<h3>Registro delle modifiche</h3>", unsafe_allow_html=True)
+    store = get_store()
+    st.json(store.event_log_stats(current_tenant_id()))
+    events = store.recent_events(current_tenant_id())
+    if events:
+        st.dataframe(pd.DataFrame(events).rename(columns={"at": "Istante (UTC)", "tbl": "Tabella", "op": "Operazione",
+                                                          "key": "Chiave", "row": "Valori"}),
+                     width="stretch", hide_index=True)
+    if st.button("Verifica il registro"):
+        differences = verify_event_log(store, current_tenant_id())
+        if differences:
+            st.error(f"{len(differences)} righe differiscono dai dati ricostruiti dal registro: {differences[:10]}")
+        else:
+            st.success("I dati ricostruiti dal registro coincidono con quelli attuali.")
+    
+    if st.session_state.get("last_profile"):
+        with st.expander("Profilo cProfile dell'ultima rerun"):
+            st.code(st.session_state.last_profile)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button("Esporta JSON", metrics_json(), file_name="contractme_metrics.json",
+                           mime="application/json")
+    with col2:
+        st.download_button("Esporta Prometheus", metrics_prometheus(), file_name="contractme_metrics.prom",
+                           mime="text/plain")
+
+# Analisi dei costi degli abbonamenti su colonne NumPy
+SUBSCRIPTION_TYPES = ["Streaming", "Servizi", "Utility", "Palestra", "Software", "Altro"]
+
+class SubscriptionCosts:
+    """Abbonamenti di un tenant in forma colonnare, con proiezioni di spesa vettoriali"""
+
+    def __init__(self, subscriptions):
+        self.names = np.array([sub.name for sub in subscriptions], dtype=object)
+        self.costs = np.array([sub.cost for sub in subscriptions], dtype=np.float64)
+        self.renewals = np.array([sub.renewal_date for sub in subscriptions], dtype="datetime64[D]")
+        self.types, self.type_codes = np.unique(np.array([sub.type for sub in subscriptions], dtype=object),
+                                                return_inverse=True)
+
+    def __len__(self):
+        return len(self.costs)
+
+    @property
+    def monthly_total(self):
+        return float(self.costs.sum())
+
+    @property
+    def annual_total(self):
+        return self.monthly_total * 12
+
+    def totals_by_type(self):
+        totals = np.bincount(self.type_codes, weights=self.costs, minlength=len(self.types))
+        return pd.Series(totals, index=self.types, name="Costo mensile").sort_values(ascending=False)
+
+    def payment_dates(self, start, end):
+        """Date dei pagamenti mensili tra start ed end: matrice (abbonamenti x mesi) e maschera di validità"""
+        start = np.datetime64(start, "D")
+        end = np.datetime64(end, "D")
+        renewal_months = self.renewals.astype("datetime64[M]")
+        day_offsets = (self.renewals - renewal_months.astype("datetime64[D]")).astype(np.int64)
+        
+        # Si parte dal mese del rinnovo o, se è lontano nel passato, dal mese precedente a start
+        first = np.maximum(renewal_months, start.astype("datetime64[M]") - np.timedelta64(1, "M"))
+        months_span = int((end.astype("datetime64[M]") - start.astype("datetime64[M]")).astype(np.int64)) + 2
+        months = first[:, None] + np.arange(months_span)[None, :]
+        month_starts = months.astype("datetime64[D]")
+        month_lengths = ((months + np.timedelta64(1, "M")).astype("datetime64[D]") - month_starts).astype(np.int64)
+        
+        # Il rinnovo del 31 cade sull'ultimo giorno nei mesi più corti
+        dates = month_starts + np.minimum(day_offsets[:, None], month_lengths - 1)
+        valid = (dates >= start) & (dates <= end) & (dates >= self.renewals[:, None])
+        return dates, valid
+
+    def spend_between(self, start, end):
+        if not len(self):
+            return 0.0
+        _, valid = self.payment_dates(start, end)
+        return float((valid.sum(axis=1) * self.costs).sum())
+
+    def renewals_within(self, today, days):
+        """Spesa dei rinnovi nei prossimi `days` giorni"""
+        return self.spend_between(today, today + timedelta(days=days))
+
+    def monthly_series(self, today, months=12):
+        """Spesa prevista per ciascuno dei prossimi mesi"""
+        start = np.datetime64(today, "M")
+        index = start + np.arange(months)
+        if not len(self):
+            return pd.Series(np.zeros(months), index=index.astype("datetime64[D]"), name="Spesa")
+        end = (start + np.timedelta64(months, "M")).astype("datetime64[D]") - np.timedelta64(1, "D")
+        dates, valid = self.payment_dates(today, end)
+        month_index = (dates.astype("datetime64[M]") - start).astype(np.int64)
+        totals = np.zeros(months)
+        np.add.at(totals, month_index[valid], np.broadcast_to(self.costs[:, None], dates.shape)[valid])
+        return pd.Series(totals, index=index.astype("datetime64[D]"), name="Spesa")
+
+# Inizializzazione dello stato della sessione
+def init_session_state():
+    if 'user' not in st.session_state:
+        st.session_state.user = None
+
+    if 'data_version' not in st.session_state:
+        st.session_state.data_version = None
+
+    if 'documents' not in st.session_state:
+        st.session_state.documents = []
+    
+    if 'deadlines' not in st.session_state:
+        st.session_state.deadlines = []
+    
+    if 'subscriptions' not in st.session_state:
+        st.session_state.subscriptions = []
+    
+    if 'chat_history' not in st.session_state:
+        st.session_state.chat_history = []
+    
+    if 'chat_archived' not in st.session_state:
+        st.session_state.chat_archived = 0
+
+    if 'categories' not in st.session_state:
+        st.session_state.categories = CategoryTaxonomy((name, None) for name in DEFAULT_CATEGORIES)
+    
+    if 'category_index' not in st.session_state:
+        st.session_state.category_index = CategoryIndex()
+    
+    if 'duplicate_index' not in st.session_state:
+        st.session_state.duplicate_index = None
+
+def current_tenant_id():
+    return st.session_state.user["tenant_id"]
+
+# Sincronizzazione della sessione con l'archivio del tenant
+def sync_session_state(force=False):
+    store = get_store()
+    tenant_id = current_tenant_id()
+    
+    # Al primo accesso del giorno gli stati vengono riclassificati in blocco
+    store.roll_statuses(tenant_id, datetime.now().date())
+    
+    # Controllo economico: si ricarica solo se un'altra sessione o un altro processo ha scritto
+    if not force and st.session_state.data_version == store.tenant_version(tenant_id):
+        return
+    
+    data = store.load_tenant(tenant_id)
+    st.session_state.documents = data["documents"]
+    st.session_state.deadlines = data["deadlines"]
+    st.session_state.subscriptions = data["subscriptions"]
+    st.session_state.categories = CategoryTaxonomy(data["categories"])
+    st.session_state.category_index = CategoryIndex(data["documents"], data["deadlines"])
+    # L'indice dei quasi duplicati serve solo ai caricamenti: viene ricostruito quando serve
+    st.session_state.duplicate_index = None
+    st.session_state.data_version = data["version"]
+
+def apply_write(version, update):
+    """Applica alla sessione una scrittura appena salvata; False se è stato ricaricato tutto il tenant"""
+    # Se nessun altro ha scritto nel frattempo basta aggiornare la copia locale,
+    # altrimenti si ricarica tutto il tenant
+    applied = version == st.session_state.data_version + 1
+    if applied:
+        update()
+        st.session_state.data_version = version
+    else:
+        sync_session_state(force=True)
+    
+    # Invalidazione esplicita dei dati derivati del tenant in tutte le sessioni
+    get_cache().invalidate(current_tenant_id())
+    return applied
+
+# Accesso e registrazione
+def login_page():
+    send_html("<h1>📄 ContractME</h1>")
+    
+    tab1, tab2 = st.tabs(["Accedi", "Crea spazio di lavoro"])
+    
+    with tab1:
+        username = st.text_input("Nome utente", key="login_username")
+        password = st.text_input("Password", type="password", key="login_password")
+        
+        if st.button("Accedi"):
+            user = get_store().authenticate(username, password)
+            if user:
+                st.session_state.user = user
+                st.session_state.data_version = None
+                st.rerun()
+            else:
+                st.error("Nome utente o password non validi.")
+    
+    with tab2:
+        tenant_name = st.text_input("Nome dello spazio di lavoro (es. famiglia o team)")
+        new_username = st.text_input("Nome utente", key="register_username")
+        new_password = st.text_input("Password", type="password", key="register_password")
+        
+        if st.button("Crea spazio di lavoro"):
+            if tenant_name and new_username and new_password:
+                try:
+                    st.session_state.user = get_store().create_tenant(tenant_name, new_username, new_password)
+                    st.session_state.data_version = None
+                    st.rerun()
+                except ValueError as e:
+                    st.error(str(e))
+            else:
+                st.error("Tutti i campi sono obbligatori!")
+
+def logout():
+    clear_chat()
+    for key in ["user", "data_version", "documents", "deadlines", "subscriptions", "chat_history", "chat_archived",
+                "categories", "category_index"]:
+        st.session_state.pop(key, None)
+
+def account_panel():
+    user = st.session_state.user
+    st.markdown(f"👤 **{user['username']}** · {user['tenant_name']}")
+    
+    if user["role"] == "owner":
+        with st.expander("Membri del team"):
+            for member in get_store().list_users(user["tenant_id"]):
+                st.markdown(f"- {member['username']} ({member['role']})")
+            
+            member_username = st.text_input("Nuovo membro", key="member_username")
+            member_password = st.text_input("Password iniziale", type="password", key="member_password")
+            
+            if st.button("Aggiungi membro"):
+                if member_username and member_password:
+                    try:
+                        get_store().add_user(user["tenant_id"], member_username, member_password)
+                        st.success(f"Utente '{member_username}' aggiunto!")
+                    except ValueError as e:
+                        st.error(str(e))
+                else:
+                    st.error("Nome utente e password sono obbligatori!")
+    
+        backup_panel()
+    
+    category_panel()
+    
+    if st.button("Esci"):
+        logout()
+        st.rerun()
+
+def backup_panel():
+    # Per archivi molto grandi conviene la riga di comando: python ContractME.py export/import
+    with st.expander("Backup e migrazione"):
+        if st.button("Prepara archivio"):
+            export_path = os.path.join(DATA_DIR, f"export_{current_tenant_id()}.tar")
+            with open(export_path, "wb") as f:
+                export_tenant(get_store(), current_tenant_id(), f)
+            st.session_state.export_path = export_path
+        
+        if st.session_state.get("export_path") and os.path.exists(st.session_state.export_path):
+            with open(st.session_state.export_path, "rb") as f:
+                st.download_button("Scarica archivio", f, file_name="contractme_backup.tar",
+                                   mime="application/x-tar")
+        
+        archive = st.file_uploader("Importa archivio", type=["tar"])
+        if archive is not None and st.button("Importa"):
+            try:
+                counts = import_tenant(get_store(), current_tenant_id(), archive)
+            except (tarfile.TarError, ValueError, KeyError) as e:
+                st.error(f"Archivio non valido: {e}")
+            else:
+                sync_session_state(force=True)
+                get_cache().invalidate(current_tenant_id())
+                st.success(f"Importati {counts.get('documents', 0)} documenti, {counts.get('deadlines', 0)} scadenze "
+                           f"e {counts.get('subscriptions', 0)} abbonamenti.")
+
+# Tassonomia delle categorie
+def category_selectbox(label, include_all=False, key=None):
+    """Selettore delle categorie in ordine di albero, con il percorso completo di ogni categoria"""
+    taxonomy = st.session_state.categories
+    options = (["Tutti"] if include_all else []) + list(taxonomy)
+    return st.selectbox(label, options, key=key,
+                        format_func=lambda name: name if name == "Tutti" else taxonomy.path(name))
+
+def category_panel():
+    with st.expander("Categorie"):
+        taxonomy = st.session_state.categories
+        counts = st.session_state.category_index.document_counts()
+        for name in taxonomy:
+            st.markdown(f"- {taxonomy.path(name)} ({counts.get(name, 0)})")
+        
+        category = category_selectbox("Categoria", key="taxonomy_category")
+        parent = st.selectbox("Categoria superiore", ["Nessuna"] + list(taxonomy), key="taxonomy_parent",
+                              format_func=lambda name: name if name == "Nessuna" else taxonomy.path(name))
+        if st.button("Sposta"):
+            parent = None if parent == "Nessuna" else parent
+            try:
+                version = get_store().move_category(current_tenant_id(), category, parent)
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                apply_write(version, lambda: taxonomy.move(category, parent))
+                st.rerun()
+        
+        new_name = st.text_input("Nuovo nome (se esiste già, le categorie vengono unite)", key="taxonomy_name")
+        if st.button("Rinomina") and new_name and new_name != category:
+            try:
+                version = get_store().rename_category(current_tenant_id(), category, new_name)
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                def update():
+                    taxonomy.rename(category, new_name)
+                    st.session_state.category_index.rename(category, new_name)
+                
+                apply_write(version, update)
+                st.rerun()
+
+# Operazioni in blocco su documenti, scadenze e abbonamenti: una sola scrittura e una sola rerun
+BULK_ACTIONS = {
+    "documents": ["Elimina", "Cambia categoria", "Sposta la scadenza"],
+    "deadlines": ["Elimina", "Cambia categoria", "Segna come completate", "Segna come da fare", "Sposta la data"],
+    "subscriptions": ["Elimina", "Cambia tipo", "Sposta il rinnovo"]
+}
+
+# Colonna delle scadenze che le collega alle voci di ogni tabella
+BULK_LINKS = {"documents": "document_id", "deadlines": "id", "subscriptions": "subscription_id"}
+
+def bulk_actions(kind, items, label):
+    """Selezione multipla delle voci mostrate e operazione da applicare a tutte"""
+    names = {item.id: label(item) for item in items}
+    key = f"bulk_{kind}"
+    # Le voci eliminate nel frattempo (anche da un'altra sessione) escono dalla selezione
+    if key in st.session_state:
+        st.session_state[key] = [item_id for item_id in st.session_state[key] if item_id in names]
+    
+    with st.expander("Operazioni in blocco"):
+        if st.checkbox(f"Seleziona tutte le voci mostrate ({len(names)})", key=f"{key}_all"):
+            selected = list(names)
+        else:
+            selected = st.multiselect("Voci", list(names), format_func=names.get, key=key)
+        action = st.selectbox("Operazione", BULK_ACTIONS[kind], key=f"{key}_action")
+        
+        value = None
+        if action == "Cambia categoria":
+            value = category_selectbox("Nuova categoria", key=f"{key}_category")
+        elif action == "Cambia tipo":
+            value = st.selectbox("Nuovo tipo", SUBSCRIPTION_TYPES, key=f"{key}_type")
+        elif action.startswith("Sposta"):
+            value = int(st.number_input("Giorni (negativi per anticipare)", value=7, step=1, key=f"{key}_days"))
+        
+        if st.button(f"Applica a {len(selected)} voci", key=f"{key}_apply", disabled=not selected):
+            with timed(f"bulk.{kind}"):
+                applied = apply_bulk_action(kind, action, selected, value)
+            count(f"bulk.{kind}", len(selected))
+            st.success(f"{action}: {len(selected)} voci aggiornate.")
+            rerun_fragment(applied)
 
-# Inizializzazione dello stato della sessione
-def init_session_state():
-    if 'documents' not in st.session_state:
-        st.session_state.documents = []
+def apply_bulk_action(kind, action, ids, value):
+    """Salva l'operazione e la applica alla sessione; False se è stato ricaricato tutto il tenant"""
+    store = get_store()
+    tenant_id = current_tenant_id()
+    state = st.session_state
+    selected = set(ids)
+    records = getattr(state, kind)
+    today = datetime.now().date()
     
-    if 'deadlines' not in st.session_state:
-        st.session_state.deadlines = []
+    def linked(deadline):
+        return getattr(deadline, BULK_LINKS[kind]) in selected
     
-    if 'subscriptions' not in st.session_state:
-        st.session_state.subscriptions = []
+    if action == "Elimina":
+        version = getattr(store, f"delete_{kind}")(tenant_id, ids)
+        
+        def update():
+            for d in state.deadlines:
+                if linked(d):
+                    state.category_index.remove_deadline(d)
+            state.deadlines = [d for d in state.deadlines if not linked(d)]
+            if kind == "documents":
+                for doc in state.documents:
+                    if doc.id in selected:
+                        state.category_index.remove_document(doc)
+                        if state.duplicate_index is not None:
+                            state.duplicate_index.remove(doc.id)
+            if kind != "deadlines":
+                setattr(state, kind, [record for record in records if record.id not in selected])
     
-    if 'chat_history' not in st.session_state:
-        st.session_state.chat_history = []
-
-    if 'categories' not in st.session_state:
-        st.session_state.categories = ["Casa", "Lavoro", "Salute", "Finanza", "Istruzione", "Altro"]
+    elif action in ("Cambia categoria", "Cambia tipo"):
+        version = store.recategorize(tenant_id, kind, ids, value)
+        
+        def update():
+            for record in records:
+                if record.id not in selected:
+                    continue
+                if kind == "subscriptions":
+                    record.type = value
+                    continue
+                # L'indice delle categorie va aggiornato con la categoria vecchia e quella nuova
+                remove, add = ((state.category_index.remove_document, state.category_index.add_document)
+                               if kind == "documents" else
+                               (state.category_index.remove_deadline, state.category_index.add_deadline))
+                remove(record)
+                record.category = value
+                add(record)
+            if kind != "subscriptions":
+                state.categories.add(value)
+    
+    elif action.startswith("Segna"):
+        done = action == "Segna come completate"
+        version = store.mark_deadlines_done(tenant_id, ids, done)
+        
+        def update():
+            for d in records:
+                if d.id in selected:
+                    d.status = "done" if done else classify_status(d.date, today)
+    
+    else:
+        version = store.reschedule(tenant_id, kind, ids, value)
+        shift = timedelta(days=value)
+        # Come nell'archivio, di un documento si sposta solo la scadenza nel giorno della sua data di scadenza
+        expiries = {record.id: record.expiry_date for record in records if kind == "documents" and record.id in selected}
+        
+        def update():
+            for record in records:
+                if record.id not in selected or kind == "deadlines":
+                    continue
+                if kind == "documents" and record.expiry_date:
+                    record.expiry_date += shift
+                if kind == "subscriptions":
+                    record.renewal_date += shift
+                    record.status = classify_status(record.renewal_date, today)
+            for d in state.deadlines:
+                if linked(d) and (kind != "documents" or d.date == expiries[d.document_id]):
+                    d.date += shift
+                    if d.status != "done":
+                        d.status = classify_status(d.date, today)
+    
+    return apply_write(version, update)
 
 # Funzione per visualizzare il logo
 def display_logo():
-    st.markdown("""
+    send_html("""
     <div class="sidebar-logo">
-        <h1 style="color: #4e73df;">📄 ContractME</h1>
+        <h1>📄 ContractME</h1>
         <p>Gestisci i tuoi documenti con semplicità</p>
     </div>
-    """, unsafe_allow_html=True)
+    """)
+
+# Ricerca rapida in tutte le voci del tenant: è un frammento, così ogni carattere digitato
+# riesegue solo la ricerca e non la pagina
+SEARCH_PAGES = {"document": ("📄", "Documenti"), "deadline": ("⏰", "Scadenze"), "subscription": ("🔄", "Abbonamenti")}
+
+def open_search_result(page):
+    st.session_state.navigation = page
+
+@fragment("quick_search")
+def quick_search():
+    query = st.text_input("Cerca", key="quick_search", placeholder="Cerca documenti, scadenze, abbonamenti",
+                          live=True, label_visibility="collapsed")
+    if len(query.strip()) < search.MIN_PREFIX:
+        return
+    
+    with timed("quick_search.query"):
+        results, total = get_search().search(current_tenant_id(), query)
+    if not results:
+        st.caption("Nessun risultato.")
+        return
+    
+    for kind, record_id, title, detail in results:
+        icon, page = SEARCH_PAGES[kind]
+        # Il risultato scelto apre la sua pagina: serve una rerun completa
+        if st.button(f"{icon} {title} · {detail}", key=f"search_{kind}_{record_id}", width="stretch",
+                     on_click=open_search_result, args=(page,)):
+            st.rerun()
+    if total > len(results):
+        st.caption(f"Primi {len(results)} di {total} risultati.")
 
 # Funzione per creare la sidebar
 def create_sidebar():
     with st.sidebar:
         display_logo()
         
+        quick_search()
+        
         st.markdown("---")
         
         menu = ["Dashboard", "Documenti", "Scadenze", "Abbonamenti", "Calendario", "Assistente AI"]
-        choice = st.radio("Navigazione", menu)
+        choice = st.radio("Navigazione", menu, key="navigation")
+        
+        st.markdown("---")
+        
+        account_panel()
         
         st.markdown("---")
         
-        st.markdown("""
-        <div style="text-align: center; margin-top: 20px; font-size: small;">
+        send_html("""
+        <div class="sidebar-footer">
             © 2025 ContractME<br>
             Versione 1.0
         </div>
-        """, unsafe_allow_html=True)
+        """)
         
         return choice
 
 # 1. Modulo di caricamento documenti
+DOCUMENT_TYPES = {"jpg": "image", "jpeg": "image", "png": "image", "webp": "image", "pdf": "pdf", "txt": "text",
+                  "md": "text"}
+
+def duplicate_index():
+    """Indice dei quasi duplicati del tenant, costruito al primo caricamento dopo una sincronizzazione"""
+    if st.session_state.duplicate_index is None:
+        with timed("duplicate_index.build"):
+            st.session_state.duplicate_index = similarity.NearDuplicateIndex(
+                get_store().load_fingerprints(current_tenant_id()))
+    return st.session_state.duplicate_index
+
+def upload_fingerprint(uploaded_file, doc_type):
+    # La firma del file scelto viene calcolata una sola volta, non a ogni rerun del modulo
+    fingerprint = st.session_state.get("upload_fingerprint")
+    if fingerprint is None or fingerprint[0] != uploaded_file.file_id:
+        with timed("similarity.fingerprint"):
+            try:
+                signature = similarity.fingerprint(doc_type, uploaded_file.getvalue())
+            except (OSError, RuntimeError, Image.DecompressionBombError):
+                signature = None
+        fingerprint = st.session_state.upload_fingerprint = (uploaded_file.file_id, signature)
+    return fingerprint[1]
+
+def save_document_version(document, filename, content, preview, original_size, original, fingerprint):
+    """Salva un file come nuova revisione di un documento e la sostituisce al documento in sessione"""
+    revision = dataclasses.replace(document, preview=preview, filename=filename, upload_date=datetime.now().date())
+    try:
+        version = get_store().add_document_version(current_tenant_id(), revision, content, original_size, original,
+                                                   fingerprint)
+    except ValueError as e:
+        st.error(str(e))
+        return None
+    
+    def update():
+        documents = st.session_state.documents
+        documents[documents.index(document)] = revision
+        st.session_state.category_index.remove_document(document)
+        st.session_state.category_index.add_document(revision)
+        if st.session_state.duplicate_index is not None:
+            st.session_state.duplicate_index.remove(document.id)
+            if fingerprint:
+                st.session_state.duplicate_index.add(revision.id, *fingerprint)
+    
+    apply_write(version, update)
+    st.success(f"Versione {revision.version} di '{document.name}' caricata con successo!")
+    return revision
+
 def upload_document():
-    st.markdown("<h2>Carica un nuovo documento</h2>", unsafe_allow_html=True)
+    send_html("<h2>Carica un nuovo documento</h2>")
     
     col1, col2 = st.columns(2)
     
     with col1:
         doc_name = st.text_input("Nome del documento")
-        doc_category = st.selectbox("Categoria", st.session_state.categories)
+        doc_category = category_selectbox("Categoria")
         custom_category = st.text_input("Aggiungi nuova categoria (opzionale)")
         
         if custom_category and custom_category not in st.session_state.categories:
-            st.session_state.categories.append(custom_category)
+            version = get_store().add_category(current_tenant_id(), custom_category)
+            apply_write(version, lambda: st.session_state.categories.add(custom_category))
             st.success(f"Categoria '{custom_category}' aggiunta!")
     
     with col2:
         uploaded_file = st.file_uploader("Carica un documento", 
-                                       type=["pdf", "jpg", "jpeg", "png", "txt", "md"],
-                                       help="Formati supportati: PDF, JPG, PNG, TXT, MD")
+                                       type=["pdf", "jpg", "jpeg", "png", "webp", "txt", "md"],
+                                       help="Formati supportati: PDF, JPG, PNG, WEBP, TXT, MD")
         
         has_expiry = st.checkbox("Il documento ha una scadenza")
         
@@ -231,156 +3561,251 @@ def upload_document():
         else:
             expiry_date = None
     
-    if st.button("Carica documento"):
-        if doc_name and uploaded_file:
+    # Controllo dei quasi duplicati appena viene scelto il file, prima del caricamento
+    fingerprint = None
+    previous = None
+    confirmed = True
+    if uploaded_file:
+        upload_type = DOCUMENT_TYPES.get(uploaded_file.name.split(".")[-1].lower())
+        fingerprint = upload_fingerprint(uploaded_file, upload_type)
+        duplicates = duplicate_index().query(*fingerprint) if fingerprint else []
+        documents = {doc.id: doc for doc in st.session_state.documents}
+        for doc_id, score in duplicates[:3]:
+            st.warning(f"Possibile duplicato di '{documents[doc_id].name}' (somiglianza {score:.0%}).")
+        
+        # Il file può essere una nuova revisione di un documento dello stesso tipo: il più simile è proposto
+        options = [None] + [doc.id for doc in st.session_state.documents if doc.type == upload_type]
+        suggested = next((doc_id for doc_id, _ in duplicates if doc_id in options), None)
+        previous_id = st.selectbox("Nuova versione di", options, index=options.index(suggested),
+                                   format_func=lambda doc_id: "Nessun documento: è un nuovo documento" if doc_id is None
+                                   else f"{documents[doc_id].name} (versione {documents[doc_id].version})")
+        previous = documents.get(previous_id)
+        if duplicates and previous is None:
+            confirmed = st.checkbox("Carica comunque")
+    
+    if st.button("Carica documento", disabled=not confirmed):
+        if uploaded_file and (doc_name or previous is not None):
             # Salvataggio temporaneo del file
             file_extension = uploaded_file.name.split(".")[-1].lower()
             
             # Per determinare il tipo di documento
-            doc_type = ""
+            doc_type = DOCUMENT_TYPES.get(file_extension, "")
             preview_data = None
+            content = None
+            original_size = None
+            original = None
+            filename = uploaded_file.name
             
-            if file_extension in ["jpg", "jpeg", "png"]:
-                doc_type = "image"
-                image = Image.open(uploaded_file)
-                img_bytes = io.BytesIO()
-                image.save(img_bytes, format="PNG")
-                preview_data = base64.b64encode(img_bytes.getvalue()).decode()
+            if doc_type == "image":
+                try:
+                    with timed("ingest.image"):
+                        content, original_size, original = get_ingest_pool().submit(
+                            ingest_image, uploaded_file.getvalue()).result()
+                except (OSError, Image.DecompressionBombError):
+                    st.error("L'immagine caricata non è leggibile.")
+                    return
+                filename = normalized_filename(filename)
             
-            elif file_extension == "pdf":
-                doc_type = "pdf"
-                preview_data = base64.b64encode(uploaded_file.read()).decode()
-                
-            elif file_extension in ["txt", "md"]:
-                doc_type = "text"
-                preview_data = uploaded_file.read().decode()
-                
-            # Creazione dell'oggetto documento
-            document = {
-                "id": len(st.session_state.documents) + 1,
-                "name": doc_name,
-                "category": doc_category if not custom_category else custom_category,
-                "type": doc_type,
-                "preview": preview_data,
-                "upload_date": datetime.now().date(),
-                "expiry_date": expiry_date,
-                "filename": uploaded_file.name
-            }
+            elif doc_type in ("pdf", "text"):
+                content = uploaded_file.getvalue()
             
-            # Aggiunta alla sessione
-            st.session_state.documents.append(document)
+            if content is not None and len(content) <= PREVIEW_INLINE_BYTES:
+                preview_data = encode_preview(doc_type, content)
             
-            # Se ha data di scadenza, aggiungiamo anche come deadline
-            if expiry_date:
-                deadline = {
-                    "id": len(st.session_state.deadlines) + 1,
-                    "title": f"Scadenza {doc_name}",
-                    "date": expiry_date,
-                    "description": f"Scadenza per il documento '{doc_name}'",
-                    "category": doc_category if not custom_category else custom_category,
-                    "document_id": document["id"]
-                }
-                st.session_state.deadlines.append(deadline)
+            if previous is not None:
+                # Nuova revisione: nome, categoria e scadenza restano quelli del documento
+                document = save_document_version(previous, filename, content, preview_data,
+                                                 original_size, original, fingerprint)
+                if document is None:
+                    return
+            else:
+                # Creazione dell'oggetto documento (l'id viene assegnato dall'archivio)
+                document = Document(
+                    name=doc_name,
+                    category=doc_category if not custom_category else custom_category,
+                    type=doc_type,
+                    preview=preview_data,
+                    upload_date=datetime.now().date(),
+                    expiry_date=expiry_date,
+                    filename=filename
+                )
+                
+                # Se ha data di scadenza, aggiungiamo anche come deadline
+                deadline = None
+                if expiry_date:
+                    deadline = Deadline(
+                        title=f"Scadenza {doc_name}",
+                        date=expiry_date,
+                        description=f"Scadenza per il documento '{doc_name}'",
+                        category=doc_category if not custom_category else custom_category
+                    )
+                
+                # Salvataggio nell'archivio e aggiunta alla sessione
+                try:
+                    version = get_store().add_document(current_tenant_id(), document, content, deadline,
+                                                       original_size, original, fingerprint)
+                except ValueError as e:
+                    st.error(str(e))
+                    return
+                
+                def update():
+                    st.session_state.documents.append(document)
+                    st.session_state.categories.add(document.category)
+                    st.session_state.category_index.add_document(document)
+                    if fingerprint and st.session_state.duplicate_index is not None:
+                        st.session_state.duplicate_index.add(document.id, *fingerprint)
+                    if deadline:
+                        st.session_state.deadlines.append(deadline)
+                        st.session_state.category_index.add_deadline(deadline)
+                
+                apply_write(version, update)
+                
+                st.success(f"Documento '{doc_name}' caricato con successo!")
             
-            st.success(f"Documento '{doc_name}' caricato con successo!")
+            if ocr_enabled(doc_type):
+                # Il testo delle scansioni viene estratto in background, senza rallentare il caricamento
+                get_ocr_queue().enqueue(current_tenant_id(), document.id, doc_type, content)
+            if original_size:
+                st.info(f"Immagine ottimizzata: {original_size / 1024:,.0f} KB → {len(content) / 1024:,.0f} KB "
+                        f"({(original_size - len(content)) / original_size:.0%} risparmiato).")
         else:
             st.error("Per favore, inserisci un nome per il documento e carica un file.")
 
+@fragment("view_documents")
 def view_documents():
-    st.markdown("<h2>I tuoi documenti</h2>", unsafe_allow_html=True)
+    send_html("<h2>I tuoi documenti</h2>")
     
     if not st.session_state.documents:
         st.info("Non hai ancora caricato documenti. Usa il modulo sopra per caricare il tuo primo documento.")
         return
     
-    # Rimuovi eventuali duplicati basati sul nome
-    unique_docs = {}
-    for doc in st.session_state.documents:
-        name = doc.get("name", "Documento senza nome")
-        unique_docs[name] = doc
-    
-    # Usa solo documenti unici
-    st.session_state.documents = list(unique_docs.values())
+    # Filtro per categoria: una categoria comprende anche le sue sottocategorie
+    filter_category = category_selectbox("Filtra per categoria", include_all=True)
     
-    # Filtro per categoria
-    all_categories = ["Tutti"] + st.session_state.categories
-    filter_category = st.selectbox("Filtra per categoria", all_categories)
-    
-    filtered_docs = st.session_state.documents
-    if filter_category != "Tutti":
-        filtered_docs = [doc for doc in st.session_state.documents if doc["category"] == filter_category]
+    with timed("view_documents.scan"):
+        filtered_docs = st.session_state.documents
+        if filter_category != "Tutti":
+            filtered_docs = st.session_state.category_index.documents_in(
+                st.session_state.categories.descendants(filter_category))
+        count("records_scanned", len(filtered_docs))
     
     if not filtered_docs:
         st.info(f"Non ci sono documenti nella categoria '{filter_category}'.")
         return
     
-    # Visualizzazione documenti
-    for i, doc in enumerate(filtered_docs):
-        col1, col2 = st.columns([2, 3])
+    bulk_actions("documents", filtered_docs, lambda doc: doc.name)
+    
+    # Visualizzazione documenti: ogni scheda è un frammento a sé
+    for doc in filtered_docs:
+        document_card(doc)
+
+@fragment("document_card")
+def document_card(doc):
+    # Dopo l'eliminazione si riesegue solo questa scheda, che non viene più mostrata
+    if not st.session_state.category_index.contains_document(doc):
+        return
+    
+    col1, col2 = st.columns([2, 3])
+    
+    with col1:
+        send_html(templates.document_card(doc.name, doc.category, doc.upload_date, doc.filename, doc.expiry_date,
+                                          doc.version))
         
-        with col1:
-            st.markdown(f"""
-            <div class="card">
-                <h3>{doc['name']}</h3>
-                <p><strong>Categoria:</strong> {doc['category']}</p>
-                <p><strong>Data caricamento:</strong> {doc['upload_date'].strftime('%d/%m/%Y')}</p>
-                <p><strong>Tipo file:</strong> {doc['filename'].split('.')[-1].upper()}</p>
-                
-                {f"<p><strong>Data scadenza:</strong> {doc['expiry_date'].strftime('%d/%m/%Y')}</p>" if doc['expiry_date'] else ""}
-            </div>
-            """, unsafe_allow_html=True)
+        if st.button(f"Elimina documento {doc.name}", key=f"del_doc_{doc.id}"):
+            version = get_store().delete_document(current_tenant_id(), doc.id)
             
-            if st.button(f"Elimina documento {doc['name']}", key=f"del_doc_{doc['id']}"):
+            def update():
                 # Rimuovi il documento
                 st.session_state.documents.remove(doc)
+                st.session_state.category_index.remove_document(doc)
+                if st.session_state.duplicate_index is not None:
+                    st.session_state.duplicate_index.remove(doc.id)
                 # Rimuovi eventuali scadenze associate
-                st.session_state.deadlines = [d for d in st.session_state.deadlines if d.get('document_id') != doc['id']]
-                st.success(f"Documento '{doc['name']}' eliminato con successo!")
-                st.rerun()
-        
-        with col2:
-            st.markdown("<div class='card'><h4>Anteprima</h4>", unsafe_allow_html=True)
+                for d in st.session_state.deadlines:
+                    if d.document_id == doc.id:
+                        st.session_state.category_index.remove_deadline(d)
+                st.session_state.deadlines = [d for d in st.session_state.deadlines if d.document_id != doc.id]
             
-            if doc["type"] == "image":
-                st.markdown(f"""
-                <img src="data:image/png;base64,{doc['preview']}" 
-                     style="max-width: 100%; max-height: 300px; display: block; margin: 0 auto;">
-                """, unsafe_allow_html=True)
-                
-            elif doc["type"] == "pdf":
-                st.markdown(f"""
-                <p>Anteprima PDF non disponibile direttamente. 
-                   <a href="data:application/pdf;base64,{doc['preview']}" download="{doc['name']}.pdf">
-                   Scarica il PDF</a></p>
-                """, unsafe_allow_html=True)
-                
-            elif doc["type"] == "text":
-                st.markdown(f"""
-                <div style="background-color: #f5f5f5; padding: 10px; border-radius: 5px; 
-                            max-height: 300px; overflow-y: auto; font-family: monospace;">
-                    {doc['preview'].replace('\n', '<br>')}
-                </div>
-                """, unsafe_allow_html=True)
+            # Se la sessione è stata ricaricata per intero serve una rerun completa
+            applied = apply_write(version, update)
+            st.success(f"Documento '{doc.name}' eliminato con successo!")
+            rerun_fragment(applied)
+    
+    with col2:
+        if doc.type == "image":
+            preview = document_preview(doc)
+            # Il base64 è prodotto dall'app e non contiene caratteri da escapare
+            if preview:
+                send_html(templates.PREVIEW_IMAGE.render(mime=templates.image_mime(preview),
+                                                         data=templates.Markup(preview)))
             
-            st.markdown("</div>", unsafe_allow_html=True)
-        
-        st.markdown("<hr>", unsafe_allow_html=True)
+        elif doc.type == "pdf":
+            # Il PDF viene scaricato su richiesta invece di viaggiare nell'HTML della pagina
+            send_html(templates.PREVIEW_PDF)
+            st.download_button("Scarica il PDF", lambda: base64.b64decode(document_preview(doc) or ""),
+                               file_name=f"{doc.name}.pdf", mime="application/pdf", key=f"pdf_{doc.id}")
+            
+        elif doc.type == "text":
+            # Una riga vuota chiuderebbe il blocco HTML nel markdown di Streamlit
+            text = templates.Markup(templates.escape(document_preview(doc) or "").replace("\n", "<br>"))
+            send_html(templates.PREVIEW_TEXT.render(text=text))
+    
+    # La cronologia viene letta dall'archivio solo quando viene aperta
+    if doc.version > 1 and st.toggle("Cronologia versioni", key=f"history_{doc.id}"):
+        document_history(doc)
+    
+    send_html("<hr>")
+
+def version_diff(store, tenant_id, doc, old, new):
+    """Differenze tra due revisioni: diff unificato per i testi, confronto del contenuto per i file binari"""
+    before = store.document_version_content(tenant_id, doc.id, old)
+    after = store.document_version_content(tenant_id, doc.id, new)
+    if doc.type != "text":
+        if before == after:
+            return "Le due versioni hanno lo stesso contenuto."
+        return f"Contenuto diverso: {len(before):,} byte nella versione {old}, {len(after):,} nella versione {new}."
+    return "".join(difflib.unified_diff(before.decode().splitlines(keepends=True), after.decode().splitlines(keepends=True),
+                                        fromfile=f"versione {old}", tofile=f"versione {new}")) \
+        or "Nessuna differenza."
+
+def document_history(doc):
+    store = get_store()
+    tenant_id = current_tenant_id()
+    history = cached("document_history", doc.id, lambda: store.document_history(tenant_id, doc.id))
+    st.dataframe(pd.DataFrame([(h["version"], h["filename"], h["upload_date"], h["size"]) for h in history],
+                              columns=["Versione", "File", "Data", "Byte"]), hide_index=True, width="stretch")
+    
+    versions = [h["version"] for h in history]
+    col1, col2 = st.columns(2)
+    with col1:
+        old = st.selectbox("Confronta la versione", versions, index=1, key=f"diff_from_{doc.id}")
+    with col2:
+        new = st.selectbox("con la versione", versions, index=0, key=f"diff_to_{doc.id}")
+    
+    # Ricostruire una revisione costa un delta per ogni revisione successiva: il diff resta in cache
+    with timed("document_history.diff"):
+        diff = cached("document_diff", (doc.id, old, new), lambda: version_diff(store, tenant_id, doc, old, new))
+    st.code(diff, language="diff" if doc.type == "text" else None)
+    
+    filename = next(h["filename"] for h in history if h["version"] == old)
+    st.download_button(f"Scarica la versione {old}", lambda: store.document_version_content(tenant_id, doc.id, old),
+                       file_name=filename, key=f"download_version_{doc.id}")
 
 # 2. Modulo di gestione scadenze
 def add_deadline():
-    st.markdown("<h2>Aggiungi una nuova scadenza</h2>", unsafe_allow_html=True)
+    send_html("<h2>Aggiungi una nuova scadenza</h2>")
     
     col1, col2 = st.columns(2)
     
     with col1:
         deadline_title = st.text_input("Titolo della scadenza")
-        deadline_category = st.selectbox("Categoria", st.session_state.categories)
+        deadline_category = category_selectbox("Categoria", key="deadline_category")
         
     with col2:
         deadline_date = st.date_input("Data scadenza", min_value=datetime.now().date())
         
         # Opzione per collegare a un documento esistente
-        doc_options = ["Nessun documento collegato"] + [doc["name"] for doc in st.session_state.documents]
+        doc_options = ["Nessun documento collegato"] + [doc.name for doc in st.session_state.documents]
         selected_doc = st.selectbox("Documento collegato (opzionale)", doc_options)
         
     deadline_desc = st.text_area("Descrizione", height=100)
@@ -391,192 +3816,139 @@ def add_deadline():
             doc_id = None
             if selected_doc != "Nessun documento collegato":
                 for doc in st.session_state.documents:
-                    if doc["name"] == selected_doc:
-                        doc_id = doc["id"]
+                    if doc.name == selected_doc:
+                        doc_id = doc.id
                         break
             
-            deadline = {
-                "id": len(st.session_state.deadlines) + 1,
-                "title": deadline_title,
-                "date": deadline_date,
-                "description": deadline_desc,
-                "category": deadline_category,
-                "document_id": doc_id
-            }
+            deadline = Deadline(
+                title=deadline_title,
+                date=deadline_date,
+                description=deadline_desc,
+                category=deadline_category,
+                document_id=doc_id
+            )
+            
+            try:
+                version = get_store().add_deadline(current_tenant_id(), deadline)
+            except ValueError as e:
+                st.error(str(e))
+                return
+            def update():
+                st.session_state.deadlines.append(deadline)
+                st.session_state.categories.add(deadline.category)
+                st.session_state.category_index.add_deadline(deadline)
             
-            st.session_state.deadlines.append(deadline)
+            apply_write(version, update)
             st.success(f"Scadenza '{deadline_title}' aggiunta con successo!")
         else:
             st.error("Titolo e data sono obbligatori!")
 
+@fragment("view_deadlines")
 def view_deadlines():
-    st.markdown("<h2>Le tue scadenze</h2>", unsafe_allow_html=True)
+    send_html("<h2>Le tue scadenze</h2>")
     
     if not st.session_state.deadlines:
         st.info("Non hai ancora aggiunto scadenze.")
         return
     
-    # Ordiniamo le scadenze per data
-    sorted_deadlines = sorted(st.session_state.deadlines, key=lambda x: x["date"])
+    # Ordiniamo le scadenze per data (una sola volta per versione dei dati)
+    sorted_deadlines = cached_order("sorted_deadlines", (), st.session_state.deadlines,
+                                    lambda deadlines: sorted(deadlines, key=lambda x: x.date))
     
     # Filtro per periodi
-    period_options = ["Tutte", "Prossimi 7 giorni", "Prossimi 30 giorni", "Prossimi 3 mesi", "Scadute"]
+    period_options = ["Tutte", "Prossimi 7 giorni", "Prossimi 30 giorni", "Prossimi 3 mesi", "Scadute", "Completate"]
     selected_period = st.selectbox("Visualizza scadenze per periodo", period_options)
     
     filtered_deadlines = sorted_deadlines
     today = datetime.now().date()
     
-    if selected_period == "Prossimi 7 giorni":
-        end_date = today + timedelta(days=7)
-        filtered_deadlines = [d for d in sorted_deadlines if today <= d["date"] <= end_date]
-    elif selected_period == "Prossimi 30 giorni":
-        end_date = today + timedelta(days=30)
-        filtered_deadlines = [d for d in sorted_deadlines if today <= d["date"] <= end_date]
-    elif selected_period == "Prossimi 3 mesi":
-        end_date = today + timedelta(days=90)
-        filtered_deadlines = [d for d in sorted_deadlines if today <= d["date"] <= end_date]
-    elif selected_period == "Scadute":
-        filtered_deadlines = [d for d in sorted_deadlines if d["date"] < today]
+    with timed("view_deadlines.scan"):
+        count("records_scanned", len(sorted_deadlines))
+        
+        if selected_period == "Prossimi 7 giorni":
+            filtered_deadlines = [d for d in sorted_deadlines if d.status in ("urgent", "imminent")]
+        elif selected_period == "Prossimi 30 giorni":
+            end_date = today + timedelta(days=30)
+            filtered_deadlines = [d for d in sorted_deadlines if today <= d.date <= end_date]
+        elif selected_period == "Prossimi 3 mesi":
+            end_date = today + timedelta(days=90)
+            filtered_deadlines = [d for d in sorted_deadlines if today <= d.date <= end_date]
+        elif selected_period == "Scadute":
+            filtered_deadlines = [d for d in sorted_deadlines if d.status == "expired"]
+        elif selected_period == "Completate":
+            filtered_deadlines = [d for d in sorted_deadlines if d.status == "done"]
     
     if not filtered_deadlines:
         st.info(f"Non ci sono scadenze nel periodo selezionato ({selected_period}).")
         return
     
-    # Visualizziamo le scadenze in una tabella
-    deadlines_data = []
-    
-    for d in filtered_deadlines:
-        # Calcoliamo se scaduta o imminente
-        days_left = (d["date"] - today).days
-        status = "⚠️ Scaduta" if days_left < 0 else "🔄 Imminente" if days_left <= 7 else "✅ Futura"
-        
-        # Troviamo il nome del documento associato, se presente
-        doc_name = "Nessuno"
-        if d.get("document_id"):
-            for doc in st.session_state.documents:
-                if doc["id"] == d["document_id"]:
-                    doc_name = doc["name"]
-                    break
-        
-        deadlines_data.append({
-            "ID": d["id"],
-            "Titolo": d["title"],
-            "Data": d["date"].strftime("%d/%m/%Y"),
-            "Giorni rimanenti": max(days_left, 0) if days_left >= 0 else f"Scaduta da {abs(days_left)} giorni",
-            "Categoria": d["category"],
-            "Documento": doc_name,
-            "Stato": status
-        })
-    
-    df = pd.DataFrame(deadlines_data)
-    
-    # Visualizzazione come tabella colorata
-    st.markdown("""
-    <style>
-    .deadline-table {
-        font-family: Arial, sans-serif;
-        border-collapse: collapse;
-        width: 100%;
-    }
-    .deadline-table th {
-        background-color: #4e73df;
-        color: white;
-        padding: 12px;
-        text-align: left;
-    }
-    .deadline-table td {
-        padding: 10px;
-        border-bottom: 1px solid #ddd;
-    }
-    .deadline-table tr:nth-child(even) {
-        background-color: #f9f9f9;
-    }
-    .deadline-table tr:hover {
-        background-color: #f1f1f1;
-    }
-    
-    .status-expired {
-        color: #e74a3b;
-        font-weight: bold;
-    }
-    .status-imminent {
-        color: #f6c23e;
-        font-weight: bold;
-    }
-    .status-future {
-        color: #1cc88a;
-    }
-    </style>
-    """, unsafe_allow_html=True)
-    
-    # Visualizzazione della tabella
-    html_table = "<table class='deadline-table'>"
-    
-    # Intestazione
-    html_table += "<tr>"
-    for col in df.columns:
-        html_table += f"<th>{col}</th>"
-    html_table += "</tr>"
-    
-    # Righe
-    for _, row in df.iterrows():
-        html_table += "<tr>"
-        for i, value in enumerate(row):
-            cell_class = ""
-            if df.columns[i] == "Stato":
-                if "Scaduta" in value:
-                    cell_class = "status-expired"
-                elif "Imminente" in value:
-                    cell_class = "status-imminent"
-                else:
-                    cell_class = "status-future"
-            
-            html_table += f"<td class='{cell_class}'>{value}</td>"
-        html_table += "</tr>"
+    bulk_actions("deadlines", filtered_deadlines, lambda d: f"{d.title} ({d.date:%d/%m/%Y})")
     
-    html_table += "</table>"
+    def build_deadline_table():
+        document_names = {doc.id: doc.name for doc in st.session_state.documents}
+        rows = []
+        for d in filtered_deadlines:
+            # Lo stato è già classificato nell'archivio
+            days_left = (d.date - today).days
+            style = STATUS_STYLES[d.status]
+            rows.append(templates.DEADLINE_ROW.render(
+                id=d.id,
+                title=d.title,
+                date=d.date,
+                days=days_left if days_left >= 0 else f"Scaduta da {abs(days_left)} giorni",
+                category=d.category,
+                document=document_names.get(d.document_id, "Nessuno"),
+                status_class=style["css"],
+                status=style["label"]
+            ))
+        return templates.DEADLINE_TABLE.render(rows=templates.join(rows))
     
-    st.markdown(html_table, unsafe_allow_html=True)
+    # La tabella HTML viene condivisa tra le sessioni finché i dati non cambiano
+    with timed("view_deadlines.table"):
+        html_table = cached("deadline_table", (selected_period, today), build_deadline_table)
+    
+    send_html(html_table)
     
     # Grafico delle prossime scadenze
-    st.markdown("<h3>Grafico delle prossime scadenze</h3>", unsafe_allow_html=True)
+    send_html("<h3>Grafico delle prossime scadenze</h3>")
     
-    upcoming_deadlines = [d for d in sorted_deadlines if d["date"] >= today][:10]  # Prendiamo le prossime 10
+    upcoming_deadlines = [d for d in sorted_deadlines if d.status not in ("expired", "done")][:10]  # Prendiamo le prossime 10
     
     if upcoming_deadlines:
         df_chart = pd.DataFrame([
             {
-                "Titolo": d["title"], 
-                "Data": d["date"], 
-                "Giorni rimanenti": (d["date"] - today).days
+                "Titolo": d.title, 
+                "Data": d.date, 
+                "Giorni rimanenti": (d.date - today).days
             } for d in upcoming_deadlines
         ])
         
         df_chart = df_chart.sort_values("Data")
         
-        fig = px.bar(
-            df_chart, 
-            x="Titolo", 
-            y="Giorni rimanenti",
-            title="Giorni rimanenti alle prossime scadenze",
-            color="Giorni rimanenti",
-            color_continuous_scale=["#e74a3b", "#f6c23e", "#1cc88a"],
-            height=400
-        )
+        with timed("view_deadlines.chart"):
+            fig = px.bar(
+                df_chart, 
+                x="Titolo", 
+                y="Giorni rimanenti",
+                title="Giorni rimanenti alle prossime scadenze",
+                color="Giorni rimanenti",
+                color_continuous_scale=["#e74a3b", "#f6c23e", "#1cc88a"],
+                height=400
+            )
         
-        st.plotly_chart(fig, use_container_width=True)
+        st.plotly_chart(fig, width="stretch")
     else:
         st.info("Non ci sono scadenze future da visualizzare nel grafico.")
 
 # 3. Modulo Abbonamenti
 def add_subscription():
-    st.markdown("<h2>Aggiungi un nuovo abbonamento</h2>", unsafe_allow_html=True)
+    send_html("<h2>Aggiungi un nuovo abbonamento</h2>")
     
     col1, col2 = st.columns(2)
     
     with col1:
         sub_name = st.text_input("Nome abbonamento")
-        sub_type = st.selectbox("Tipo", ["Streaming", "Servizi", "Utility", "Palestra", "Software", "Altro"])
+        sub_type = st.selectbox("Tipo", SUBSCRIPTION_TYPES)
         
     with col2:
         sub_renewal_date = st.date_input("Data prossimo rinnovo", min_value=datetime.now().date())
@@ -586,83 +3958,67 @@ def add_subscription():
     
     if st.button("Aggiungi abbonamento"):
         if sub_name and sub_renewal_date:
-            subscription = {
-                "id": len(st.session_state.subscriptions) + 1,
-                "name": sub_name,
-                "type": sub_type,
-                "renewal_date": sub_renewal_date,
-                "cost": float(sub_cost),  # Assicuriamoci che il costo sia un float
-                "description": sub_desc
-            }
-            
-            st.session_state.subscriptions.append(subscription)
+            subscription = Subscription(
+                name=sub_name,
+                type=sub_type,
+                renewal_date=sub_renewal_date,
+                cost=sub_cost,
+                description=sub_desc
+            )
             
             # Aggiungiamo anche una scadenza per il rinnovo
-            deadline = {
-                "id": len(st.session_state.deadlines) + 1,
-                "title": f"Rinnovo {sub_name}",
-                "date": sub_renewal_date,
-                "description": f"Rinnovo abbonamento '{sub_name}' - {sub_cost}€",
-                "category": "Abbonamenti",
-                "subscription_id": subscription["id"]
-            }
-            st.session_state.deadlines.append(deadline)
+            deadline = Deadline(
+                title=f"Rinnovo {sub_name}",
+                date=sub_renewal_date,
+                description=f"Rinnovo abbonamento '{sub_name}' - {sub_cost}€",
+                category="Abbonamenti"
+            )
+            
+            try:
+                version = get_store().add_subscription(current_tenant_id(), subscription, deadline)
+            except ValueError as e:
+                st.error(str(e))
+                return
+            
+            def update():
+                st.session_state.subscriptions.append(subscription)
+                st.session_state.deadlines.append(deadline)
+                st.session_state.categories.add(deadline.category)
+                st.session_state.category_index.add_deadline(deadline)
+            
+            apply_write(version, update)
             
             st.success(f"Abbonamento '{sub_name}' aggiunto con successo!")
         else:
             st.error("Nome e data di rinnovo sono obbligatori!")
 
+@fragment("view_subscriptions")
 def view_subscriptions():
-    st.markdown("<h2>I tuoi abbonamenti</h2>", unsafe_allow_html=True)
+    send_html("<h2>I tuoi abbonamenti</h2>")
     
     if not st.session_state.subscriptions:
         st.info("Non hai ancora aggiunto abbonamenti.")
         return
     
-    # Visualizziamo gli abbonamenti in cards
-    # Assicuriamoci che ogni abbonamento abbia una chiave 'cost' e che sia un numero
-    for sub in st.session_state.subscriptions:
-        if "cost" not in sub or not isinstance(sub["cost"], (int, float)):
-            sub["cost"] = 0.0
-            
-    total_monthly_cost = sum(sub["cost"] for sub in st.session_state.subscriptions)
+    # Costi e date sono validati al salvataggio: qui si leggono solo le colonne precalcolate
+    today = datetime.now().date()
+    costs = cached("subscription_costs", (), lambda: SubscriptionCosts(st.session_state.subscriptions))
     
-    st.markdown(f"""
-    <div class="metric">
-        <div class="metric-label">Costo mensile totale</div>
-        <div class="metric-value">{total_monthly_cost:.2f} €</div>
-    </div>
-    """, unsafe_allow_html=True)
+    with timed("view_subscriptions.analytics"):
+        next_30_days = costs.renewals_within(today, 30)
+        
+        col1, col2, col3 = st.columns(3)
+        for col, label, value in [(col1, "Costo mensile totale", costs.monthly_total),
+                                  (col2, "Proiezione annuale", costs.annual_total),
+                                  (col3, "Rinnovi nei prossimi 30 giorni", next_30_days)]:
+            with col:
+                send_html(templates.COST_METRIC.render(label=label, value=value))
     
     # Ordinati per data di rinnovo
-    # Ordinati per data di rinnovo
-    # Verifichiamo che ogni abbonamento abbia una renewal_date valida prima di ordinare
-    for sub in st.session_state.subscriptions:
-        # Reimposta sempre la data di rinnovo per sicurezza
-        try:
-            # Proviamo ad accedere alla data, se non esiste o non è valida, impostiamo una predefinita
-            renewal_date = sub.get("renewal_date")
-            if renewal_date is None or not hasattr(renewal_date, "year"):
-                sub["renewal_date"] = datetime.now().date()
-        except:
-            # In caso di qualsiasi errore, imposta una data di default
-            sub["renewal_date"] = datetime.now().date()
-    
-    # Rimuovi eventuali duplicati basati sul nome
-    unique_subs = {}
-    for sub in st.session_state.subscriptions:
-        name = sub.get("name", "Abbonamento senza nome")
-        unique_subs[name] = sub
-    
-    # Usa solo abbonamenti unici
-    st.session_state.subscriptions = list(unique_subs.values())
-    
-    # Ordinamento sicuro
-    try:
-        sorted_subs = sorted(st.session_state.subscriptions, key=lambda x: x["renewal_date"])
-    except:
-        # Se l'ordinamento fallisce, usa la lista non ordinata
-        sorted_subs = st.session_state.subscriptions.copy()
+    sorted_subs = cached_order("sorted_subscriptions", (), st.session_state.subscriptions,
+                               lambda subscriptions: sorted(subscriptions, key=lambda x: x.renewal_date))
+    
+    bulk_actions("subscriptions", sorted_subs, lambda sub: sub.name)
     
     # Visualizziamo le card in una griglia
     col1, col2 = st.columns(2)
@@ -670,213 +4026,236 @@ def view_subscriptions():
     for i, sub in enumerate(sorted_subs):
         # Alterniamo le colonne
         with col1 if i % 2 == 0 else col2:
-            # Controlla in modo sicuro se è possibile calcolare i giorni al rinnovo
-            try:
-                days_to_renewal = (sub["renewal_date"] - datetime.now().date()).days
-            except:
-                days_to_renewal = 0
-                
-            status_color = "#e74a3b" if days_to_renewal <= 3 else "#f6c23e" if days_to_renewal <= 7 else "#1cc88a"
+            days_to_renewal = (sub.renewal_date - today).days
+            send_html(templates.subscription_card(sub.name, sub.type, sub.cost, sub.renewal_date, days_to_renewal,
+                                                  sub.status, sub.description))
             
-            # Assicuriamoci che il nome e altri campi necessari siano presenti
-            name = sub.get("name", "Abbonamento senza nome")
-            sub_type = sub.get("type", "Non specificato")
-            cost_value = sub.get("cost", 0)
-            description = sub.get("description", "")
-            
-            if not isinstance(cost_value, (int, float)):
-                cost_value = 0
+            if st.button(f"Elimina {sub.name}", key=f"del_sub_{sub.id}"):
+                version = get_store().delete_subscription(current_tenant_id(), sub.id)
                 
-            st.markdown(f"""
-            <div class="card" style="border-left: 5px solid {status_color};">
-                <h3>{name}</h3>
-                <p><strong>Tipo:</strong> {sub_type}</p>
-                <p><strong>Costo mensile:</strong> {cost_value:.2f} €</p>
-                <p><strong>Prossimo rinnovo:</strong> {sub["renewal_date"].strftime('%d/%m/%Y')}</p>
-                <p><strong>Giorni al rinnovo:</strong> <span style="color: {status_color}; font-weight: bold;">{days_to_renewal}</span></p>
-                <p><strong>Descrizione:</strong> {description}</p>
-            </div>
-            """, unsafe_allow_html=True)
-            
-            # Ottieni il nome dell'abbonamento in modo sicuro
-            name = sub.get("name", "Abbonamento senza nome")
-            sub_id = sub.get("id", 0)
-            
-            if st.button(f"Elimina {name}", key=f"del_sub_{sub_id}_{name}"):
-                # Rimuovi abbonamento
-                st.session_state.subscriptions.remove(sub)
-                # Rimuovi eventuali scadenze associate
-                st.session_state.deadlines = [d for d in st.session_state.deadlines if d.get('subscription_id') != sub['id']]
-                st.success(f"Abbonamento '{sub['name']}' eliminato con successo!")
-                st.rerun()
+                def update():
+                    # Rimuovi abbonamento
+                    st.session_state.subscriptions.remove(sub)
+                    # Rimuovi eventuali scadenze associate
+                    for d in st.session_state.deadlines:
+                        if d.subscription_id == sub.id:
+                            st.session_state.category_index.remove_deadline(d)
+                    st.session_state.deadlines = [d for d in st.session_state.deadlines if d.subscription_id != sub.id]
+                
+                applied = apply_write(version, update)
+                st.success(f"Abbonamento '{sub.name}' eliminato con successo!")
+                rerun_fragment(applied)
     
     # Grafico a torta dei costi degli abbonamenti
-    st.markdown("<h3>Distribuzione dei costi degli abbonamenti</h3>", unsafe_allow_html=True)
-    if sorted_subs:
-        # Assicuriamoci che tutti gli abbonamenti abbiano un costo valido e un nome
-        valid_subs = []
-        for sub in sorted_subs:
-            if "cost" in sub and isinstance(sub["cost"], (int, float)):
-                # Assicuriamoci che ci sia un nome valido
-                if "name" not in sub or not sub["name"]:
-                    sub["name"] = "Abbonamento senza nome"
-                valid_subs.append(sub)
-        
-        if valid_subs:
-            fig = px.pie(
-                names=[sub["name"] for sub in valid_subs],
-                values=[sub["cost"] for sub in valid_subs],
-                title="Distribuzione costi mensili",
-                hole=0.4,
-                color_discrete_sequence=px.colors.qualitative.Pastel
-            )
-            
-            fig.update_traces(textposition='inside', textinfo='percent+label')
-            st.plotly_chart(fig, use_container_width=True)
-        else:
-            st.info("Non ci sono abbonamenti con costi validi da visualizzare.")
-    else:
-        st.info("Non ci sono abbonamenti da visualizzare.")
+    send_html("<h3>Distribuzione dei costi degli abbonamenti</h3>")
+    
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        fig = px.pie(
+            names=costs.names,
+            values=costs.costs,
+            title="Distribuzione costi mensili",
+            hole=0.4,
+            color_discrete_sequence=px.colors.qualitative.Pastel
+        )
+        
+        fig.update_traces(textposition='inside', textinfo='percent+label')
+        st.plotly_chart(fig, width="stretch")
+    
+    with col2:
+        by_type = costs.totals_by_type()
+        fig = px.bar(
+            x=by_type.index,
+            y=by_type.values,
+            title="Costo mensile per tipo",
+            labels={"x": "", "y": "€ al mese"},
+            color_discrete_sequence=["#4e73df"]
+        )
+        st.plotly_chart(fig, width="stretch")
+    
+    # Spesa prevista nei prossimi 12 mesi, in base alle date di rinnovo
+    series = costs.monthly_series(today)
+    fig = px.bar(
+        x=series.index,
+        y=series.values,
+        title="Spesa prevista nei prossimi 12 mesi",
+        labels={"x": "", "y": "€"},
+        color_discrete_sequence=["#1cc88a"]
+    )
+    st.plotly_chart(fig, width="stretch")
 
 # 4. Modulo Calendario
+CALENDAR_VIEWS = {"Mese": 1, "3 mesi": 3, "6 mesi": 6, "Anno": 12}
+WEEKDAY_LABELS = ["Lun", "Mar", "Mer", "Gio", "Ven", "Sab", "Dom"]
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+def build_month_calendar(events, year, month, today):
+    """HTML del mese con gli eventi di ogni giorno"""
+    events_by_day = {}
+    for event in events:
+        events_by_day.setdefault(event["date"].day, []).append(event)
+    
+    # Creiamo l'HTML del calendario, una cella alla volta con i template precompilati
+    weeks = []
+    for week in calendar.monthcalendar(year, month):
+        cells = []
+        for day in week:
+            if day == 0:
+                # Giorno vuoto (non fa parte del mese)
+                cells.append("<td></td>")
+                continue
+            
+            day_events = []
+            for event in events_by_day.get(day, []):
+                if event["type"] == "subscription":
+                    day_events.append(templates.CALENDAR_EVENT.render(
+                        event_class="", title=f"{event['title']} - {event['cost']:.2f}€"))
+                else:
+                    day_events.append(templates.CALENDAR_EVENT.render(event_class="urgent", title=event["title"]))
+            
+            is_today = today == date(year, month, day)
+            cells.append(templates.CALENDAR_DAY.render(day_class="today" if is_today else "", day=day,
+                                                       events=templates.join(day_events)))
+        weeks.append(f"<tr>{''.join(cells)}</tr>")
+    
+    return templates.CALENDAR.render(title=f"{calendar.month_name[month]} {year}", weeks=templates.join(weeks))
+
+def calendar_heatmaps(summary, start, end):
+    """Griglie settimane x giorni della settimana con numero di eventi e costo dei rinnovi"""
+    days = np.arange(start, end + timedelta(days=1), dtype="datetime64[D]")
+    offsets = (days - np.datetime64(start, "D")).astype(int) + start.weekday()
+    weeks = offsets // 7
+    weekdays = offsets % 7
+    
+    counts = np.full((7, weeks[-1] + 1), np.nan)
+    costs = np.full((7, weeks[-1] + 1), np.nan)
+    labels = np.full((7, weeks[-1] + 1), "", dtype=object)
+    for day, week, weekday in zip(days.tolist(), weeks, weekdays):
+        deadlines, renewals, cost = summary.get(day, (0, 0, 0))
+        counts[weekday, week] = deadlines + renewals
+        costs[weekday, week] = cost
+        labels[weekday, week] = f"{day:%d/%m/%Y}<br>{deadlines} scadenze, {renewals} rinnovi"
+    
+    # Sull'asse x l'inizio di ogni settimana (il lunedì, anche se fuori dal periodo)
+    first_monday = start - timedelta(days=start.weekday())
+    x = [(first_monday + timedelta(weeks=int(w))).strftime("%d/%m") for w in range(weeks[-1] + 1)]
+    
+    def heatmap(z, colorscale, hover):
+        fig = go.Figure(go.Heatmap(z=z, x=x, y=WEEKDAY_LABELS, text=labels, colorscale=colorscale, xgap=2, ygap=2,
+                                   hovertemplate=hover + "<extra></extra>"))
+        fig.update_layout(height=260, margin=dict(l=10, r=10, t=10, b=10), yaxis_autorange="reversed")
+        return fig
+    
+    return (heatmap(counts, "Blues", "%{text}"),
+            heatmap(costs, "Oranges", "%{text}<br>Rinnovi: %{z:.2f} €"))
+
+@fragment("calendar")
 def generate_calendar():
-    st.markdown("<h2>Calendario scadenze e rinnovi</h2>", unsafe_allow_html=True)
+    send_html("<h2>Calendario scadenze e rinnovi</h2>")
+    store = get_store()
+    tenant_id = current_tenant_id()
+    today = datetime.now().date()
     
-    # Selezione mese/anno
-    col1, col2 = st.columns(2)
+    # Selezione vista, anno e mese di partenza
+    col1, col2, col3 = st.columns(3)
     
     with col1:
-        current_year = datetime.now().year
-        year_options = list(range(current_year, current_year + 3))
-        selected_year = st.selectbox("Anno", year_options)
+        view = st.selectbox("Vista", list(CALENDAR_VIEWS))
+        months = CALENDAR_VIEWS[view]
     
     with col2:
+        # Gli anni selezionabili coprono tutte le voci del tenant, oltre ai prossimi due anni
+        first_year, last_year = cached("calendar_years", (), lambda: store.calendar_years(tenant_id)) \
+            or (today.year, today.year)
+        year_options = list(range(min(first_year, today.year), max(last_year, today.year + 2) + 1))
+        selected_year = st.selectbox("Anno", year_options, index=year_options.index(today.year))
+    
+    with col3:
         month_options = list(range(1, 13))
         month_names = [calendar.month_name[m] for m in month_options]
-        selected_month_name = st.selectbox("Mese", month_names)
-        selected_month = month_options[month_names.index(selected_month_name)]
-    
-    # Generiamo il calendario
-    cal = calendar.monthcalendar(selected_year, selected_month)
-    
-    # Otteniamo tutti gli eventi del mese selezionato
-    events = []
-    
-    # Aggiungiamo le scadenze
-    for deadline in st.session_state.deadlines:
-        if deadline["date"].year == selected_year and deadline["date"].month == selected_month:
-            events.append({
-                "day": deadline["date"].day,
-                "title": deadline["title"],
-                "type": "deadline",
-                "id": deadline["id"],
-                "category": deadline["category"]
-            })
-    
-    # Aggiungiamo i rinnovi degli abbonamenti
-    for sub in st.session_state.subscriptions:
-        if sub["renewal_date"].year == selected_year and sub["renewal_date"].month == selected_month:
-            events.append({
-                "day": sub["renewal_date"].day,
-                "title": f"Rinnovo {sub['name']}",
-                "type": "subscription",
-                "id": sub["id"],
-                "cost": sub["cost"]
-            })
-    
-    # Creiamo l'HTML del calendario
-    week_days = ["Lun", "Mar", "Mer", "Gio", "Ven", "Sab", "Dom"]
-    
-    calendar_html = f"""
-    <h3 style="text-align: center;">{calendar.month_name[selected_month]} {selected_year}</h3>
-    <table class="calendar">
-        <tr>
-    """
-    
-    for day in week_days:
-        calendar_html += f"<th>{day}</th>"
-    
-    calendar_html += "</tr>"
-    
-    # Aggiungiamo le settimane
-    for week in cal:
-        calendar_html += "<tr>"
-        
-        for day in week:
-            if day == 0:
-                # Giorno vuoto (non fa parte del mese)
-                calendar_html += "<td></td>"
-            else:
-                # Troviamo gli eventi di questo giorno
-                day_events = [e for e in events if e["day"] == day]
-                
-                # Impostiamo uno stile se oggi
-                is_today = (datetime.now().day == day and 
-                            datetime.now().month == selected_month and 
-                            datetime.now().year == selected_year)
-                
-                today_style = "background-color: #e8f4f8; font-weight: bold;"
-                
-                calendar_html += f"<td style='{today_style if is_today else ''}'>"
-                calendar_html += f"<div class='calendar-day'>{day}</div>"
-                
-                # Aggiungiamo gli eventi
-                for event in day_events:
-                    event_class = "calendar-event urgent" if event["type"] == "deadline" else "calendar-event"
-                    event_title = event["title"]
-                    
-                    if event["type"] == "subscription":
-                        event_title += f" - {event['cost']:.2f}€"
-                    
-                    calendar_html += f"<div class='{event_class}'>{event_title}</div>"
-                
-                calendar_html += "</td>"
-        
-        calendar_html += "</tr>"
+        selected_month_name = st.selectbox("Mese", month_names, disabled=view == "Anno")
+        selected_month = 1 if view == "Anno" else month_options[month_names.index(selected_month_name)]
     
-    calendar_html += "</table>"
+    start = date(selected_year, selected_month, 1)
+    end = add_months(start, months) - timedelta(days=1)
     
-    st.markdown(calendar_html, unsafe_allow_html=True)
+    if months == 1:
+        # Il mese legge dall'archivio solo le proprie voci; l'HTML viene ricostruito solo quando
+        # cambiano i dati (o il giorno corrente)
+        with timed("generate_calendar.build"):
+            calendar_html = cached("calendar", (start, today), lambda: build_month_calendar(
+                store.calendar_events(tenant_id, start, end), selected_year, selected_month, today))
+        
+        send_html(calendar_html)
+        
+        # Legenda
+        send_html(templates.CALENDAR_LEGEND)
+    else:
+        # Più mesi: una sola query aggregata per giorno, disegnata come heatmap
+        with timed("generate_calendar.summary"):
+            summary = cached("calendar_summary", (start, end), lambda: store.calendar_summary(tenant_id, start, end))
+        
+        deadlines = sum(s[0] for s in summary.values())
+        renewals = sum(s[1] for s in summary.values())
+        cost = sum(s[2] for s in summary.values())
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            send_html(templates.METRIC.render(value=deadlines, label="Scadenze"))
+        with col2:
+            send_html(templates.METRIC.render(value=renewals, label="Rinnovi"))
+        with col3:
+            send_html(templates.COST_METRIC.render(value=cost, label="Costo dei rinnovi"))
+        
+        counts_fig, costs_fig = calendar_heatmaps(summary, start, end)
+        st.subheader(f"Eventi per giorno ({start:%d/%m/%Y} - {end:%d/%m/%Y})")
+        st.plotly_chart(counts_fig, width="stretch")
+        st.subheader("Costo dei rinnovi per giorno")
+        st.plotly_chart(costs_fig, width="stretch")
     
-    # Legenda
-    st.markdown("""
-    <div style='margin-top: 20px;'>
-        <span class='calendar-event' style='display: inline-block; margin-right: 10px;'>Abbonamento</span>
-        <span class='calendar-event urgent' style='display: inline-block;'>Scadenza</span>
-    </div>
-    """, unsafe_allow_html=True)
+    # Esportazione iCalendar: il file viene generato solo quando si preme il pulsante
+    with st.expander("Esporta calendario (.ics)"):
+        st.download_button("Scarica il calendario", data=lambda: b"".join(ics_feed(store, tenant_id)),
+                           file_name="contractme.ics", mime="text/calendar", key="ics_download")
+        if ICS_PORT:
+            st.write("Indirizzo per abbonarsi al calendario da Google Calendar, Outlook o Calendario di Apple:")
+            st.code(ics_url(store, tenant_id), language=None)
 
 # 5. Modulo Assistente AI
+@fragment("ai_assistant")
 def ai_assistant():
-    st.markdown("<h2>Assistente AI</h2>", unsafe_allow_html=True)
+    send_html("<h2>Assistente AI</h2>")
     
     # Selezione del documento
-    document_options = ["Nessun documento selezionato"] + [doc["name"] for doc in st.session_state.documents]
+    document_options = ["Nessun documento selezionato"] + [doc.name for doc in st.session_state.documents]
     selected_doc_name = st.selectbox("Seleziona un documento per fare domande", document_options)
     
     selected_doc = None
     if selected_doc_name != "Nessun documento selezionato":
         for doc in st.session_state.documents:
-            if doc["name"] == selected_doc_name:
+            if doc.name == selected_doc_name:
                 selected_doc = doc
                 break
     
     # Visualizziamo la cronologia della chat
-    st.markdown("<h3>Cronologia chat</h3>", unsafe_allow_html=True)
-    
-    for chat in st.session_state.chat_history:
-        if chat["role"] == "user":
-            st.markdown(f"""
-            <div class="chat-message chat-user">
-                <strong>Tu:</strong> {chat["content"]}
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            st.markdown(f"""
-            <div class="chat-message chat-assistant">
-                <strong>Assistente AI:</strong> {chat["content"]}
-            </div>
-            """, unsafe_allow_html=True)
+    send_html("<h3>Cronologia chat</h3>")
+    
+    def render_chat(messages):
+        # Un solo blocco HTML per tutta la cronologia
+        send_html(templates.join(
+            templates.CHAT_MESSAGE.render(role=chat["role"], speaker="Tu" if chat["role"] == "user" else "Assistente AI",
+                                          content=chat["content"])
+            for chat in messages
+        ))
+    
+    # I messaggi più vecchi sono su disco e vengono letti solo se richiesti
+    if st.session_state.chat_archived and st.toggle(f"Mostra i messaggi precedenti ({st.session_state.chat_archived})"):
+        render_chat(archived_chat())
+    render_chat(st.session_state.chat_history)
     
     # Input per l'utente
     user_input = st.text_input("Scrivi la tua domanda...")
@@ -887,7 +4266,7 @@ def ai_assistant():
         if st.button("Invia domanda"):
             if user_input:
                 # Aggiungiamo la domanda alla chat
-                st.session_state.chat_history.append({
+                append_chat({
                     "role": "user",
                     "content": user_input
                 })
@@ -896,18 +4275,18 @@ def ai_assistant():
                 ai_response = simulate_ai_response(user_input, selected_doc)
                 
                 # Aggiungiamo la risposta alla chat
-                st.session_state.chat_history.append({
+                append_chat({
                     "role": "assistant",
                     "content": ai_response
                 })
                 
-                st.rerun()
+                rerun_fragment()
     
     with col2:
         if st.button("Cancella chat"):
-            st.session_state.chat_history = []
+            clear_chat()
             st.success("Cronologia chat cancellata!")
-            st.rerun()
+            rerun_fragment()
 
 def simulate_ai_response(user_input, doc):
     """Simula una risposta AI basata sul documento selezionato"""
@@ -921,22 +4300,28 @@ def simulate_ai_response(user_input, doc):
     ]
     
     document_responses = [
-        f"Ho esaminato il documento '{doc['name']}'. Cosa vuoi sapere nello specifico?",
-        f"Il documento '{doc['name']}' è nella categoria '{doc['category']}'. Posso aiutarti a interpretarlo.",
-        f"Questo documento è stato caricato il {doc['upload_date'].strftime('%d/%m/%Y')}. Come posso aiutarti?",
-        f"Sto analizzando '{doc['name']}'. Ricorda che questa è una simulazione di assistente AI."
+        f"Ho esaminato il documento '{doc.name}'. Cosa vuoi sapere nello specifico?",
+        f"Il documento '{doc.name}' è nella categoria '{doc.category}'. Posso aiutarti a interpretarlo.",
+        f"Questo documento è stato caricato il {doc.upload_date.strftime('%d/%m/%Y')}. Come posso aiutarti?",
+        f"Sto analizzando '{doc.name}'. Ricorda che questa è una simulazione di assistente AI."
     ]
     
     # Risposte specifiche basate su parole chiave nella domanda
     if "scadenza" in user_input.lower() or "rinnovo" in user_input.lower():
-        if doc and doc.get("expiry_date"):
-            return f"La scadenza per '{doc['name']}' è prevista per il {doc['expiry_date'].strftime('%d/%m/%Y')}."
+        if doc and doc.expiry_date:
+            return f"La scadenza per '{doc.name}' è prevista per il {doc.expiry_date.strftime('%d/%m/%Y')}."
         else:
             return "Non ho trovato informazioni sulle scadenze nel documento selezionato."
     
     elif "contenuto" in user_input.lower() or "cosa" in user_input.lower() and "dice" in user_input.lower():
-        if doc and doc["type"] == "text":
-            preview = doc["preview"]
+        if doc and doc.type == "text":
+            preview = document_preview(doc)
+        elif doc:
+            # Per le scansioni si usa il testo riconosciuto dall'OCR, se disponibile
+            preview = get_store().document_text(current_tenant_id(), doc.id)
+        else:
+            preview = None
+        if preview:
             # Limitiamo la lunghezza della risposta
             if len(preview) > 300:
                 preview = preview[:300] + "..."
@@ -946,7 +4331,7 @@ def simulate_ai_response(user_input, doc):
     
     elif "categoria" in user_input.lower():
         if doc:
-            return f"Il documento '{doc['name']}' appartiene alla categoria '{doc['category']}'."
+            return f"Il documento '{doc.name}' appartiene alla categoria '{doc.category}'."
         else:
             return "Non hai selezionato un documento."
     
@@ -958,126 +4343,102 @@ def simulate_ai_response(user_input, doc):
 
 # 6. Dashboard
 def dashboard():
-    st.markdown("<h1>Dashboard</h1>", unsafe_allow_html=True)
+    send_html("<h1>Dashboard</h1>")
     
     # Metriche principali
     col1, col2, col3, col4 = st.columns(4)
     
-    # Calcolo delle metriche
-    total_docs = len(st.session_state.documents)
-    
-    # Documenti caricati negli ultimi 7 giorni
-    today = datetime.now().date()
-    week_ago = today - timedelta(days=7)
-    docs_last_week = sum(1 for doc in st.session_state.documents if doc["upload_date"] >= week_ago)
-    
-    # Numero di categorie utilizzate
-    used_categories = set()
-    for doc in st.session_state.documents:
-        used_categories.add(doc["category"])
-    
-    # Scadenze imminenti
-    week_later = today + timedelta(days=7)
-    upcoming_deadlines = sum(1 for d in st.session_state.deadlines if today <= d["date"] <= week_later)
+    with timed("dashboard.scan"):
+        count("records_scanned", len(st.session_state.documents) + len(st.session_state.deadlines))
+        
+        # Calcolo delle metriche
+        total_docs = len(st.session_state.documents)
+        
+        # Documenti caricati negli ultimi 7 giorni
+        today = datetime.now().date()
+        week_ago = today - timedelta(days=7)
+        docs_last_week = sum(1 for doc in st.session_state.documents if doc.upload_date >= week_ago)
+        
+        # Numero di categorie utilizzate, dall'indice delle categorie
+        used_categories = st.session_state.category_index.documents
+        
+        # Scadenze future ordinate per data, condivise dai grafici e dalle liste sottostanti
+        future_deadlines = cached_order("future_deadlines", today, st.session_state.deadlines,
+                                        lambda deadlines: sorted([d for d in deadlines if d.status not in ("expired", "done")],
+                                                                 key=lambda x: x.date))
+        
+        # Scadenze imminenti
+        upcoming_deadlines = sum(1 for d in future_deadlines if d.status in ("urgent", "imminent"))
     
     # Visualizzazione metriche
-    with col1:
-        st.markdown(f"""
-        <div class="metric">
-            <div class="metric-value">{total_docs}</div>
-            <div class="metric-label">Documenti totali</div>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    with col2:
-        st.markdown(f"""
-        <div class="metric">
-            <div class="metric-value">{docs_last_week}</div>
-            <div class="metric-label">Nuovi documenti (7 giorni)</div>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    with col3:
-        st.markdown(f"""
-        <div class="metric">
-            <div class="metric-value">{len(used_categories)}</div>
-            <div class="metric-label">Categorie utilizzate</div>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    with col4:
-        st.markdown(f"""
-        <div class="metric">
-            <div class="metric-value">{upcoming_deadlines}</div>
-            <div class="metric-label">Scadenze imminenti</div>
-        </div>
-        """, unsafe_allow_html=True)
+    for col, value, label in [(col1, total_docs, "Documenti totali"),
+                              (col2, docs_last_week, "Nuovi documenti (7 giorni)"),
+                              (col3, len(used_categories), "Categorie utilizzate"),
+                              (col4, upcoming_deadlines, "Scadenze imminenti")]:
+        with col:
+            send_html(templates.METRIC.render(value=value, label=label))
     
     # Grafici
     col1, col2 = st.columns(2)
     
     with col1:
-        st.markdown("<h3>Distribuzione documenti per categoria</h3>", unsafe_allow_html=True)
+        send_html("<h3>Distribuzione documenti per categoria</h3>")
         
         if st.session_state.documents:
-            # Conteggio documenti per categoria
-            category_counts = {}
-            for doc in st.session_state.documents:
-                category = doc["category"]
-                if category in category_counts:
-                    category_counts[category] += 1
-                else:
-                    category_counts[category] = 1
+            # Conteggi per categoria mantenuti dall'indice
+            category_counts = st.session_state.category_index.document_counts()
             
             # Creazione grafico
-            fig = px.pie(
-                names=list(category_counts.keys()),
-                values=list(category_counts.values()),
-                title="Documenti per categoria",
-                hole=0.4,
-                color_discrete_sequence=px.colors.qualitative.Set3
-            )
-            
-            fig.update_traces(textposition='inside', textinfo='percent+label')
-            st.plotly_chart(fig, use_container_width=True)
+            with timed("dashboard.category_chart"):
+                fig = px.pie(
+                    names=[st.session_state.categories.path(name) for name in category_counts],
+                    values=list(category_counts.values()),
+                    title="Documenti per categoria",
+                    hole=0.4,
+                    color_discrete_sequence=px.colors.qualitative.Set3
+                )
+                
+                fig.update_traces(textposition='inside', textinfo='percent+label')
+            st.plotly_chart(fig, width="stretch")
         else:
             st.info("Non hai ancora caricato documenti. Il grafico apparirà quando aggiungerai documenti.")
     
     with col2:
-        st.markdown("<h3>Prossime scadenze</h3>", unsafe_allow_html=True)
+        send_html("<h3>Prossime scadenze</h3>")
         
         if st.session_state.deadlines:
             # Prossime scadenze ordinate per data
-            upcoming = sorted([d for d in st.session_state.deadlines if d["date"] >= today], 
-                              key=lambda x: x["date"])[:10]  # Mostriamo le prossime 10
+            upcoming = future_deadlines[:10]  # Mostriamo le prossime 10
             
             if upcoming:
                 deadline_data = []
                 for d in upcoming:
-                    days_left = (d["date"] - today).days
+                    days_left = (d.date - today).days
                     deadline_data.append({
-                        "Titolo": d["title"] if len(d["title"]) <= 20 else d["title"][:17] + "...",
+                        "Titolo": d.title if len(d.title) <= 20 else d.title[:17] + "...",
                         "Giorni": days_left,
-                        "Data": d["date"].strftime("%d/%m/%Y")
+                        "Data": d.date.strftime("%d/%m/%Y")
                     })
                 
-                df = pd.DataFrame(deadline_data)
+                with timed("dashboard.dataframe"):
+                    df = pd.DataFrame(deadline_data)
                 
                 # Creazione grafico a barre orizzontale
-                fig = px.bar(
-                    df,
-                    y="Titolo",
-                    x="Giorni",
-                    orientation='h',
-                    title="Giorni rimanenti alle prossime scadenze",
-                    color="Giorni",
-                    color_continuous_scale=["#e74a3b", "#f6c23e", "#1cc88a"],
-                    text="Data",
-                    labels={"Titolo": "", "Giorni": "Giorni rimanenti"}
-                )
-                
-                fig.update_layout(yaxis={'categoryorder': 'total ascending'})
-                st.plotly_chart(fig, use_container_width=True)
+                with timed("dashboard.deadline_chart"):
+                    fig = px.bar(
+                        df,
+                        y="Titolo",
+                        x="Giorni",
+                        orientation='h',
+                        title="Giorni rimanenti alle prossime scadenze",
+                        color="Giorni",
+                        color_continuous_scale=["#e74a3b", "#f6c23e", "#1cc88a"],
+                        text="Data",
+                        labels={"Titolo": "", "Giorni": "Giorni rimanenti"}
+                    )
+                    
+                    fig.update_layout(yaxis={'categoryorder': 'total ascending'})
+                st.plotly_chart(fig, width="stretch")
             else:
                 st.info("Non ci sono scadenze future.")
         else:
@@ -1087,69 +4448,46 @@ def dashboard():
     col1, col2 = st.columns(2)
     
     with col1:
-        st.markdown("<h3>Documenti recenti</h3>", unsafe_allow_html=True)
+        send_html("<h3>Documenti recenti</h3>")
         
         if st.session_state.documents:
             # Ultimi 5 documenti caricati
             recent_docs = sorted(st.session_state.documents, 
-                                 key=lambda x: x["upload_date"], 
+                                 key=lambda x: x.upload_date, 
                                  reverse=True)[:5]
             
-            for doc in recent_docs:
-                st.markdown(f"""
-                <div class="card" style="margin-bottom: 10px; padding: 10px;">
-                    <div style="display: flex; justify-content: space-between; align-items: center;">
-                        <span style="font-weight: bold;">{doc["name"]}</span>
-                        <span style="color: #7b8a8b;">{doc["upload_date"].strftime('%d/%m/%Y')}</span>
-                    </div>
-                    <div style="color: #4e73df; font-size: 13px;">{doc["category"]}</div>
-                </div>
-                """, unsafe_allow_html=True)
+            send_html(templates.join(
+                templates.RECENT_DOCUMENT.render(name=doc.name, upload_date=doc.upload_date, category=doc.category)
+                for doc in recent_docs
+            ))
         else:
             st.info("Non hai ancora caricato documenti.")
     
     with col2:
-        st.markdown("<h3>Prossime 5 scadenze</h3>", unsafe_allow_html=True)
+        send_html("<h3>Prossime 5 scadenze</h3>")
         
         if st.session_state.deadlines:
             # Prossime 5 scadenze
-            next_deadlines = sorted([d for d in st.session_state.deadlines if d["date"] >= today], 
-                                    key=lambda x: x["date"])[:5]
+            next_deadlines = future_deadlines[:5]
             
             if next_deadlines:
-                for deadline in next_deadlines:
-                    days_left = (deadline["date"] - today).days
-                    status_color = "#e74a3b" if days_left <= 3 else "#f6c23e" if days_left <= 7 else "#1cc88a"
-                    
-                    st.markdown(f"""
-                    <div class="card" style="margin-bottom: 10px; padding: 10px; border-left: 5px solid {status_color};">
-                        <div style="display: flex; justify-content: space-between; align-items: center;">
-                            <span style="font-weight: bold;">{deadline["title"]}</span>
-                            <span style="color: {status_color}; font-weight: bold;">{days_left} giorni</span>
-                        </div>
-                        <div>{deadline["date"].strftime('%d/%m/%Y')}</div>
-                    </div>
-                    """, unsafe_allow_html=True)
+                send_html(templates.join(
+                    templates.NEXT_DEADLINE.render(title=deadline.title, status=deadline.status,
+                                                   days=(deadline.date - today).days, date=deadline.date)
+                    for deadline in next_deadlines
+                ))
             else:
                 st.info("Non ci sono scadenze future.")
         else:
             st.info("Non hai ancora aggiunto scadenze.")
 
-# Main dell'applicazione
-def main():
-    # Inizializzazione
-    load_css()
-    init_session_state()
-    
-    # Creazione della sidebar per la navigazione
-    page = create_sidebar()
-    
-    # Gestione pagine
+# Gestione pagine
+def render_page(page):
     if page == "Dashboard":
         dashboard()
     
     elif page == "Documenti":
-        st.markdown("<h1>Gestione Documenti</h1>", unsafe_allow_html=True)
+        send_html("<h1>Gestione Documenti</h1>")
         
         # Tab per upload o visualizzazione
         tab1, tab2 = st.tabs(["Carica documenti", "Visualizza documenti"])
@@ -1161,7 +4499,7 @@ def main():
             view_documents()
     
     elif page == "Scadenze":
-        st.markdown("<h1>Gestione Scadenze</h1>", unsafe_allow_html=True)
+        send_html("<h1>Gestione Scadenze</h1>")
         
         # Tab per aggiunta o visualizzazione
         tab1, tab2 = st.tabs(["Aggiungi scadenza", "Visualizza scadenze"])
@@ -1173,7 +4511,7 @@ def main():
             view_deadlines()
     
     elif page == "Abbonamenti":
-        st.markdown("<h1>Gestione Abbonamenti</h1>", unsafe_allow_html=True)
+        send_html("<h1>Gestione Abbonamenti</h1>")
         
         # Tab per aggiunta o visualizzazione
         tab1, tab2 = st.tabs(["Aggiungi abbonamento", "Visualizza abbonamenti"])
@@ -1185,12 +4523,187 @@ def main():
             view_subscriptions()
     
     elif page == "Calendario":
-        st.markdown("<h1>Calendario</h1>", unsafe_allow_html=True)
+        send_html("<h1>Calendario</h1>")
         generate_calendar()
     
     elif page == "Assistente AI":
-        st.markdown("<h1>Assistente AI</h1>", unsafe_allow_html=True)
+        send_html("<h1>Assistente AI</h1>")
         ai_assistant()
 
+# Main dell'applicazione
+def main():
+    # Durante la rerun la sessione non può essere liberata perché inattiva
+    with session_activity():
+        # Traccia dei tempi di questa rerun
+        st.session_state.rerun_trace = []
+        
+        try:
+            with timed("rerun"):
+                # Inizializzazione
+                load_css()
+                init_session_state()
+                
+                if st.session_state.user is None:
+                    login_page()
+                    return
+                
+                if os.environ.get("CONTRACTME_SCHEDULER") == "thread":
+                    get_scheduler()
+                if ICS_PORT:
+                    get_ics_server()
+                
+                with timed("sync_session_state"):
+                    sync_session_state()
+                
+                # Creazione della sidebar per la navigazione
+                with timed("create_sidebar"):
+                    page = create_sidebar()
+                
+                run_page(page, lambda: render_page(page))
+        finally:
+            st.session_state.last_rerun_trace = st.session_state.rerun_trace
+            account_session_memory()
+            export_metrics_file()
+        
+        if st.query_params.get("admin") == "1" and st.session_state.user["role"] == "owner":
+            admin_panel()
+
+# Riga di comando per backup e migrazioni tra server (fuori da `streamlit run`)
+def cli(args):
+    if args == ["scheduler"]:
+        # Processo dedicato ai promemoria: controlla le scritture degli altri processi ogni 5 minuti
+        scheduler = ReminderScheduler(get_store(), build_channels(), refresh_interval=300)
+        scheduler.load()
+        print(f"Scheduler avviato con {len(scheduler._heap)} promemoria in coda.")
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            scheduler.stop()
+        return 0
+    
+    if args == ["ics-server"]:
+        # Processo dedicato al feed iCalendar, sulla porta CONTRACTME_ICS_PORT
+        server = start_ics_server(get_store(), ICS_PORT or 8765)
+        print(f"Feed iCalendar in ascolto sulla porta {server.server_address[1]}.")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return 0
+    
+    if len(args) == 2 and args[0] == "images":
+        # Normalizza le immagini caricate prima dell'introduzione della normalizzazione
+        store = get_store()
+        tenant_id = store.find_tenant(args[1])
+        if tenant_id is None:
+            print(f"Spazio di lavoro '{args[1]}' non trovato.")
+            return 1
+        total_before = total_after = 0
+        for doc_id, name, before, after in normalize_stored_images(store, tenant_id):
+            print(f"{doc_id:>6} {name}: {before:,} → {after:,} byte ({before - after:,} risparmiati)")
+            total_before += before
+            total_after += after
+        print(f"images: {total_before:,} → {total_after:,} byte")
+        return 0
+    
+    if len(args) == 2 and args[0] == "duplicates":
+        # Calcola le firme mancanti ed elenca i gruppi di quasi duplicati
+        store = get_store()
+        tenant_id = store.find_tenant(args[1])
+        if tenant_id is None:
+            print(f"Spazio di lavoro '{args[1]}' non trovato.")
+            return 1
+        print(f"duplicates: {fingerprint_stored_documents(store, tenant_id)} firme calcolate")
+        with store.pool.connection() as conn:
+            names = dict(conn.execute("SELECT id, name FROM documents WHERE tenant_id = ?", (tenant_id,)).fetchall())
+        for group in duplicate_groups(store, tenant_id):
+            print("  " + ", ".join(f"{doc_id} {names.get(doc_id, '?')}" for doc_id in group))
+        return 0
+    
+    if len(args) == 2 and args[0] == "ocr":
+        # Estrae il testo dei documenti non ancora indicizzati e attende che la coda si svuoti
+        store = get_store()
+        tenant_id = store.find_tenant(args[1])
+        if tenant_id is None:
+            print(f"Spazio di lavoro '{args[1]}' non trovato.")
+            return 1
+        if not OCR_ENABLED or not (ocr.available("image") or ocr.available("pdf")):
+            print("OCR non disponibile: servono pytesseract e Tesseract (e PyMuPDF per i PDF).")
+            return 1
+        queue = OcrQueue(store)
+        print(f"ocr: {queue.reindex(tenant_id)} documenti in coda")
+        start = time.perf_counter()
+        while (stats := queue.stats())["documents_waiting"] or stats["queue_depth"]:
+            print(f"  {stats['documents_waiting']} documenti e {stats['queue_depth']} pagine in coda, "
+                  f"{stats['pages_per_minute']:.1f} pagine/min")
+            time.sleep(5)
+        queue.shutdown()
+        print(f"ocr: completato in {time.perf_counter() - start:.1f} s, {stats['failed']} errori")
+        return 0
+    
+    if len(args) == 2 and args[0] == "verify":
+        # Confronta i dati attuali con quelli ricostruiti dall'ultima istantanea e dal registro
+        store = get_store()
+        tenant_id = store.find_tenant(args[1])
+        if tenant_id is None:
+            print(f"Spazio di lavoro '{args[1]}' non trovato.")
+            return 1
+        differences = verify_event_log(store, tenant_id)
+        for table, key in differences:
+            print(f"  {table} {key}")
+        print(f"verify: {len(differences)} differenze, {store.event_log_stats(tenant_id)}")
+        return 1 if differences else 0
+    
+    if len(args) == 4 and args[0] == "restore":
+        # Ricrea i dati di un istante passato (ora locale, es. 2024-06-01T18:30) in un nuovo spazio di lavoro
+        store = get_store()
+        tenant_id = store.find_tenant(args[1])
+        if tenant_id is None:
+            print(f"Spazio di lavoro '{args[1]}' non trovato.")
+            return 1
+        username = input("Proprietario del nuovo spazio di lavoro: ")
+        password = getpass.getpass("Password: ")
+        start = time.perf_counter()
+        try:
+            counts = restore_tenant(store, tenant_id, datetime.fromisoformat(args[2]), args[3], username, password)
+        except ValueError as e:
+            print(e)
+            return 1
+        print(f"restore: {counts} in {time.perf_counter() - start:.1f} s")
+        return 0
+    
+    if len(args) != 3 or args[0] not in ["export", "import", "ics"]:
+        print("Uso: python ContractME.py export|import <spazio di lavoro> <archivio.tar>")
+        print("     python ContractME.py ics <spazio di lavoro> <calendario.ics>")
+        print("     python ContractME.py images|ocr|duplicates|verify <spazio di lavoro>")
+        print("     python ContractME.py restore <spazio di lavoro> <istante> <nuovo spazio di lavoro>")
+        print("     python ContractME.py scheduler")
+        print("     python ContractME.py ics-server")
+        return 2
+    
+    command, tenant_name, path = args
+    store = get_store()
+    tenant_id = store.find_tenant(tenant_name)
+    if tenant_id is None:
+        print(f"Spazio di lavoro '{tenant_name}' non trovato.")
+        return 1
+    
+    start = time.perf_counter()
+    if command == "ics":
+        with open(path, "wb") as f:
+            size = sum(f.write(chunk) for chunk in ics_feed(store, tenant_id))
+        print(f"ics: {size} byte in {time.perf_counter() - start:.1f} s")
+        return 0
+    if command == "export":
+        with open(path, "wb") as f:
+            counts = export_tenant(store, tenant_id, f)
+    else:
+        with open(path, "rb") as f:
+            counts = import_tenant(store, tenant_id, f)
+    print(f"{command}: {counts} in {time.perf_counter() - start:.1f} s")
+    return 0
+
 if __name__ == '__main__':
+    if not st.runtime.exists() and len(sys.argv) > 1:
+        sys.exit(cli(sys.argv[1:]))
     main()
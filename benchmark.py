@@ -0,0 +1,213 @@
+"""Benchmark delle pagine di ContractME con dati sintetici.
+
+Esempi:
+    python benchmark.py --scales 1000,10000
+    python benchmark.py --scales 1000 --save-baseline
+    python benchmark.py --scales 1000 --baseline benchmark_baseline.json --tolerance 0.2
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ContractME.py")
+
+PAGES = {
+    "dashboard": "Dashboard",
+    "view_documents": "Documenti",
+    "view_deadlines": "Scadenze",
+    "view_subscriptions": "Abbonamenti",
+    "generate_calendar": "Calendario",
+    "ai_assistant": "Assistente AI"
+}
+
+CATEGORIES = ["Casa", "Lavoro", "Salute", "Finanza", "Istruzione", "Altro"]
+SUBSCRIPTION_TYPES = ["Streaming", "Servizi", "Utility", "Palestra", "Software", "Altro"]
+
+# Dimensioni tipiche dei file caricati: (tipo, estensione, mediana in byte, peso)
+FILE_PROFILES = [
+    ("pdf", "pdf", 350_000, 0.5),
+    ("image", "png", 900_000, 0.3),
+    ("text", "txt", 6_000, 0.2)
+]
+
+WORDS = ("contratto canone rinnovo clausola recesso fornitura garanzia pagamento rata scadenza "
+         "assicurazione polizza locazione utenze servizio durata penale disdetta importo").split()
+
+def synthetic_blob(rng, doc_type, median):
+    # Dimensione log-normale attorno alla mediana, come per i file reali
+    size = max(256, int(rng.lognormvariate(0, 0.6) * median))
+    if doc_type == "text":
+        words = [rng.choice(WORDS) for _ in range(size // 8)]
+        return " ".join(words).encode()[:size]
+    header = b"%PDF-1.7\n" if doc_type == "pdf" else b"\x89PNG\r\n\x1a\n"
+    return header + rng.randbytes(size - len(header))
+
+def populate(store, tenant_id, scale, distinct_blobs, seed):
+    """Riempie il tenant con `scale` documenti, scadenze e abbonamenti sintetici"""
+    rng = random.Random(seed)
+    today = datetime.now().date()
+
+    # Un insieme limitato di contenuti distinti, riutilizzati dai documenti (l'archivio li deduplica)
+    blobs = []
+    for _ in range(distinct_blobs):
+        doc_type, extension, median, _ = rng.choices(FILE_PROFILES, weights=[p[3] for p in FILE_PROFILES])[0]
+        data = synthetic_blob(rng, doc_type, median)
+        blobs.append((doc_type, extension, data, hashlib.sha256(data).hexdigest()))
+
+    documents, deadlines, subscriptions = [], [], []
+    for i in range(1, scale + 1):
+        doc_type, extension, _, sha256 = rng.choice(blobs)
+        upload_date = today - timedelta(days=rng.randint(0, 730))
+        expiry_date = today + timedelta(days=rng.randint(-60, 730)) if rng.random() < 0.4 else None
+        documents.append((tenant_id, i, f"Documento {i}", rng.choice(CATEGORIES), doc_type, sha256,
+                          upload_date.isoformat(), expiry_date.isoformat() if expiry_date else None,
+                          f"documento_{i}.{extension}"))
+
+        deadline_date = today + timedelta(days=rng.randint(-365, 730))
+        deadlines.append((tenant_id, i, f"Scadenza {i}", deadline_date.isoformat(),
+                          " ".join(rng.choice(WORDS) for _ in range(12)), rng.choice(CATEGORIES),
+                          rng.randint(1, scale) if rng.random() < 0.5 else None, None))
+
+        renewal_date = today + timedelta(days=rng.randint(0, 365))
+        subscriptions.append((tenant_id, i, f"Abbonamento {i}", rng.choice(SUBSCRIPTION_TYPES),
+                              renewal_date.isoformat(), round(rng.lognormvariate(2.5, 0.7), 2),
+                              " ".join(rng.choice(WORDS) for _ in range(8))))
+
+    with store.pool.transaction() as conn:
+        conn.executemany("INSERT OR IGNORE INTO blobs (tenant_id, sha256, data, size) VALUES (?, ?, ?, ?)",
+                         [(tenant_id, sha256, data, len(data)) for _, _, data, sha256 in blobs])
+        conn.executemany("INSERT INTO documents (tenant_id, id, name, category, type, blob_sha256, upload_date, "
+                         "expiry_date, filename) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", documents)
+        conn.executemany("INSERT INTO deadlines (tenant_id, id, title, date, description, category, document_id, "
+                         "subscription_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", deadlines)
+        conn.executemany("INSERT INTO subscriptions (tenant_id, id, name, type, renewal_date, cost, description) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)", subscriptions)
+        conn.execute("UPDATE tenants SET version = version + 1 WHERE id = ?", (tenant_id,))
+
+def synthetic_chat(turns):
+    chat = []
+    for i in range(turns):
+        chat.append({"role": "user", "content": f"Quando scade il contratto {i}?"})
+        chat.append({"role": "assistant", "content": "Non ho trovato informazioni sulle scadenze nel documento selezionato."})
+    return chat
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def bench_page(user, page_label, repeats, timeout):
+    """Misura le rerun di una pagina con AppTest, dopo una rerun di riscaldamento"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.session_state["user"] = user
+    at.session_state["chat_history"] = synthetic_chat(50)
+    at.run()
+    at.sidebar.radio[0].set_value(page_label).run()
+    if at.exception:
+        raise RuntimeError(f"{page_label}: {at.exception[0].message}")
+
+    latencies = []
+    fragments = {}
+    for _ in range(repeats):
+        start = time.perf_counter()
+        at.run()
+        latencies.append((time.perf_counter() - start) * 1000)
+        # Un'interazione dentro un frammento riesegue solo quello: il suo tempo nella traccia
+        # della rerun stima la latenza della rerun parziale, da confrontare con quella completa
+        for name, elapsed in at.session_state["last_rerun_trace"]:
+            if name.startswith("fragment."):
+                fragments.setdefault(name.removeprefix("fragment."), []).append(elapsed)
+
+    tracemalloc.start()
+    at.run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": max(latencies),
+        "peak_mb": peak / (1024 * 1024),
+        "fragments_p50_ms": {name: percentile(values, 50) for name, values in fragments.items()}
+    }
+
+def compare(results, baseline, tolerance):
+    """Restituisce le regressioni di p50 rispetto alla baseline"""
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if reference and result["p50_ms"] > reference["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{key}: p50 {result['p50_ms']:.1f} ms > baseline {reference['p50_ms']:.1f} ms "
+                               f"(+{tolerance:.0%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark delle pagine di ContractME")
+    parser.add_argument("--scales", default="1000", help="Numero di record per entità, separati da virgola")
+    parser.add_argument("--pages", default=",".join(PAGES), help="Pagine da misurare, separate da virgola")
+    parser.add_argument("--repeats", type=int, default=10, help="Rerun misurate per pagina")
+    parser.add_argument("--distinct-blobs", type=int, default=64, help="Contenuti distinti dei file sintetici")
+    parser.add_argument("--timeout", type=float, default=600, help="Timeout di una rerun (secondi)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="File JSON con i risultati")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="Baseline con cui confrontare")
+    parser.add_argument("--save-baseline", action="store_true", help="Salva i risultati come nuova baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Peggioramento ammesso del p50")
+    args = parser.parse_args()
+
+    # Ogni benchmark usa un archivio temporaneo, mai quello reale
+    os.environ["CONTRACTME_DATA_DIR"] = tempfile.mkdtemp(prefix="contractme_bench_")
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    import ContractME
+
+    store = ContractME.DataStore()
+    results = {}
+
+    for scale in [int(s) for s in args.scales.split(",")]:
+        user = store.create_tenant(f"bench-{scale}", f"bench-{scale}", "bench")
+        start = time.perf_counter()
+        populate(store, user["tenant_id"], scale, args.distinct_blobs, args.seed)
+        print(f"scala {scale}: dati generati in {time.perf_counter() - start:.1f} s")
+
+        for page in args.pages.split(","):
+            result = bench_page(user, PAGES[page], args.repeats, args.timeout)
+            results[f"{page}@{scale}"] = result
+            print(f"  {page:<20} p50 {result['p50_ms']:9.1f} ms  p95 {result['p95_ms']:9.1f} ms  "
+                  f"p99 {result['p99_ms']:9.1f} ms  picco {result['peak_mb']:8.1f} MB")
+            for name, p50 in result["fragments_p50_ms"].items():
+                print(f"    frammento {name:<20} p50 {p50:9.1f} ms (rerun completa {result['p50_ms']:.1f} ms)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline salvata in {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressioni rispetto alla baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("Nessuna regressione rispetto alla baseline.")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
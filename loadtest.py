@@ -0,0 +1,447 @@
+"""Prova di carico di ContractME con molte sessioni concorrenti.
+
+Avvia un server Streamlit su un archivio temporaneo con dati sintetici (vedi benchmark.py) e lo fa
+usare da utenti virtuali che parlano con il server come un browser: una connessione WebSocket per
+sessione, i valori dei widget inviati a ogni rerun, i file caricati con l'upload HTTP di Streamlit.
+Ogni utente accede e poi segue scenari di navigazione tra le pagine della sidebar, con una pausa
+di riflessione tra due interazioni. Il numero di utenti sale a gradini finché il server non satura,
+cioè finché aggiungere utenti non aumenta più le interazioni servite al secondo.
+
+Per ogni gradino: percentili della latenza di ogni pagina e azione (dall'invio della rerun alla
+fine dello script), interazioni al secondo, errori, CPU e memoria residente del server. Gli utenti
+virtuali girano in un solo processo asyncio, separato dal server: la sua CPU è riportata a parte.
+
+Esempi:
+    python loadtest.py --users 1,10,25,50,100 --duration 30
+    python loadtest.py --users 200 --scenarios upload:1 --output carico.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+
+import requests
+from websockets.asyncio.client import connect
+from websockets.exceptions import ConnectionClosed
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.Common_pb2 import UploadedFileInfo
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+from benchmark import APP_PATH, WORDS, percentile, populate
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+USERNAME = "carico-{}"
+PASSWORD = "carico"
+
+class InteractionError(Exception):
+    """Interazione fallita: eccezione dell'app, nessuna risposta del server o widget mancante"""
+
+    def __init__(self, name, message, seconds=0.0):
+        super().__init__(f"{name}: {message}")
+        self.name = name
+        self.seconds = seconds
+
+class VirtualUser:
+    """Una sessione del server usata come da un browser"""
+
+    def __init__(self, base_url, username, think, rng, record):
+        self.base_url = base_url
+        self.username = username
+        self.think = think
+        self.rng = rng
+        self.record = record
+        self.timeout = 60
+        self.session_id = None
+        self.websocket = None
+        self.elements = {}  # percorso del delta -> (tipo, elemento, id del frammento)
+        self.states = {}    # id del widget -> WidgetState inviato a ogni rerun
+
+    async def connect(self):
+        url = self.base_url.replace("http", "ws", 1) + "/_stcore/stream"
+        self.websocket = await connect(url, subprotocols=["streamlit"], max_size=None)
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+
+    async def receive(self):
+        msg = ForwardMsg()
+        msg.ParseFromString(await asyncio.wait_for(self.websocket.recv(), self.timeout))
+        return msg
+
+    def find(self, kind, label):
+        """(elemento, id del frammento) del primo widget della pagina con il tipo e l'etichetta dati"""
+        for path in sorted(self.elements):
+            element_kind, element, fragment_id = self.elements[path]
+            if element_kind == kind and element.label == label:
+                return element, fragment_id
+        raise InteractionError(label, f"{kind} non trovato")
+
+    async def rerun(self, name, fragment_id="", triggers=()):
+        """Invia una rerun con lo stato dei widget e ne misura la durata fino alla fine dello script"""
+        msg = BackMsg()
+        msg.rerun_script.widget_states.widgets.extend(list(self.states.values()) + list(triggers))
+        msg.rerun_script.fragment_id = fragment_id
+        await asyncio.sleep(self.rng.expovariate(1 / self.think) if self.think else 0)
+
+        if fragment_id:
+            self.elements = {path: value for path, value in self.elements.items() if value[2] != fragment_id}
+        else:
+            self.elements = {}
+        start = time.perf_counter()
+        error = None
+        await self.websocket.send(msg.SerializeToString())
+        try:
+            while True:
+                reply = await self.receive()
+                kind = reply.WhichOneof("type")
+                if kind == "new_session":
+                    self.session_id = reply.new_session.initialize.session_id
+                elif kind == "delta" and reply.delta.WhichOneof("type") == "new_element":
+                    element_kind = reply.delta.new_element.WhichOneof("type")
+                    element = getattr(reply.delta.new_element, element_kind)
+                    if element_kind == "exception":
+                        error = element.message
+                    path = tuple(reply.metadata.delta_path)
+                    self.elements[path] = (element_kind, element, reply.delta.fragment_id)
+                elif kind == "script_finished":
+                    if reply.script_finished == ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                        # st.rerun: la pagina viene ridisegnata da capo nella stessa interazione
+                        if not fragment_id:
+                            self.elements = {}
+                        continue
+                    break
+        except TimeoutError:
+            raise InteractionError(name, f"nessuna risposta in {self.timeout} s", self.timeout) from None
+        if error:
+            raise InteractionError(name, error, time.perf_counter() - start)
+
+        self.record(name, time.perf_counter() - start)
+        if not fragment_id:
+            # Come il browser, si dimenticano i widget che non sono più nella pagina
+            ids = {element.id for _, element, _ in self.elements.values() if getattr(element, "id", "")}
+            self.states = {widget_id: state for widget_id, state in self.states.items() if widget_id in ids}
+
+    async def set_value(self, name, kind, label, field, value):
+        element, fragment_id = self.find(kind, label)
+        self.states[element.id] = WidgetState(id=element.id, **{field: value})
+        await self.rerun(name, fragment_id)
+
+    async def click(self, name, label):
+        element, fragment_id = self.find("button", label)
+        await self.rerun(name, fragment_id, [WidgetState(id=element.id, trigger_value=True)])
+
+    async def login(self):
+        await self.rerun("apertura")
+        # I primi campi con queste etichette sono quelli della scheda "Accedi"
+        for label, value in [("Nome utente", self.username), ("Password", PASSWORD)]:
+            element, _ = self.find("text_input", label)
+            self.states[element.id] = WidgetState(id=element.id, string_value=value)
+        await self.click("accesso", "Accedi")
+
+    async def navigate(self, page):
+        await self.set_value(page, "radio", "Navigazione", "string_value", page)
+
+    async def choose(self, page, label):
+        element, _ = self.find("selectbox", label)
+        await self.set_value(f"{page}/{label}", "selectbox", label, "string_value", self.rng.choice(element.options))
+
+    async def upload(self, filename, data):
+        """Carica un file come il browser: URL di upload dal server, PUT del file, stato del widget"""
+        element, fragment_id = self.find("file_uploader", "Carica un documento")
+        msg = BackMsg()
+        msg.file_urls_request.request_id = uuid.uuid4().hex
+        msg.file_urls_request.session_id = self.session_id
+        msg.file_urls_request.file_names.append(filename)
+        await self.websocket.send(msg.SerializeToString())
+        while (reply := await self.receive()).WhichOneof("type") != "file_urls_response":
+            pass
+        file_urls = reply.file_urls_response.file_urls[0]
+
+        response = await asyncio.to_thread(requests.put, self.base_url + file_urls.upload_url,
+                                           files={"file": (filename, data, "text/plain")}, timeout=self.timeout)
+        response.raise_for_status()
+
+        state = WidgetState(id=element.id)
+        state.file_uploader_state_value.uploaded_file_info.append(
+            UploadedFileInfo(file_id=file_urls.file_id, name=filename, size=len(data), file_urls=file_urls))
+        self.states[element.id] = state
+        await self.rerun("Documenti/file", fragment_id)
+
+    async def upload_document(self):
+        await self.set_value("Documenti/nome", "text_input", "Nome del documento", "string_value",
+                             f"Carico {uuid.uuid4().hex[:8]}")
+        text = " ".join(self.rng.choice(WORDS) for _ in range(self.rng.randint(200, 1500)))
+        await self.upload(f"carico_{uuid.uuid4().hex[:8]}.txt", text.encode())
+        # Un testo simile a uno già caricato va confermato, come farebbe l'utente
+        if any(kind == "checkbox" and element.label == "Carica comunque" for kind, element, _ in self.elements.values()):
+            await self.set_value("Documenti/conferma", "checkbox", "Carica comunque", "bool_value", True)
+        await self.click("Documenti/caricamento", "Carica documento")
+
+# Scenari di navigazione: percorsi tipici di un utente tra le pagine della sidebar
+async def browse(user):
+    for page in ["Dashboard", "Scadenze", "Abbonamenti", "Documenti", "Dashboard"]:
+        await user.navigate(page)
+
+async def upload(user):
+    await user.navigate("Documenti")
+    await user.upload_document()
+    await user.navigate("Dashboard")
+
+async def calendar(user):
+    await user.navigate("Calendario")
+    for label in ["Mese", "Mese", "Vista"]:
+        await user.choose("Calendario", label)
+    await user.navigate("Dashboard")
+
+SCENARIOS = {"browse": browse, "upload": upload, "calendar": calendar}
+
+class ResourceSampler:
+    """CPU e memoria residente del server (con i suoi processi figli) e del processo di carico"""
+
+    def __init__(self, pid, interval=1.0):
+        self.server = psutil.Process(pid)
+        self.client = psutil.Process()
+        self.interval = interval
+        self.processes = {}
+        self.samples = []
+
+    def _sample(self):
+        cpu = rss = 0.0
+        for process in [self.server] + self.server.children(recursive=True):
+            process = self.processes.setdefault(process.pid, process)
+            try:
+                cpu += process.cpu_percent()
+                rss += process.memory_info().rss
+            except psutil.NoSuchProcess:
+                self.processes.pop(process.pid, None)
+        return cpu, rss, self.client.cpu_percent()
+
+    async def run(self):
+        self._sample()
+        while True:
+            await asyncio.sleep(self.interval)
+            self.samples.append(self._sample())
+
+    def summary(self):
+        samples, self.samples = self.samples, []
+        if not samples:
+            return {}
+        return {
+            "server_cpu_pct": sum(s[0] for s in samples) / len(samples),
+            "server_cpu_max_pct": max(s[0] for s in samples),
+            "server_rss_mb": sum(s[1] for s in samples) / len(samples) / (1024 * 1024),
+            "server_rss_max_mb": max(s[1] for s in samples) / (1024 * 1024),
+            "client_cpu_pct": sum(s[2] for s in samples) / len(samples)
+        }
+
+async def virtual_user(base_url, username, scenarios, weights, think, deadline, rng, record):
+    while time.perf_counter() < deadline:
+        # Dopo un errore l'utente ricarica la pagina: nuova sessione e nuovo accesso
+        user = VirtualUser(base_url, username, think, rng, record)
+        try:
+            await user.connect()
+            await user.login()
+            while time.perf_counter() < deadline:
+                await rng.choices(scenarios, weights)[0](user)
+        except InteractionError as e:
+            record(e.name, e.seconds, str(e))
+        except (OSError, ConnectionClosed) as e:
+            record("connessione", 0, str(e))
+            await asyncio.sleep(think)
+        finally:
+            await user.close()
+
+async def run_level(base_url, users, args, mix, sampler):
+    """Un gradino di carico: `users` sessioni concorrenti per `args.duration` secondi"""
+    records = []
+
+    def record(name, seconds, error=None):
+        records.append((name, seconds, error))
+
+    scenarios, weights = [SCENARIOS[name] for name in mix], list(mix.values())
+    start = time.perf_counter()
+    deadline = start + args.duration
+    tasks = []
+    for i in range(users):
+        rng = random.Random(args.seed * 100_003 + i)
+        # Gli accessi sono distribuiti nella prima pausa di riflessione, non tutti nello stesso istante
+        await asyncio.sleep(rng.uniform(0, args.think) / users)
+        tasks.append(asyncio.create_task(virtual_user(base_url, USERNAME.format(i % args.tenants), scenarios,
+                                                      weights, args.think, deadline, rng, record)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    latencies = {}
+    errors = {}
+    samples = {}  # primo messaggio di errore di ogni interazione
+    for name, seconds, error in records:
+        if error:
+            errors[name] = errors.get(name, 0) + 1
+            samples.setdefault(name, error)
+        else:
+            latencies.setdefault(name, []).append(seconds * 1000)
+    completed = sum(len(values) for values in latencies.values())
+    result = {
+        "users": users,
+        "elapsed_s": elapsed,
+        "interactions": completed,
+        "throughput": completed / elapsed,
+        "errors": sum(errors.values()),
+        "error_rate": sum(errors.values()) / max(1, len(records)),
+        "error_kinds": errors,
+        "error_samples": samples,
+        "pages": {name: {"count": len(values), "p50_ms": percentile(values, 50), "p95_ms": percentile(values, 95),
+                         "p99_ms": percentile(values, 99), "max_ms": max(values)}
+                  for name, values in sorted(latencies.items())}
+    }
+    all_latencies = [value for values in latencies.values() for value in values]
+    if all_latencies:
+        result["p95_ms"] = percentile(all_latencies, 95)
+    if sampler:
+        result.update(sampler.summary())
+    return result
+
+def saturated(previous, current, min_efficiency, max_error_rate, slo_ms):
+    """Motivo per cui il gradino è oltre la saturazione, o None"""
+    if current["error_rate"] > max_error_rate:
+        return f"errori {current['error_rate']:.1%}"
+    if slo_ms and current.get("p95_ms", 0) > slo_ms:
+        return f"p95 {current['p95_ms']:.0f} ms oltre {slo_ms:.0f} ms"
+    if previous and previous["throughput"] > 0:
+        # Con il server non saturo le interazioni al secondo crescono quasi in proporzione agli utenti
+        growth = current["users"] / previous["users"] - 1
+        gain = current["throughput"] / previous["throughput"] - 1
+        if growth > 0 and gain / growth < min_efficiency:
+            return f"throughput +{gain:.0%} con +{growth:.0%} utenti"
+    return None
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(port, data_dir):
+    env = dict(os.environ, CONTRACTME_DATA_DIR=data_dir)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "streamlit", "run", APP_PATH, "--server.headless", "true",
+         "--server.port", str(port), "--server.address", "127.0.0.1", "--server.fileWatcherType", "none",
+         "--server.enableXsrfProtection", "false", "--browser.gatherUsageStats", "false"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Il server Streamlit è terminato con codice {server.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1):
+                return server
+        except OSError:
+            time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("Il server Streamlit non ha risposto entro 60 s")
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition(":")
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"scenario sconosciuto: {name} (disponibili: {', '.join(SCENARIOS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+async def run(args, base_url, server_pid):
+    mix = parse_mix(args.scenarios)
+    sampler = ResourceSampler(server_pid) if psutil else None
+    sampling = asyncio.create_task(sampler.run()) if sampler else None
+    levels = []
+    try:
+        for users in [int(u) for u in args.users.split(",")]:
+            result = await run_level(base_url, users, args, mix, sampler)
+            result["saturated"] = saturated(levels[-1] if levels else None, result, args.min_efficiency,
+                                            args.max_error_rate, args.slo)
+            levels.append(result)
+            resources = (f"  CPU server {result['server_cpu_pct']:6.1f}%  RSS {result['server_rss_max_mb']:7.1f} MB  "
+                         f"CPU carico {result['client_cpu_pct']:5.1f}%" if "server_cpu_pct" in result else "")
+            print(f"{users:5d} utenti: {result['throughput']:7.2f} interazioni/s  p95 {result.get('p95_ms', 0):8.1f} ms  "
+                  f"errori {result['errors']:4d}{resources}")
+            for name, page in result["pages"].items():
+                print(f"    {name:<22} n {page['count']:5d}  p50 {page['p50_ms']:8.1f} ms  p95 {page['p95_ms']:8.1f} ms  "
+                      f"p99 {page['p99_ms']:8.1f} ms")
+            for name, errors in result["error_kinds"].items():
+                print(f"    errori {name:<15} {errors:5d}  es. {result['error_samples'][name]}")
+            if result["saturated"]:
+                print(f"  saturazione: {result['saturated']}")
+                if not args.past_saturation:
+                    break
+    finally:
+        if sampling:
+            sampling.cancel()
+
+    unsaturated = [level for level in levels if not level["saturated"]]
+    if unsaturated:
+        best = max(unsaturated, key=lambda level: level["throughput"])
+        print(f"Capacità: {best['throughput']:.2f} interazioni/s con {best['users']} utenti concorrenti")
+    if psutil is None:
+        print("psutil non installato: CPU e memoria del server non misurate.")
+    return levels
+
+def main():
+    parser = argparse.ArgumentParser(description="Prova di carico di ContractME con sessioni concorrenti")
+    parser.add_argument("--users", default="1,5,10,25,50,100,200", help="Utenti concorrenti di ogni gradino")
+    parser.add_argument("--duration", type=float, default=30, help="Durata di ogni gradino (secondi)")
+    parser.add_argument("--think", type=float, default=2.0, help="Pausa media tra due interazioni (secondi)")
+    parser.add_argument("--scenarios", default="browse:6,calendar:3,upload:1",
+                        help=f"Scenari con il loro peso, es. browse:6,upload:1 (disponibili: {', '.join(SCENARIOS)})")
+    parser.add_argument("--tenants", type=int, default=5, help="Spazi di lavoro tra cui sono divisi gli utenti")
+    parser.add_argument("--scale", type=int, default=200, help="Record per entità di ogni spazio di lavoro")
+    parser.add_argument("--distinct-blobs", type=int, default=16, help="Contenuti distinti dei file sintetici")
+    parser.add_argument("--min-efficiency", type=float, default=0.5,
+                        help="Crescita minima del throughput, in proporzione a quella degli utenti, prima della saturazione")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="Errori ammessi prima della saturazione")
+    parser.add_argument("--slo", type=float, help="p95 massimo (ms) prima della saturazione")
+    parser.add_argument("--past-saturation", action="store_true", help="Esegue tutti i gradini anche dopo la saturazione")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="File JSON con i risultati")
+    args = parser.parse_args()
+
+    # Come il benchmark, la prova usa un archivio temporaneo e mai quello reale
+    data_dir = tempfile.mkdtemp(prefix="contractme_load_")
+    os.environ["CONTRACTME_DATA_DIR"] = data_dir
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    import ContractME
+
+    store = ContractME.DataStore()
+    start = time.perf_counter()
+    for i in range(args.tenants):
+        user = store.create_tenant(f"carico-{i}", USERNAME.format(i), PASSWORD)
+        populate(store, user["tenant_id"], args.scale, args.distinct_blobs, args.seed + i)
+    print(f"{args.tenants} spazi di lavoro da {args.scale} record generati in {time.perf_counter() - start:.1f} s")
+
+    port = free_port()
+    server = start_server(port, data_dir)
+    try:
+        levels = asyncio.run(run(args, f"http://127.0.0.1:{port}", server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(levels, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
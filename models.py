@@ -0,0 +1,202 @@
+"""Record tipizzati di documenti, scadenze e abbonamenti di ContractME e strutture costruite su di essi.
+
+I record sono validati una sola volta al salvataggio, così le pagine li leggono senza controlli;
+__slots__ evita un dizionario per ogni record. Stanno in un modulo a parte perché Streamlit
+riesegue lo script principale a ogni interazione, ridefinendone le classi: qui restano le stesse
+per tutta la vita del processo e gli oggetti si possono serializzare con pickle (cache su disco).
+"""
+import math
+from dataclasses import dataclass
+from datetime import date
+
+@dataclass(slots=True, kw_only=True)
+class Document:
+    id: int = None
+    name: str
+    category: str
+    type: str
+    preview: str = None
+    upload_date: date
+    expiry_date: date = None
+    filename: str
+    version: int = 1
+
+    def validate(self):
+        if not self.name:
+            raise ValueError("Il nome del documento è obbligatorio.")
+        if self.type not in ("pdf", "image", "text"):
+            raise ValueError("Formato del documento non supportato.")
+        if not isinstance(self.upload_date, date):
+            raise ValueError("La data di caricamento non è valida.")
+        if self.expiry_date is not None and not isinstance(self.expiry_date, date):
+            raise ValueError("La data di scadenza non è valida.")
+
+@dataclass(slots=True, kw_only=True)
+class Deadline:
+    id: int = None
+    title: str
+    date: date
+    description: str = ""
+    category: str
+    document_id: int = None
+    subscription_id: int = None
+    status: str = None
+
+    def validate(self):
+        if not self.title:
+            raise ValueError("Il titolo della scadenza è obbligatorio.")
+        if not isinstance(self.date, date):
+            raise ValueError("La data della scadenza non è valida.")
+        self.description = self.description or ""
+
+@dataclass(slots=True, kw_only=True)
+class Subscription:
+    id: int = None
+    name: str
+    type: str
+    renewal_date: date
+    cost: float
+    description: str = ""
+    status: str = None
+
+    def validate(self):
+        if not self.name:
+            raise ValueError("Il nome dell'abbonamento è obbligatorio.")
+        if not isinstance(self.renewal_date, date):
+            raise ValueError("La data di rinnovo non è valida.")
+        try:
+            self.cost = float(self.cost)
+        except (TypeError, ValueError):
+            raise ValueError("Il costo mensile deve essere un numero.")
+        if not math.isfinite(self.cost):
+            raise ValueError("Il costo mensile deve essere un numero finito.")
+        if self.cost < 0:
+            raise ValueError("Il costo mensile non può essere negativo.")
+        self.description = self.description or ""
+
+class CategoryTaxonomy:
+    """Albero delle categorie di un tenant, nell'ordine di creazione"""
+
+    def __init__(self, rows=()):
+        self.parents = {}  # nome -> categoria padre (None per le radici)
+        for name, parent in rows:
+            self.parents[name] = parent
+        self._order = None
+
+    def add(self, name, parent=None):
+        if name not in self.parents:
+            self.parents[name] = parent
+            self._order = None
+
+    def rename(self, old, new):
+        """Rinomina una categoria o, se la nuova esiste già, la unisce a quella"""
+        if new == old:
+            return
+        if new not in self.parents:
+            # Ricostruzione per mantenere la posizione della categoria rinominata
+            self.parents = {new if name == old else name: parent for name, parent in self.parents.items()}
+        else:
+            del self.parents[old]
+        for name, parent in self.parents.items():
+            if parent == old:
+                self.parents[name] = new
+        self._order = None
+
+    def move(self, name, parent):
+        self.parents[name] = parent
+        self._order = None
+
+    def __contains__(self, name):
+        return name in self.parents
+
+    def __len__(self):
+        return len(self.parents)
+
+    def __iter__(self):
+        """Categorie in ordine di albero: ogni padre seguito dalle sue sottocategorie"""
+        if self._order is None:
+            children = {}
+            for name, parent in self.parents.items():
+                children.setdefault(parent if parent in self.parents else None, []).append(name)
+            order = []
+            stack = list(reversed(children.get(None, [])))
+            while stack:
+                name = stack.pop()
+                order.append(name)
+                stack.extend(reversed(children.get(name, [])))
+            self._order = order
+        return iter(self._order)
+
+    def path(self, name):
+        parts = [name]
+        parent = self.parents.get(name)
+        while parent in self.parents and parent not in parts:
+            parts.append(parent)
+            parent = self.parents[parent]
+        return " / ".join(reversed(parts))
+
+    def descendants(self, name):
+        """La categoria con tutte le sue sottocategorie, a qualunque profondità"""
+        found = [name]
+        for category in found:
+            found.extend(child for child, parent in self.parents.items() if parent == category and child not in found)
+        return found
+
+class CategoryIndex:
+    """Indice categoria -> id di documenti e scadenze, aggiornato a ogni scrittura della sessione"""
+
+    def __init__(self, documents=(), deadlines=()):
+        self.documents = {}  # categoria -> {id: documento}
+        self.deadlines = {}  # categoria -> {id: scadenza}
+        for document in documents:
+            self.add_document(document)
+        for deadline in deadlines:
+            self.add_deadline(deadline)
+
+    @staticmethod
+    def _add(buckets, record):
+        buckets.setdefault(record.category, {})[record.id] = record
+
+    @staticmethod
+    def _remove(buckets, record):
+        bucket = buckets.get(record.category)
+        if bucket is not None:
+            bucket.pop(record.id, None)
+            if not bucket:
+                del buckets[record.category]
+
+    def add_document(self, document):
+        self._add(self.documents, document)
+
+    def remove_document(self, document):
+        self._remove(self.documents, document)
+
+    def contains_document(self, document):
+        return document.id in self.documents.get(document.category, {})
+
+    def add_deadline(self, deadline):
+        self._add(self.deadlines, deadline)
+
+    def remove_deadline(self, deadline):
+        self._remove(self.deadlines, deadline)
+
+    def rename(self, old, new):
+        for buckets in (self.documents, self.deadlines):
+            moved = buckets.pop(old, {})
+            for record in moved.values():
+                record.category = new
+            if moved:
+                buckets.setdefault(new, {}).update(moved)
+
+    def documents_in(self, categories):
+        """Documenti delle categorie indicate, in ordine di id"""
+        found = {}
+        for category in categories:
+            found.update(self.documents.get(category, {}))
+        return [found[doc_id] for doc_id in sorted(found)]
+
+    def document_counts(self):
+        return {category: len(bucket) for category, bucket in self.documents.items()}
+
+    def deadline_counts(self):
+        return {category: len(bucket) for category, bucket in self.deadlines.items()}
@@ -0,0 +1,53 @@
+"""Riconoscimento del testo (OCR) dei documenti scansionati di ContractME.
+
+Opzionale: servono pytesseract con il programma Tesseract e, per i PDF, PyMuPDF. Le funzioni di
+riconoscimento girano nei processi del pool OCR, che devono poterle importare per nome.
+"""
+import hashlib
+import io
+import os
+import shutil
+
+from PIL import Image
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+OCR_LANG = os.environ.get("CONTRACTME_OCR_LANG", "ita+eng")
+PDF_DPI = int(os.environ.get("CONTRACTME_OCR_DPI", "200"))
+
+def available(doc_type):
+    """Indica se i documenti di questo tipo possono essere riconosciuti in questo ambiente"""
+    if pytesseract is None or shutil.which(pytesseract.pytesseract.tesseract_cmd) is None:
+        return False
+    return doc_type == "image" or (doc_type == "pdf" and pymupdf is not None)
+
+def split_pages(doc_type, data):
+    """Pagine di un documento come (hash, immagine PNG, testo già presente nel file)"""
+    if doc_type == "image":
+        return [(hashlib.sha256(data).hexdigest(), data, None)]
+
+    pages = []
+    with pymupdf.open(stream=data, filetype="pdf") as pdf:
+        for page in pdf:
+            # Un PDF generato al computer ha già il testo: la pagina non va riconosciuta
+            text = page.get_text().strip()
+            if text:
+                pages.append((hashlib.sha256(text.encode()).hexdigest(), None, text))
+                continue
+            # L'hash dei pixel identifica la pagina anche dentro PDF diversi
+            pixmap = page.get_pixmap(dpi=PDF_DPI, colorspace=pymupdf.csGRAY)
+            pages.append((hashlib.sha256(pixmap.samples).hexdigest(), pixmap.tobytes("png"), None))
+    return pages
+
+def recognize(image):
+    """Testo di una pagina; eseguita in un processo del pool"""
+    with Image.open(io.BytesIO(image)) as page:
+        return pytesseract.image_to_string(page, lang=OCR_LANG).strip()
@@ -0,0 +1,129 @@
+"""Indice della ricerca rapida di ContractME su documenti, scadenze e abbonamenti.
+
+Ogni voce ha un titolo (nome del documento o dell'abbonamento, titolo della scadenza) e un testo
+(categoria, tipo, descrizione, nome del file, testo del documento). I termini, in minuscolo e senza
+accenti, stanno in un vocabolario ordinato: quelli che iniziano con un prefisso sono un intervallo
+contiguo, trovato con due ricerche binarie come il sottoalbero di un trie. Ogni termine ha l'insieme
+delle voci che lo contengono nel titolo e quello delle voci che lo contengono nel testo: una
+ricerca unisce e interseca insiemi, senza scorrere le voci. L'indice di un tenant è condiviso da
+tutte le sue sessioni.
+"""
+import bisect
+import heapq
+import re
+import unicodedata
+
+KINDS = ("document", "deadline", "subscription")
+MIN_PREFIX = 2
+MAX_TERM = 40
+
+_WORD = re.compile(rf"\w{{{MIN_PREFIX},{MAX_TERM}}}")
+_COMBINING = re.compile("[\u0300-\u036f]")
+_LAST = chr(0x10FFFF)
+
+def normalize(text):
+    return _COMBINING.sub("", unicodedata.normalize("NFKD", text.lower()))
+
+def terms(text):
+    """Termini indicizzati di un testo"""
+    return set(_WORD.findall(normalize(text))) if text else set()
+
+def query_terms(query):
+    # I termini più lunghi sono i più selettivi: restringono subito i candidati
+    return sorted(terms(query), key=len, reverse=True)
+
+def entry_key(kind, record_id):
+    # Chiavi intere crescenti con l'id: tra le voci trovate si mostrano prima le più recenti
+    return record_id * len(KINDS) + KINDS.index(kind)
+
+class SearchIndex:
+    """Indice per prefisso delle voci di un tenant"""
+
+    def __init__(self, entries=()):
+        self.titles = {}   # termine -> chiavi delle voci con il termine nel titolo
+        self.texts = {}    # termine -> chiavi delle voci con il termine nel testo
+        self.entries = {}  # chiave -> (tipo, id, titolo, dettaglio, termini del titolo, parti del testo)
+        for kind, record_id, title, detail, texts in entries:
+            key = entry_key(kind, record_id)
+            title_terms = tuple(terms(title))
+            self.entries[key] = (kind, record_id, title, detail, title_terms, texts)
+            for postings, found in ((self.titles, title_terms), *((self.texts, part) for part in texts)):
+                for term in found:
+                    keys = postings.get(term)
+                    if keys is None:
+                        postings[term] = {key}
+                    else:
+                        keys.add(key)
+        # Il vocabolario viene ordinato una volta sola dopo la costruzione, poi mantenuto ordinato
+        self.vocabulary = sorted(self.titles.keys() | self.texts.keys())
+
+    def _post(self, postings, term, key):
+        keys = postings.get(term)
+        if keys is None:
+            if term not in self.titles and term not in self.texts:
+                bisect.insort(self.vocabulary, term)
+            keys = postings[term] = set()
+        keys.add(key)
+
+    def _unpost(self, postings, term, key):
+        # Un termine può comparire in più parti del testo di una voce
+        keys = postings.get(term)
+        if keys is None:
+            return
+        keys.discard(key)
+        if not keys:
+            del postings[term]
+            if term not in self.titles and term not in self.texts:
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, term)]
+
+    def add(self, kind, record_id, title, detail, texts):
+        """Aggiunge (o sostituisce) una voce. texts sono gli insiemi dei termini delle parti del testo,
+        già estratti: le voci con lo stesso contenuto condividono lo stesso insieme"""
+        self.remove(kind, record_id)
+        key = entry_key(kind, record_id)
+        title_terms = tuple(terms(title))
+        for term in title_terms:
+            self._post(self.titles, term, key)
+        for part in texts:
+            for term in part:
+                self._post(self.texts, term, key)
+        self.entries[key] = (kind, record_id, title, detail, title_terms, texts)
+
+    def remove(self, kind, record_id):
+        key = entry_key(kind, record_id)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for term in entry[4]:
+            self._unpost(self.titles, term, key)
+        for part in entry[5]:
+            for term in part:
+                self._unpost(self.texts, term, key)
+
+    def _prefixed(self, postings, prefix):
+        """Chiavi delle voci con almeno un termine che inizia con il prefisso"""
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = bisect.bisect_left(self.vocabulary, prefix + _LAST, start)
+        return set().union(*(postings[term] for term in self.vocabulary[start:end] if term in postings))
+
+    def search(self, query, limit=10):
+        """(voci trovate, numero totale): ogni parola della ricerca è il prefisso di un termine della voce.
+        Prima le voci che hanno tutte le parole nel titolo, poi le altre; a pari livello le più recenti"""
+        words = query_terms(query)
+        if not words:
+            return [], 0
+        in_title = found = None
+        for word in words:
+            titles = self._prefixed(self.titles, word)
+            anywhere = titles | self._prefixed(self.texts, word)
+            in_title = titles if in_title is None else in_title & titles
+            found = anywhere if found is None else found & anywhere
+            if not found:
+                return [], 0
+        best = heapq.nlargest(limit, in_title)
+        if len(best) < limit:
+            best += heapq.nlargest(limit - len(best), found - in_title)
+        return [self.entries[key][:4] for key in best], len(found)
+
+    def __len__(self):
+        return len(self.entries)
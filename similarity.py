@@ -0,0 +1,144 @@
+"""Rilevamento dei documenti quasi duplicati di ContractME.
+
+Il testo è rappresentato da una firma MinHash dei suoi trigrammi di parole, le immagini (e i PDF
+scansionati) da un hash percettivo (dHash) di 64 bit. Le firme sono indicizzate con LSH: una ricerca
+confronta solo i documenti che condividono almeno una banda della firma, non tutto l'archivio.
+L'indice di un tenant si tiene in sessione e si aggiorna a ogni caricamento.
+"""
+import hashlib
+import io
+import re
+
+import numpy as np
+from PIL import Image, ImageOps
+
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+SHINGLE_SIZE = 3
+NUM_PERM = 128
+# 16 bande da 8 righe: due testi con somiglianza di Jaccard 0.8 hanno il 95% di probabilità di
+# condividere un bucket, due testi al 0.4 circa l'1%
+TEXT_BANDS = 16
+TEXT_THRESHOLD = 0.8
+# 8 bande da 8 bit: due hash che differiscono in al massimo 7 bit hanno sicuramente una banda uguale
+IMAGE_BANDS = 8
+IMAGE_MAX_DISTANCE = 6
+SHINGLE_BATCH = 4096
+
+# Permutazioni h -> (a * h + b) mod p con hash a 32 bit e a, b < 2^31: il prodotto non supera uint64.
+# Il seme è fisso perché le firme salvate restino confrontabili tra processi e versioni
+_PRIME = np.uint64((1 << 61) - 1)
+_rng = np.random.default_rng(20240601)
+_A = _rng.integers(1, 1 << 31, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, 1 << 31, NUM_PERM, dtype=np.uint64)
+
+def shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def minhash(text):
+    """Firma MinHash del testo (None se non contiene parole)"""
+    tokens = shingles(text)
+    if not tokens:
+        return None
+    hashes = np.fromiter((int.from_bytes(hashlib.blake2b(token.encode(), digest_size=4).digest(), "little")
+                          for token in tokens), dtype=np.uint64, count=len(tokens))
+    signature = np.full(NUM_PERM, _PRIME, dtype=np.uint64)
+    # A blocchi, per non creare una matrice trigrammi x permutazioni intera con i documenti lunghi
+    for start in range(0, len(hashes), SHINGLE_BATCH):
+        block = (np.outer(hashes[start:start + SHINGLE_BATCH], _A) + _B) % _PRIME
+        np.minimum(signature, block.min(axis=0), out=signature)
+    return signature
+
+def dhash(image):
+    """Hash percettivo a 64 bit: il verso del gradiente tra pixel vicini di una miniatura 9x8"""
+    image = ImageOps.exif_transpose(image).convert("L").resize((9, 8), Image.Resampling.LANCZOS)
+    pixels = np.asarray(image, dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1])
+
+def fingerprint(doc_type, data):
+    """(tipo, firma) del contenuto di un documento, o None se non se ne può calcolare una"""
+    if doc_type == "text":
+        signature = minhash(data.decode(errors="ignore"))
+        return ("text", signature) if signature is not None else None
+
+    if doc_type == "image":
+        with Image.open(io.BytesIO(data)) as image:
+            # Per i JPEG basta decodificare una versione ridotta
+            image.draft("L", (256, 256))
+            return "image", dhash(image)
+
+    if doc_type == "pdf" and pymupdf is not None:
+        with pymupdf.open(stream=data, filetype="pdf") as pdf:
+            signature = minhash(" ".join(page.get_text() for page in pdf))
+            if signature is not None:
+                return "text", signature
+            if len(pdf):
+                # PDF scansionato: si confronta la prima pagina come immagine
+                pixmap = pdf[0].get_pixmap(dpi=36, colorspace=pymupdf.csGRAY)
+                return "image", dhash(Image.frombytes("L", (pixmap.width, pixmap.height), pixmap.samples))
+    return None
+
+# Le firme sono salvate come byte: little endian per il testo, i 64 bit così come sono per le immagini
+def to_bytes(kind, signature):
+    return signature.astype("<u8").tobytes() if kind == "text" else signature.tobytes()
+
+def from_bytes(kind, data):
+    if kind == "text":
+        return np.frombuffer(data, dtype="<u8").astype(np.uint64)
+    return np.frombuffer(data, dtype=np.uint8)
+
+def similarity(kind, a, b):
+    if kind == "text":
+        return float(np.mean(a == b))
+    return 1 - int(np.unpackbits(a ^ b).sum()) / 64
+
+class NearDuplicateIndex:
+    """Indice LSH delle firme dei documenti di un tenant"""
+
+    def __init__(self, fingerprints=()):
+        self.buckets = {}     # (tipo, banda, valore) -> id dei documenti
+        self.signatures = {}  # id -> (tipo, firma)
+        for doc_id, kind, signature in fingerprints:
+            self.add(doc_id, kind, signature)
+
+    def _keys(self, kind, signature):
+        raw = signature.tobytes()
+        size = len(raw) // (TEXT_BANDS if kind == "text" else IMAGE_BANDS)
+        return [(kind, band, raw[band * size:(band + 1) * size]) for band in range(len(raw) // size)]
+
+    def add(self, doc_id, kind, signature):
+        self.signatures[doc_id] = (kind, signature)
+        for key in self._keys(kind, signature):
+            self.buckets.setdefault(key, set()).add(doc_id)
+
+    def remove(self, doc_id):
+        kind, signature = self.signatures.pop(doc_id, (None, None))
+        if kind is None:
+            return
+        for key in self._keys(kind, signature):
+            bucket = self.buckets[key]
+            bucket.discard(doc_id)
+            if not bucket:
+                del self.buckets[key]
+
+    def query(self, kind, signature):
+        """Documenti simili alla firma data come (id, somiglianza), dal più simile"""
+        candidates = set()
+        for key in self._keys(kind, signature):
+            candidates |= self.buckets.get(key, set())
+        threshold = TEXT_THRESHOLD if kind == "text" else 1 - IMAGE_MAX_DISTANCE / 64
+        matches = []
+        for doc_id in candidates:
+            score = similarity(kind, signature, self.signatures[doc_id][1])
+            if score >= threshold:
+                matches.append((doc_id, score))
+        return sorted(matches, key=lambda match: -match[1])
+
+    def __len__(self):
+        return len(self.signatures)
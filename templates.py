@@ -0,0 +1,168 @@
+"""Template HTML precompilati delle pagine di ContractME.
+
+Ogni template viene analizzato e compattato una sola volta, alla creazione. I valori inseriti sono sempre
+escapati, tranne i frammenti già prodotti da un template (Markup); gli stili stanno nelle classi
+del foglio di stile invece di essere ripetuti su ogni elemento.
+"""
+import html
+import re
+from functools import lru_cache
+from string import Formatter
+
+RECORD_CACHE_SIZE = 4096
+
+class Markup(str):
+    """HTML sicuro, inserito nei template così com'è"""
+
+def escape(value):
+    if isinstance(value, Markup):
+        return value
+    return Markup(html.escape(str(value)))
+
+def join(fragments):
+    return Markup("".join(fragments))
+
+class Template:
+    """Template con segnaposto {nome} o {nome:formato}, compilato alla creazione"""
+
+    def __init__(self, source):
+        # Gli a capo e l'indentazione servono solo alla leggibilità del sorgente
+        source = re.sub(r">\s+<", "><", source.strip())
+        source = re.sub(r"\s*\n\s*", " ", source)
+        self.parts = [(literal, field, spec) for literal, field, spec, _ in Formatter().parse(source)]
+
+    def render(self, **values):
+        out = []
+        for literal, field, spec in self.parts:
+            out.append(literal)
+            if field is not None:
+                value = values[field]
+                out.append(escape(format(value, spec) if spec else value))
+        return Markup("".join(out))
+
+@lru_cache(maxsize=None)
+def minify_css(css):
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    return Markup(re.sub(r"\s*([{};:,>])\s*", r"\1", css).strip())
+
+# Documenti
+DOCUMENT_CARD = Template("""
+<div class="card">
+    <h3>{name}</h3>
+    <p><strong>Categoria:</strong> {category}</p>
+    <p><strong>Data caricamento:</strong> {upload_date:%d/%m/%Y}</p>
+    <p><strong>Tipo file:</strong> {extension}</p>
+    {version}
+    {expiry}
+</div>
+""")
+
+DOCUMENT_EXPIRY = Template("<p><strong>Data scadenza:</strong> {expiry_date:%d/%m/%Y}</p>")
+
+DOCUMENT_VERSION = Template("<p><strong>Versione:</strong> {version}</p>")
+
+PREVIEW_IMAGE = Template("""
+<div class="card"><h4>Anteprima</h4><img class="preview-image" src="data:{mime};base64,{data}"></div>
+""")
+
+# Formato di un'immagine dall'inizio del suo base64: le immagini caricate prima della normalizzazione sono PNG
+IMAGE_MIME_PREFIXES = {"iVBOR": "image/png", "/9j/": "image/jpeg", "UklGR": "image/webp"}
+
+def image_mime(data):
+    for prefix, mime in IMAGE_MIME_PREFIXES.items():
+        if data.startswith(prefix):
+            return mime
+    return "image/png"
+
+PREVIEW_TEXT = Template("""
+<div class="card"><h4>Anteprima</h4><div class="preview-text">{text}</div></div>
+""")
+
+PREVIEW_PDF = Markup('<div class="card"><h4>Anteprima</h4><p>Anteprima PDF non disponibile direttamente.</p></div>')
+
+# Abbonamenti e metriche
+METRIC = Template("""
+<div class="metric">
+    <div class="metric-value">{value}</div>
+    <div class="metric-label">{label}</div>
+</div>
+""")
+
+COST_METRIC = Template("""
+<div class="metric">
+    <div class="metric-label">{label}</div>
+    <div class="metric-value">{value:.2f} €</div>
+</div>
+""")
+
+SUBSCRIPTION_CARD = Template("""
+<div class="card edge-{status}">
+    <h3>{name}</h3>
+    <p><strong>Tipo:</strong> {type}</p>
+    <p><strong>Costo mensile:</strong> {cost:.2f} €</p>
+    <p><strong>Prossimo rinnovo:</strong> {renewal_date:%d/%m/%Y}</p>
+    <p><strong>Giorni al rinnovo:</strong> <span class="tone-{status}">{days}</span></p>
+    <p><strong>Descrizione:</strong> {description}</p>
+</div>
+""")
+
+# Scadenze
+DEADLINE_TABLE = Template("""
+<table class="deadline-table">
+    <tr><th>ID</th><th>Titolo</th><th>Data</th><th>Giorni rimanenti</th><th>Categoria</th><th>Documento</th><th>Stato</th></tr>
+    {rows}
+</table>
+""")
+
+DEADLINE_ROW = Template("""
+<tr><td>{id}</td><td>{title}</td><td>{date:%d/%m/%Y}</td><td>{days}</td><td>{category}</td><td>{document}</td>
+<td class="{status_class}">{status}</td></tr>
+""")
+
+# Calendario
+CALENDAR = Template("""
+<h3 class="calendar-title">{title}</h3>
+<table class="calendar">
+    <tr><th>Lun</th><th>Mar</th><th>Mer</th><th>Gio</th><th>Ven</th><th>Sab</th><th>Dom</th></tr>
+    {weeks}
+</table>
+""")
+
+CALENDAR_DAY = Template('<td class="{day_class}"><div class="calendar-day">{day}</div>{events}</td>')
+
+CALENDAR_EVENT = Template('<div class="calendar-event {event_class}">{title}</div>')
+
+CALENDAR_LEGEND = Markup('<div class="calendar-legend"><span class="calendar-event">Abbonamento</span>'
+                         '<span class="calendar-event urgent">Scadenza</span></div>')
+
+# Assistente AI
+CHAT_MESSAGE = Template('<div class="chat-message chat-{role}"><strong>{speaker}:</strong> {content}</div>')
+
+# Dashboard
+RECENT_DOCUMENT = Template("""
+<div class="card card-compact">
+    <div class="row-between"><strong>{name}</strong><span class="muted">{upload_date:%d/%m/%Y}</span></div>
+    <div class="category-tag">{category}</div>
+</div>
+""")
+
+NEXT_DEADLINE = Template("""
+<div class="card card-compact edge-{status}">
+    <div class="row-between"><strong>{title}</strong><span class="tone-{status}">{days} giorni</span></div>
+    <div>{date:%d/%m/%Y}</div>
+</div>
+""")
+
+# L'HTML di un record dipende solo dai campi mostrati: finché non cambiano, la scheda resta in cache
+@lru_cache(maxsize=RECORD_CACHE_SIZE)
+def document_card(name, category, upload_date, filename, expiry_date, version):
+    expiry = DOCUMENT_EXPIRY.render(expiry_date=expiry_date) if expiry_date else Markup()
+    revision = DOCUMENT_VERSION.render(version=version) if version > 1 else Markup()
+    return DOCUMENT_CARD.render(name=name, category=category, upload_date=upload_date,
+                                extension=filename.split(".")[-1].upper(), version=revision, expiry=expiry)
+
+@lru_cache(maxsize=RECORD_CACHE_SIZE)
+def subscription_card(name, type, cost, renewal_date, days, status, description):
+    return SUBSCRIPTION_CARD.render(name=name, type=type, cost=cost, renewal_date=renewal_date, days=days,
+                                    status=status, description=description)
@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+# ContractME legge la cartella dei dati all'importazione: i test non toccano quella vera
+os.environ.setdefault("CONTRACTME_DATA_DIR", tempfile.mkdtemp(prefix="contractme-test-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import ContractME
+import similarity
+from models import Document, Deadline, Subscription
+
+TODAY = date.today()
+
+@pytest.fixture
+def store(tmp_path):
+    return ContractME.DataStore(str(tmp_path / "contractme.db"))
+
+def fill(store, tenant_id, tag):
+    """Dati di prova di un tenant, con il tag nei nomi e nei contenuti: gli id coincidono tra i tenant"""
+    content = f"contratto {tag}\nseconda riga {tag}\n".encode()
+    store.add_category(tenant_id, f"Cartella {tag}")
+    store.add_document(tenant_id, Document(name=f"Contratto {tag}", category=f"Cartella {tag}", type="text",
+                                           upload_date=TODAY, expiry_date=TODAY + timedelta(days=2),
+                                           filename=f"{tag}.txt"),
+                       content, Deadline(title=f"Scadenza {tag}", date=TODAY + timedelta(days=2), category="Casa"),
+                       fingerprint=similarity.fingerprint("text", content))
+    store.add_document(tenant_id, Document(name=f"Scansione {tag}", category="Casa", type="image",
+                                           upload_date=TODAY, filename=f"{tag}.png"),
+                       f"immagine {tag}".encode())
+    store.add_subscription(tenant_id, Subscription(name=f"Servizio {tag}", type="Streaming",
+                                                   renewal_date=TODAY + timedelta(days=5), cost=9.99),
+                           Deadline(title=f"Rinnovo {tag}", date=TODAY + timedelta(days=5), category="Abbonamenti"))
+    store.add_deadline(tenant_id, Deadline(title=f"Tasse {tag}", date=TODAY + timedelta(days=40), category="Finanza"))
+    page = f"pagina-{tag}"
+    store.set_document_pages(tenant_id, 2, [page])
+    store.save_page_texts(tenant_id, [(page, f"testo riconosciuto {tag}")])
+
+@pytest.fixture
+def tenants(store):
+    """Due tenant con gli stessi id e contenuti diversi"""
+    first = store.create_tenant("acme", "alice", "pw")["tenant_id"]
+    second = store.create_tenant("globex", "bob", "pw")["tenant_id"]
+    fill(store, first, "acme")
+    fill(store, second, "globex")
+    return first, second
@@ -0,0 +1,148 @@
+import io
+import tarfile
+
+import pytest
+
+import ContractME
+from conftest import TODAY, fill
+from models import Deadline, Document
+
+def export(store, tenant_id):
+    archive = io.BytesIO()
+    counts = ContractME.export_tenant(store, tenant_id, archive)
+    archive.seek(0)
+    return archive, counts
+
+def blob_count(store, tenant_id):
+    with store.pool.connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM blobs WHERE tenant_id = ?", (tenant_id,)).fetchone()[0]
+
+def test_export_counts_every_table(store, tenants):
+    first, _ = tenants
+    _, counts = export(store, first)
+    assert counts["documents"] == 2 and counts["deadlines"] == 3 and counts["subscriptions"] == 1
+    assert counts["blobs"] == 2
+
+def test_import_remaps_ids_after_existing_rows(store, tenants):
+    first, second = tenants
+    store.add_document_version(second, store.load_tenant(second)["documents"][0], b"revisione globex\n")
+    archive, _ = export(store, second)
+    counts = ContractME.import_tenant(store, first, archive)
+    assert counts["documents"] == 2 and counts["deadlines"] == 3 and counts["document_versions"] == 1
+
+    data = store.load_tenant(first)
+    documents = {doc.id: doc for doc in data["documents"]}
+    assert documents[3].name == "Contratto globex" and documents[4].name == "Scansione globex"
+    assert documents[3].preview == "revisione globex\n"
+    assert documents[1].name == "Contratto acme"
+    imported = {d.title: d for d in data["deadlines"] if "globex" in d.title}
+    # Le scadenze collegate seguono i nuovi id di documenti e abbonamenti
+    assert imported["Scadenza globex"].document_id == 3
+    assert imported["Rinnovo globex"].subscription_id == 2
+    assert imported["Tasse globex"].document_id is None
+    assert {d.id for d in imported.values()} == {4, 5, 6}
+    assert [h["version"] for h in store.document_history(first, 3)] == [2, 1]
+    assert store.document_version_content(first, 3, 1) == b"contratto globex\nseconda riga globex\n"
+    assert store.document_version_content(first, 3, 2) == b"revisione globex\n"
+
+def test_import_into_same_tenant_duplicates_records(store, tenants):
+    first, _ = tenants
+    archive, _ = export(store, first)
+    ContractME.import_tenant(store, first, archive)
+    data = store.load_tenant(first)
+    assert [doc.id for doc in data["documents"]] == [1, 2, 3, 4]
+    assert len(data["deadlines"]) == 6
+    # I contenuti sono deduplicati per hash
+    assert blob_count(store, first) == 2
+
+def test_import_registers_categories(store, tenants):
+    first, second = tenants
+    store.add_category(second, "Mutuo", "Casa")
+    archive, _ = export(store, second)
+    ContractME.import_tenant(store, first, archive)
+    categories = dict(store.load_tenant(first)["categories"])
+    assert categories["Cartella globex"] is None and categories["Mutuo"] == "Casa"
+
+def test_import_bumps_version(store, tenants):
+    first, second = tenants
+    version = store.tenant_version(first)
+    archive, _ = export(store, second)
+    ContractME.import_tenant(store, first, archive)
+    assert store.tenant_version(first) == version + 1
+
+def test_import_rejects_corrupted_blob(store, tenants):
+    first, second = tenants
+    archive, _ = export(store, second)
+    corrupted = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="r") as source, tarfile.open(fileobj=corrupted, mode="w") as target:
+        for member in source:
+            data = source.extractfile(member).read()
+            if member.name.startswith("blobs/") and b"immagine" in data:
+                data = data[::-1]
+            member.size = len(data)
+            target.addfile(member, io.BytesIO(data))
+    corrupted.seek(0)
+    before = store.load_tenant(first)
+    with pytest.raises(ValueError):
+        ContractME.import_tenant(store, first, corrupted)
+    after = store.load_tenant(first)
+    assert after == before
+    # Nessun contenuto dell'archivio resta salvato senza documenti
+    assert blob_count(store, first) == 2
+
+def test_export_of_empty_tenant(store):
+    tenant_id = store.create_tenant("vuoto", "carla", "pw")["tenant_id"]
+    archive, counts = export(store, tenant_id)
+    assert counts["documents"] == 0 and counts["blobs"] == 0
+    other = store.create_tenant("altro", "dario", "pw")["tenant_id"]
+    fill(store, other, "altro")
+    ContractME.import_tenant(store, other, archive)
+    assert len(store.load_tenant(other)["documents"]) == 2
+
+def test_writes_during_import_are_not_blocked(store, tenants, monkeypatch):
+    first, second = tenants
+    archive, _ = export(store, second)
+    verify_blob = ContractME._verify_blob
+
+    def write_while_verifying(name, data):
+        # Una scrittura nel tenant mentre l'archivio viene ancora letto
+        if not store.load_tenant(first)["deadlines"][-1].title.startswith("Durante"):
+            store.add_deadline(first, Deadline(title="Durante l'importazione", date=TODAY, category="Casa"))
+        return verify_blob(name, data)
+
+    monkeypatch.setattr(ContractME, "_verify_blob", write_while_verifying)
+    ContractME.import_tenant(store, first, archive, workers=1)
+    deadlines = {d.title: d.id for d in store.load_tenant(first)["deadlines"]}
+    # Gli id importati seguono anche le righe scritte durante l'importazione
+    assert deadlines["Durante l'importazione"] == 4
+    assert {deadlines["Scadenza globex"], deadlines["Rinnovo globex"], deadlines["Tasse globex"]} == {5, 6, 7}
+
+def test_contents_released_during_import_are_kept(store, tenants, monkeypatch):
+    first, second = tenants
+    for i in range(3):
+        store.add_document(second, Document(name=f"Nota {i}", category="Casa", type="text", upload_date=TODAY,
+                                            filename=f"nota{i}.txt"), f"nota {i}".encode())
+    archive, _ = export(store, second)
+    monkeypatch.setattr(ContractME, "ARCHIVE_BATCH_SIZE", 1)
+    verify_blob = ContractME._verify_blob
+
+    def delete_while_verifying(name, data):
+        # Ogni eliminazione segna come rilasciati i contenuti già salvati ma non ancora referenziati
+        store.delete_document(first, 99)
+        return verify_blob(name, data)
+
+    monkeypatch.setattr(ContractME, "_verify_blob", delete_while_verifying)
+    ContractME.import_tenant(store, first, archive, workers=1)
+    documents = {doc.id: doc for doc in store.load_tenant(first)["documents"]}
+    assert documents[3].preview == "contratto globex\nseconda riga globex\n"
+    assert documents[4].preview is not None
+    assert blob_count(store, first) == 7
+    with store.pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM blobs WHERE tenant_id = ? AND released_at IS NOT NULL",
+                            (first,)).fetchone()[0] == 0
+
+def test_export_skips_released_blobs(store, tenants):
+    first, _ = tenants
+    store.delete_documents(first, [1])
+    _, counts = export(store, first)
+    assert counts["documents"] == 1 and counts["blobs"] == 1
@@ -0,0 +1,19 @@
+import benchmark
+
+def test_populate_is_reproducible_and_deduplicates_contents(store):
+    first = store.create_tenant("uno", "alice", "pw")["tenant_id"]
+    second = store.create_tenant("due", "bob", "pw")["tenant_id"]
+    benchmark.populate(store, first, 50, 5, seed=7)
+    benchmark.populate(store, second, 50, 5, seed=7)
+    data = [store.load_tenant(tenant_id) for tenant_id in (first, second)]
+    assert len(data[0]["documents"]) == len(data[0]["deadlines"]) == len(data[0]["subscriptions"]) == 50
+    assert [d.title for d in data[0]["deadlines"]] == [d.title for d in data[1]["deadlines"]]
+    with store.pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM blobs WHERE tenant_id = ?", (first,)).fetchone()[0] <= 5
+
+def test_compare_reports_only_regressions_over_tolerance():
+    baseline = {"1000/dashboard": {"p50_ms": 100.0}, "1000/view_documents": {"p50_ms": 50.0}}
+    results = {"1000/dashboard": {"p50_ms": 115.0}, "1000/view_documents": {"p50_ms": 70.0},
+               "10000/dashboard": {"p50_ms": 900.0}}
+    regressions = benchmark.compare(results, baseline, 0.2)
+    assert len(regressions) == 1 and regressions[0].startswith("1000/view_documents")
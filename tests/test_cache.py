@@ -0,0 +1,100 @@
+from datetime import timedelta
+
+import ContractME
+from conftest import TODAY
+from models import Deadline
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = ContractME.MemoryCache(max_bytes=100)
+    cache.set(1, "a", "A", 40)
+    cache.set(1, "b", "B", 40)
+    assert cache.get("a")[1] == "A"
+    cache.set(2, "c", "C", 40)
+    assert cache.get("b") is None
+    assert cache.get("a")[1] == "A" and cache.get("c")[1] == "C"
+    stats = cache.stats()
+    assert stats["entries"] == 2 and stats["bytes"] == 80 and stats["evictions"] == 1
+    assert stats["hits"] == 3 and stats["misses"] == 1
+
+def test_memory_cache_skips_values_over_the_limit():
+    cache = ContractME.MemoryCache(max_bytes=10)
+    cache.set(1, "grande", "x", 11)
+    assert cache.get("grande") is None and cache.stats()["bytes"] == 0
+
+def test_invalidate_drops_only_the_tenant_entries():
+    cache = ContractME.MemoryCache()
+    cache.set(1, "1:a", "A", 1)
+    cache.set(2, "2:a", "B", 1)
+    cache.invalidate(1)
+    assert cache.get("1:a") is None and cache.get("2:a")[1] == "B"
+
+def test_disk_cache_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / "cache.db")
+    first, second = ContractME.DiskCache(path), ContractME.DiskCache(path)
+    first.set(1, "chiave", ContractME.pickle.dumps({"totale": 3}), 10)
+    assert second.get("chiave") == (1, {"totale": 3}, 10)
+    second.invalidate(1)
+    assert first.get("chiave") is None
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = ContractME.DiskCache(str(tmp_path / "cache.db"), max_bytes=100)
+    for key in ["a", "b", "c"]:
+        cache.set(1, key, ContractME.pickle.dumps(key), 40)
+    assert cache.get("a") is None and cache.get("c")[1] == "c"
+    assert cache.stats()["bytes"] == 80 and cache.stats()["evictions"] == 1
+
+def test_disk_cache_keeps_a_running_total(tmp_path):
+    path = str(tmp_path / "cache.db")
+    first, second = ContractME.DiskCache(path), ContractME.DiskCache(path)
+    first.set(1, "a", ContractME.pickle.dumps("a"), 30)
+    second.set(2, "b", ContractME.pickle.dumps("b"), 20)
+    first.set(1, "a", ContractME.pickle.dumps("a"), 10)
+    assert first.stats()["bytes"] == second.stats()["bytes"] == 30
+    second.invalidate(1)
+    assert first.stats()["bytes"] == 20
+    # Il totale di un file creato prima della tabella dei totali viene ricalcolato all'apertura
+    with first.pool.connection() as conn:
+        conn.execute("DROP TABLE cache_total")
+    assert ContractME.DiskCache(path).stats()["bytes"] == 20
+
+def test_cache_size_does_not_serialize(monkeypatch):
+    frame = ContractME.pd.DataFrame({"nome": ["Palestra"] * 100, "costo": [9.99] * 100})
+    assert ContractME.cache_size(frame) == frame.memory_usage(index=True, deep=True).sum()
+    assert ContractME.cache_size([1, 2, 3]) > 0
+    monkeypatch.setattr(ContractME.pickle, "dumps", None)
+    cache = ContractME.DerivedDataCache()
+    cache.get_or_compute(1, "tabella", lambda: frame)
+    assert cache.stats()["memory"]["bytes"] == ContractME.cache_size(frame)
+
+def test_derived_data_is_computed_once():
+    cache = ContractME.DerivedDataCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return [3, 2, 1]
+
+    assert cache.get_or_compute(1, "1:0:ordine:()", compute) == [3, 2, 1]
+    assert cache.get_or_compute(1, "1:0:ordine:()", compute) == [3, 2, 1]
+    assert len(calls) == 1
+    cache.invalidate(1)
+    cache.get_or_compute(1, "1:0:ordine:()", compute)
+    assert len(calls) == 2
+
+def test_disk_backend_fills_other_processes():
+    # Il file della cache è nella cartella dei dati della sessione di test
+    first, second = ContractME.DerivedDataCache("disk"), ContractME.DerivedDataCache("disk")
+    first.get_or_compute(1, "chiave", lambda: {"totale": 3})
+    assert second.get_or_compute(1, "chiave", lambda: None) == {"totale": 3}
+    assert second.stats()["memory"]["entries"] == 1
+
+def test_cached_order_returns_each_session_its_own_records(monkeypatch):
+    shared = {}
+    monkeypatch.setattr(ContractME, "cached", lambda name, params, compute: shared.setdefault((name, params), compute()))
+    first = [Deadline(id=i, title=f"T{i}", date=TODAY + timedelta(days=5 - i), category="Casa") for i in (1, 2, 3)]
+    second = [Deadline(id=i, title=f"T{i}", date=TODAY + timedelta(days=5 - i), category="Casa") for i in (1, 3)]
+    by_date = lambda deadlines: sorted(deadlines, key=lambda d: d.date)
+    assert [d.id for d in ContractME.cached_order("sorted", (), first, by_date)] == [3, 2, 1]
+    # La seconda sessione riceve i propri record nell'ordine in cache, senza quelli che non ha
+    ordered = ContractME.cached_order("sorted", (), second, by_date)
+    assert [d.id for d in ordered] == [3, 1] and all(any(d is own for own in second) for d in ordered)
@@ -0,0 +1,122 @@
+import urllib.error
+import urllib.request
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+import ContractME
+from conftest import TODAY
+from models import Deadline, Subscription
+
+def test_calendar_summary_counts_deadlines_and_renewals(store, tenants):
+    first, _ = tenants
+    summary = store.calendar_summary(first, TODAY, TODAY + timedelta(days=30))
+    assert summary == {
+        TODAY + timedelta(days=2): (1, 0, 0),
+        # Il rinnovo ha anche la sua scadenza nello stesso giorno
+        TODAY + timedelta(days=5): (1, 1, pytest.approx(9.99))
+    }
+    assert store.calendar_summary(first, TODAY + timedelta(days=41), TODAY + timedelta(days=60)) == {}
+
+def test_calendar_years(store, tenants):
+    first, _ = tenants
+    store.add_deadline(first, Deadline(title="Vecchia", date=date(2019, 5, 1), category="Casa"))
+    assert store.calendar_years(first) == (2019, (TODAY + timedelta(days=40)).year)
+    empty = store.create_tenant("vuoto", "carol", "pw")["tenant_id"]
+    assert store.calendar_years(empty) is None
+
+def test_calendar_heatmaps_grid():
+    start = date(2026, 3, 4)  # mercoledì
+    end = date(2026, 3, 17)
+    summary = {date(2026, 3, 4): (2, 1, 5.0), date(2026, 3, 16): (0, 1, 3.5)}
+    counts_fig, costs_fig = ContractME.calendar_heatmaps(summary, start, end)
+    counts = np.array(counts_fig.data[0].z, dtype=float)
+    costs = np.array(costs_fig.data[0].z, dtype=float)
+    assert counts.shape == (7, 3)
+    assert list(counts_fig.data[0].x) == ["02/03", "09/03", "16/03"]
+    assert counts[2, 0] == 3 and costs[2, 0] == 5.0
+    assert counts[0, 2] == 1 and costs[0, 2] == 3.5
+    # I giorni fuori dal periodo restano vuoti
+    assert np.isnan(counts[0, 0]) and np.isnan(counts[2, 2])
+    assert np.nansum(counts) == 4
+
+def test_ics_line_folding():
+    assert ContractME._ics_line("SUMMARY:breve") == b"SUMMARY:breve\r\n"
+    folded = ContractME._ics_line("DESCRIPTION:" + "è" * 100)
+    lines = folded.split(b"\r\n")[:-1]
+    assert all(len(line) <= 75 for line in lines)
+    assert all(line.startswith(b" ") for line in lines[1:])
+    assert b"".join(line.removeprefix(b" ") for line in lines).decode() == "DESCRIPTION:" + "è" * 100
+
+def test_monthly_rule_clamps_end_of_month():
+    assert ContractME._monthly_rule(date(2026, 1, 15)) == "FREQ=MONTHLY"
+    assert ContractME._monthly_rule(date(2026, 1, 31)) == "FREQ=MONTHLY;BYMONTHDAY=28,29,30,31;BYSETPOS=-1"
+
+def test_ics_feed_contains_only_the_tenant(store, tenants):
+    first, second = tenants
+    store.add_subscription(first, Subscription(name="Palestra, centro", type="Sport",
+                                               renewal_date=date(2026, 1, 31), cost=30),
+                           Deadline(title="Rinnovo palestra", date=date(2026, 1, 31), category="Abbonamenti"))
+    feed = b"".join(ContractME.ics_feed(store, first, batch_size=1)).decode()
+    assert feed.startswith("BEGIN:VCALENDAR\r\n") and feed.endswith("END:VCALENDAR\r\n")
+    assert feed.count("BEGIN:VEVENT") == 4
+    assert "SUMMARY:Scadenza acme" in feed and "SUMMARY:Tasse acme" in feed
+    # Le scadenze dei rinnovi non si ripetono: il rinnovo è un evento ricorrente
+    assert "Rinnovo acme" not in feed and "SUMMARY:Rinnovo Servizio acme" in feed
+    assert "SUMMARY:Rinnovo Palestra\\, centro" in feed and "BYMONTHDAY=28,29,30,31" in feed
+    assert "globex" not in feed
+
+def test_ics_server(store, tenants):
+    first, _ = tenants
+    token = store.ics_token(first)
+    assert store.ics_token(first) == token
+    assert store.find_tenant_by_ics_token(token) == first
+    server = ContractME.start_ics_server(store, 0)
+    try:
+        base = f"http://127.0.0.1:{server.server_address[1]}/calendar/"
+        with urllib.request.urlopen(f"{base}{token}.ics", timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/calendar")
+            assert b"SUMMARY:Scadenza acme" in response.read()
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f"{base}sbagliato.ics", timeout=5)
+        assert error.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_ics_feed_releases_connection_between_batches(store, tenants):
+    first, _ = tenants
+    store.add_deadline(first, Deadline(title="Assicurazione", date=TODAY + timedelta(days=2), category="Casa"))
+    store.add_deadline(first, Deadline(title="Affitto", date=TODAY + timedelta(days=9), category="Casa"))
+    feed = ContractME.ics_feed(store, first, batch_size=1)
+    chunks = [next(feed), next(feed)]
+    # Il lotto già letto viene inviato senza tenere una connessione del pool
+    assert store.pool._idle.qsize() == ContractME.DB_POOL_SIZE
+    chunks.extend(feed)
+    paged = b"".join(chunks).decode()
+    whole = b"".join(ContractME.ics_feed(store, first)).decode()
+    strip = lambda feed: [line for line in feed.split("\r\n") if not line.startswith("DTSTAMP")]
+    assert strip(paged) == strip(whole)
+    assert paged.count("BEGIN:VEVENT") == 5
+
+def test_ics_server_times_out_and_tolerates_busy_port(store, tenants, monkeypatch):
+    server = ContractME.start_ics_server(store, 0)
+    try:
+        assert server.RequestHandlerClass.timeout == ContractME.ICS_TIMEOUT
+        # Un secondo processo trova la porta occupata e non avvia il feed
+        monkeypatch.setattr(ContractME, "get_store", lambda: store)
+        monkeypatch.setattr(ContractME, "ICS_PORT", server.server_address[1])
+        ContractME.get_ics_server.clear()
+        assert ContractME.get_ics_server() is None
+    finally:
+        ContractME.get_ics_server.clear()
+        server.shutdown()
+        server.server_close()
+
+def test_ics_feed_skips_completed_deadlines(store, tenants):
+    first, _ = tenants
+    store.mark_deadlines_done(first, [3])
+    feed = b"".join(ContractME.ics_feed(store, first)).decode()
+    assert "Scadenza acme" in feed
+    assert "Tasse acme" not in feed
@@ -0,0 +1,67 @@
+import calendar
+import random
+from datetime import date, timedelta
+
+import pytest
+
+import ContractME
+from conftest import TODAY
+from models import Deadline, Subscription
+
+def subscription(name, kind, renewal_date, cost):
+    return Subscription(name=name, type=kind, renewal_date=renewal_date, cost=cost)
+
+def payments(renewal_date, start, end):
+    """Riferimento non vettoriale: un pagamento al mese dal rinnovo, l'ultimo giorno nei mesi più corti"""
+    found = []
+    year, month = renewal_date.year, renewal_date.month
+    while date(year, month, 1) <= end:
+        day = min(renewal_date.day, calendar.monthrange(year, month)[1])
+        when = date(year, month, day)
+        if start <= when <= end and when >= renewal_date:
+            found.append(when)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return found
+
+def test_totals_by_type():
+    costs = ContractME.SubscriptionCosts([subscription("A", "Streaming", TODAY, 10),
+                                          subscription("B", "Software", TODAY, 5),
+                                          subscription("C", "Streaming", TODAY, 2.5)])
+    assert len(costs) == 3 and costs.monthly_total == 17.5 and costs.annual_total == 210
+    assert costs.totals_by_type().to_dict() == {"Streaming": 12.5, "Software": 5}
+
+def test_spend_matches_month_by_month_reference():
+    rng = random.Random(3)
+    start = date(2024, 1, 15)
+    subscriptions = [subscription(f"S{i}", "Altro", start + timedelta(days=rng.randint(-400, 400)),
+                                  round(rng.uniform(1, 50), 2)) for i in range(200)]
+    costs = ContractME.SubscriptionCosts(subscriptions)
+    for days in (0, 30, 365):
+        end = start + timedelta(days=days)
+        expected = sum(sub.cost * len(payments(sub.renewal_date, start, end)) for sub in subscriptions)
+        assert costs.spend_between(start, end) == pytest.approx(expected)
+
+def test_renewal_on_the_31st_falls_on_the_last_day():
+    costs = ContractME.SubscriptionCosts([subscription("Fine mese", "Altro", date(2024, 1, 31), 10)])
+    dates, valid = costs.payment_dates(date(2024, 2, 1), date(2024, 4, 30))
+    assert [str(d) for d in dates[valid]] == ["2024-02-29", "2024-03-31", "2024-04-30"]
+
+def test_monthly_series_starts_at_the_renewal():
+    costs = ContractME.SubscriptionCosts([subscription("A", "Altro", date(2024, 3, 10), 10),
+                                          subscription("B", "Altro", date(2023, 5, 20), 1)])
+    series = costs.monthly_series(date(2024, 1, 5), months=4)
+    assert list(series) == [1, 1, 11, 11]
+    assert str(series.index[0].date()) == "2024-01-01"
+
+def test_no_subscriptions():
+    costs = ContractME.SubscriptionCosts([])
+    assert costs.monthly_total == 0 and costs.renewals_within(TODAY, 30) == 0
+    assert list(costs.monthly_series(TODAY, months=3)) == [0, 0, 0]
+
+@pytest.mark.parametrize("cost", ["dodici", -1, float("nan"), float("inf")])
+def test_invalid_costs_are_rejected(store, cost):
+    tenant_id = store.create_tenant("acme", "alice", "pw")["tenant_id"]
+    with pytest.raises(ValueError):
+        store.add_subscription(tenant_id, subscription("A", "Altro", TODAY, cost),
+                               Deadline(title="Rinnovo", date=TODAY, category="Abbonamenti"))
+    assert store.load_tenant(tenant_id)["subscriptions"] == []
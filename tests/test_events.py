@@ -0,0 +1,154 @@
+import sqlite3
+import time
+from datetime import datetime
+
+import pytest
+
+import ContractME
+from conftest import TODAY
+from models import Deadline
+
+def pause():
+    # Gli istanti del registro hanno i millisecondi
+    time.sleep(0.01)
+
+def current_state(store, tenant_id):
+    return {table: sorted(records, key=lambda record: ContractME._event_key(table, record))
+            for table, records in ContractME.replay_tenant(store, tenant_id).items()}
+
+def blob_contents(store, tenant_id):
+    with store.pool.connection() as conn:
+        return {bytes(row[0]) for row in conn.execute("SELECT data FROM blobs WHERE tenant_id = ?", (tenant_id,))}
+
+def test_event_log_matches_current_data(store, tenants):
+    first, second = tenants
+    store.rename_category(first, "Casa", "Abitazione")
+    store.add_document_version(first, store.load_tenant(first)["documents"][0], b"nuovo testo\n")
+    store.reschedule(first, "deadlines", [1, 2], 7)
+    store.delete_documents(first, [2])
+    store.roll_statuses(first, TODAY)
+    assert ContractME.verify_event_log(store, first) == []
+    assert ContractME.verify_event_log(store, second) == []
+
+def test_status_changes_are_not_logged(store, tenants):
+    first, _ = tenants
+    with store.pool.connection() as conn:
+        before = conn.execute("SELECT COUNT(*) FROM events WHERE tenant_id = ?", (first,)).fetchone()[0]
+        conn.execute("UPDATE deadlines SET status = 'scaduta' WHERE tenant_id = ?", (first,))
+        assert conn.execute("SELECT COUNT(*) FROM events WHERE tenant_id = ?", (first,)).fetchone()[0] == before
+
+def test_verify_detects_writes_outside_the_log(store, tenants):
+    first, _ = tenants
+    with store.pool.connection() as conn:
+        conn.execute("DROP TRIGGER events_deadlines_update")
+        conn.execute("UPDATE deadlines SET title = 'non registrata' WHERE tenant_id = ? AND id = 1", (first,))
+    assert ContractME.verify_event_log(store, first) == [("deadlines", (1,))]
+    # Al riavvio il trigger mancante viene ricreato
+    ContractME.DataStore(store.pool.path)
+    with store.pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'events_deadlines_update'").fetchone()[0]
+
+def test_event_log_is_append_only(store, tenants):
+    with store.pool.connection() as conn:
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("DELETE FROM events")
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("UPDATE events SET op = 'insert'")
+
+def test_replay_until_an_instant(store, tenants):
+    first, _ = tenants
+    pause()
+    middle = datetime.now()
+    expected = current_state(store, first)
+    pause()
+    store.delete_document(first, 1)
+    store.add_deadline(first, Deadline(title="Nuova", date=TODAY, category="Casa"))
+    replayed = ContractME.replay_tenant(store, first, until=middle)
+    assert {table: sorted(records, key=lambda record: ContractME._event_key(table, record))
+            for table, records in replayed.items()} == expected
+
+def test_replay_across_snapshots(store, tenants, monkeypatch):
+    first, _ = tenants
+    monkeypatch.setattr(ContractME, "SNAPSHOT_EVERY", 3)
+    for day in range(10):
+        store.add_deadline(first, Deadline(title=f"Scadenza {day}", date=TODAY, category="Casa"))
+    with store.pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM snapshots WHERE tenant_id = ?", (first,)).fetchone()[0] > 2
+    assert ContractME.verify_event_log(store, first) == []
+
+def test_replay_before_first_snapshot_fails(store, tenants):
+    first, _ = tenants
+    with pytest.raises(ValueError):
+        ContractME.replay_tenant(store, first, until=datetime(2000, 1, 1))
+
+def test_restore_into_new_tenant(store, tenants):
+    first, _ = tenants
+    pause()
+    middle = datetime.now()
+    pause()
+    store.delete_documents(first, [1, 2])
+    counts = ContractME.restore_tenant(store, first, middle, "acme-ripristino", "erin", "pw")
+    assert counts["documents"] == 2 and counts["missing_blobs"] == 0
+    restored = store.find_tenant("acme-ripristino")
+    data = store.load_tenant(restored)
+    documents = {doc.name: doc for doc in data["documents"]}
+    assert sorted(documents) == ["Contratto acme", "Scansione acme"]
+    assert documents["Contratto acme"].preview == "contratto acme\nseconda riga acme\n"
+    assert len(data["deadlines"]) == 3
+    assert ContractME.verify_event_log(store, restored) == []
+
+def test_deleted_contents_are_kept_for_the_retention_window(store, tenants, monkeypatch):
+    first, _ = tenants
+    store.delete_document(first, 1)
+    assert b"contratto acme\nseconda riga acme\n" in blob_contents(store, first)
+    # Fuori dalla finestra di conservazione i contenuti non referenziati vengono raccolti
+    monkeypatch.setattr(ContractME, "retention_cutoff", lambda: "9999")
+    store.delete_document(first, 2)
+    assert blob_contents(store, first) == set()
+
+def test_restart_keeps_matching_triggers(store, tenants):
+    first, _ = tenants
+    with store.pool.connection() as conn:
+        before = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' ORDER BY name").fetchall()
+        schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    ContractME.DataStore(store.pool.path)
+    with store.pool.connection() as conn:
+        # Un avvio normale non ricrea nulla: lo schema non cambia
+        assert conn.execute("PRAGMA schema_version").fetchone()[0] == schema_version
+        assert conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' "
+                            "ORDER BY name").fetchall() == before
+
+def test_sql_statements_splits_triggers_as_one_statement():
+    script = "CREATE TABLE a (x);\nCREATE TRIGGER t AFTER INSERT ON a BEGIN\n  SELECT 1;\n  SELECT 2;\nEND;\n"
+    assert list(ContractME.sql_statements(script)) == [
+        "CREATE TABLE a (x);", "CREATE TRIGGER t AFTER INSERT ON a BEGIN\n  SELECT 1;\n  SELECT 2;\nEND;"
+    ]
+
+def test_restore_keeps_blobs_released_inside_retention(store, tenants, monkeypatch):
+    first, _ = tenants
+    # Documenti caricati prima della finestra di conservazione ed eliminati dentro la finestra
+    pause()
+    cutoff = ContractME.event_time(datetime.now())
+    monkeypatch.setattr(ContractME, "retention_cutoff", lambda: cutoff)
+    pause()
+    middle = datetime.now()
+    pause()
+    store.replace_document_content(first, 2, b"immagine ricodificata", 100)
+    store.delete_documents(first, [1])
+    counts = ContractME.restore_tenant(store, first, middle, "acme-ripristino", "erin", "pw")
+    assert counts["missing_blobs"] == 0
+    restored = store.find_tenant("acme-ripristino")
+    assert store.document_preview(restored, 1) == "contratto acme\nseconda riga acme\n"
+    assert store.document_version_content(restored, 2, 1) == b"immagine acme"
+
+def test_blobs_released_before_retention_are_collected(store, tenants, monkeypatch):
+    first, _ = tenants
+    store.delete_documents(first, [1])
+    pause()
+    cutoff = ContractME.event_time(datetime.now())
+    monkeypatch.setattr(ContractME, "retention_cutoff", lambda: cutoff)
+    store.delete_documents(first, [2])
+    with store.pool.connection() as conn:
+        kept = {bytes(row[0]) for row in conn.execute("SELECT data FROM blobs WHERE tenant_id = ?", (first,))}
+    # Il primo contenuto non è più referenziato da prima della finestra, il secondo da dentro
+    assert kept == {b"immagine acme"}
@@ -0,0 +1,80 @@
+import base64
+import io
+
+from PIL import Image
+
+import ContractME
+import templates
+from conftest import TODAY
+from models import Document
+
+def make_image(size, mode="RGB", format="PNG", orientation=None):
+    image = Image.new(mode, size, (200, 30, 30, 128) if mode == "RGBA" else (200, 30, 30))
+    output = io.BytesIO()
+    if orientation:
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        image.save(output, format=format, exif=exif)
+    else:
+        image.save(output, format=format)
+    return output.getvalue()
+
+def open_image(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+def test_normalize_image_limits_size_and_format(monkeypatch):
+    monkeypatch.setattr(ContractME, "IMAGE_MAX_SIZE", 100)
+    image = open_image(ContractME.normalize_image(make_image((400, 200))))
+    assert image.format == ContractME.IMAGE_FORMAT and image.size == (100, 50)
+    # Le immagini più piccole non vengono ingrandite
+    assert open_image(ContractME.normalize_image(make_image((40, 20)))).size == (40, 20)
+
+def test_normalize_image_applies_exif_orientation_and_drops_metadata():
+    # Orientamento 6: l'immagine va ruotata di 90 gradi
+    image = open_image(ContractME.normalize_image(make_image((60, 30), format="JPEG", orientation=6)))
+    assert image.size == (30, 60)
+    assert not image.getexif()
+
+def test_normalize_image_jpeg_flattens_transparency(monkeypatch):
+    monkeypatch.setattr(ContractME, "IMAGE_FORMAT", "JPEG")
+    image = open_image(ContractME.normalize_image(make_image((20, 20), mode="RGBA")))
+    assert image.format == "JPEG" and image.mode == "RGB"
+    # Metà trasparenza su fondo bianco
+    red, green, blue = image.getpixel((10, 10))
+    assert red > 200 and 120 < green < 160
+
+def test_ingest_image_keeps_original_only_on_request(monkeypatch):
+    data = make_image((50, 50))
+    content, original_size, original = ContractME.ingest_image(data)
+    assert original_size == len(data) and original is None and content != data
+    monkeypatch.setattr(ContractME, "IMAGE_KEEP_ORIGINAL", True)
+    assert ContractME.ingest_image(data)[2] == data
+
+def test_normalized_filename_follows_the_format(monkeypatch):
+    monkeypatch.setattr(ContractME, "IMAGE_EXTENSION", "webp")
+    assert ContractME.normalized_filename("scansione.fronte.JPG") == "scansione.fronte.webp"
+    monkeypatch.setattr(ContractME, "IMAGE_EXTENSION", "jpg")
+    assert ContractME.normalized_filename("ricevuta.png") == "ricevuta.jpg"
+
+def test_image_mime():
+    for format, mime in [("PNG", "image/png"), ("JPEG", "image/jpeg"), ("WEBP", "image/webp")]:
+        assert templates.image_mime(base64.b64encode(make_image((4, 4), format=format)).decode()) == mime
+
+def test_normalize_stored_images(store):
+    tenant_id = store.create_tenant("acme", "alice", "pw")["tenant_id"]
+    data = make_image((300, 300))
+    store.add_document(tenant_id, Document(name="Vecchia", category="Casa", type="image", upload_date=TODAY,
+                                           filename="vecchia.png"), data)
+    store.add_document(tenant_id, Document(name="Nota", category="Casa", type="text", upload_date=TODAY,
+                                           filename="nota.txt"), b"testo")
+    results = list(ContractME.normalize_stored_images(store, tenant_id))
+    assert [(doc_id, name, size) for doc_id, name, size, _ in results] == [(1, "Vecchia", len(data))]
+    # Il contenuto originale non è più referenziato ma resta per la finestra di conservazione del registro
+    with store.pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM blobs WHERE tenant_id = ?", (tenant_id,)).fetchone()[0] == 3
+    image = store.load_tenant(tenant_id)["documents"][0]
+    assert templates.image_mime(image.preview) == f"image/{ContractME.IMAGE_FORMAT.lower()}"
+    assert image.filename == f"vecchia.{ContractME.IMAGE_EXTENSION}"
+    assert list(ContractME.normalize_stored_images(store, tenant_id)) == []
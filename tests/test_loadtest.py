@@ -0,0 +1,26 @@
+import argparse
+
+import pytest
+
+import loadtest
+
+def level(users, throughput, error_rate=0.0, p95_ms=100.0):
+    return {"users": users, "throughput": throughput, "error_rate": error_rate, "p95_ms": p95_ms}
+
+def test_saturation_when_throughput_stops_growing():
+    first = level(10, 20)
+    assert loadtest.saturated(None, first, 0.5, 0.01, None) is None
+    assert loadtest.saturated(first, level(20, 38), 0.5, 0.01, None) is None
+    assert loadtest.saturated(first, level(20, 24), 0.5, 0.01, None) == "throughput +20% con +100% utenti"
+
+def test_saturation_on_errors_and_slo():
+    assert loadtest.saturated(None, level(10, 20, error_rate=0.05), 0.5, 0.01, None) == "errori 5.0%"
+    assert loadtest.saturated(None, level(10, 20, p95_ms=900), 0.5, 0.01, 500) == "p95 900 ms oltre 500 ms"
+    assert loadtest.saturated(None, level(10, 20, p95_ms=900), 0.5, 0.01, None) is None
+
+def test_parse_mix():
+    name = next(iter(loadtest.SCENARIOS))
+    assert loadtest.parse_mix(f"{name}:3") == {name: 3.0}
+    assert loadtest.parse_mix(name) == {name: 1.0}
+    with pytest.raises(argparse.ArgumentTypeError):
+        loadtest.parse_mix("sconosciuto")
@@ -0,0 +1,54 @@
+import json
+
+import ContractME
+
+def test_timers_report_count_max_and_percentiles():
+    metrics = ContractME.Metrics(samples=100)
+    for ms in range(1, 101):
+        metrics.observe("page.dashboard", ms / 1000)
+    metrics.increment("html_bytes_sent", 10)
+    metrics.increment("html_bytes_sent", 5)
+    snapshot = metrics.snapshot()
+    timer = snapshot["timers"]["page.dashboard"]
+    assert timer["count"] == 100 and round(timer["max_ms"]) == 100
+    assert round(timer["p50_ms"]) == 51 and round(timer["p95_ms"]) == 95 and round(timer["p99_ms"]) == 99
+    assert snapshot["counters"] == {"html_bytes_sent": 15}
+
+def test_percentiles_use_only_recent_samples():
+    metrics = ContractME.Metrics(samples=10)
+    for _ in range(100):
+        metrics.observe("lento", 10.0)
+    for _ in range(10):
+        metrics.observe("lento", 0.001)
+    timer = metrics.snapshot()["timers"]["lento"]
+    assert timer["p99_ms"] == 1.0 and timer["max_ms"] == 10000.0 and timer["count"] == 110
+
+def test_percentile_of_no_samples_is_zero():
+    assert ContractME.percentile([], 95) == 0.0
+
+def test_prometheus_export_lists_timers_counters_and_cache():
+    ContractME.get_metrics().observe("page.test", 0.25)
+    ContractME.count("test_counter", 2)
+    text = ContractME.metrics_prometheus()
+    assert 'contractme_timer_seconds_count{name="page.test"}' in text
+    assert 'contractme_counter_total{name="test_counter"} 2' in text
+    assert 'contractme_cache{tier="memory",stat="entries"}' in text
+
+def test_exports_do_not_start_ocr_or_search(monkeypatch):
+    def not_started():
+        raise AssertionError("l'esportazione non deve avviare le risorse")
+
+    metrics = ContractME.Metrics()
+    monkeypatch.setattr(ContractME, "get_metrics", lambda: metrics)
+    monkeypatch.setattr(ContractME, "get_ocr_queue", not_started)
+    monkeypatch.setattr(ContractME, "get_search", not_started)
+    assert "contractme_ocr" not in ContractME.metrics_prometheus()
+    assert "ocr" not in json.loads(ContractME.metrics_json())
+
+    class Queue:
+        def stats(self):
+            return {"queue_depth": 3}
+
+    metrics.register("ocr", Queue())
+    assert 'contractme_ocr{stat="queue_depth"} 3' in ContractME.metrics_prometheus()
+    assert json.loads(ContractME.metrics_json())["ocr"] == {"queue_depth": 3}
@@ -0,0 +1,81 @@
+import pytest
+
+from conftest import TODAY
+from models import CategoryIndex, CategoryTaxonomy, Deadline, Document, Subscription
+
+def subscription(cost):
+    return Subscription(name="Palestra", type="Sport", renewal_date=TODAY, cost=cost)
+
+def test_subscription_cost_is_validated():
+    sub = subscription("12.5")
+    sub.validate()
+    assert sub.cost == 12.5
+    with pytest.raises(ValueError, match="numero"):
+        subscription("dodici").validate()
+    with pytest.raises(ValueError, match="negativo"):
+        subscription(-1).validate()
+    for cost in (float("nan"), float("inf")):
+        with pytest.raises(ValueError, match="finito"):
+            subscription(cost).validate()
+
+def test_document_and_deadline_validation():
+    with pytest.raises(ValueError):
+        Document(name="", category="Casa", type="text", upload_date=TODAY, filename="a.txt").validate()
+    with pytest.raises(ValueError):
+        Document(name="A", category="Casa", type="zip", upload_date=TODAY, filename="a.zip").validate()
+    with pytest.raises(ValueError):
+        Document(name="A", category="Casa", type="text", upload_date="oggi", filename="a.txt").validate()
+    with pytest.raises(ValueError):
+        Deadline(title="Tasse", date="domani", category="Finanza").validate()
+    deadline = Deadline(title="Tasse", date=TODAY, category="Finanza", description=None)
+    deadline.validate()
+    assert deadline.description == ""
+
+def test_invalid_records_are_not_saved(store):
+    tenant_id = store.create_tenant("acme", "alice", "pw")["tenant_id"]
+    version = store.tenant_version(tenant_id)
+    with pytest.raises(ValueError):
+        store.add_document(tenant_id, Document(name="A", category="Casa", type="zip", upload_date=TODAY,
+                                               filename="a.zip"), b"contenuto")
+    with pytest.raises(ValueError):
+        store.add_deadline(tenant_id, Deadline(title="", date=TODAY, category="Casa"))
+    assert store.tenant_version(tenant_id) == version
+    with store.pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 0
+
+def test_records_have_no_instance_dict():
+    # __slots__: nessun dizionario per record
+    assert not hasattr(Deadline(title="Tasse", date=TODAY, category="Finanza"), "__dict__")
+
+def test_taxonomy_lists_children_after_their_parent():
+    taxonomy = CategoryTaxonomy([("Casa", None), ("Finanza", None), ("Mutuo", "Casa"), ("Rate", "Mutuo")])
+    assert list(taxonomy) == ["Casa", "Mutuo", "Rate", "Finanza"]
+    assert taxonomy.path("Rate") == "Casa / Mutuo / Rate"
+    assert taxonomy.descendants("Casa") == ["Casa", "Mutuo", "Rate"]
+    taxonomy.move("Mutuo", "Finanza")
+    assert list(taxonomy) == ["Casa", "Finanza", "Mutuo", "Rate"]
+
+def test_taxonomy_rename_and_merge():
+    taxonomy = CategoryTaxonomy([("Casa", None), ("Mutuo", "Casa"), ("Finanza", None)])
+    taxonomy.rename("Casa", "Abitazione")
+    assert list(taxonomy) == ["Abitazione", "Mutuo", "Finanza"]
+    taxonomy.rename("Abitazione", "Finanza")
+    assert "Abitazione" not in taxonomy and taxonomy.path("Mutuo") == "Finanza / Mutuo"
+    taxonomy.rename("Finanza", "Finanza")
+    assert list(taxonomy) == ["Finanza", "Mutuo"]
+
+def test_category_index_tracks_records():
+    documents = [Document(id=i, name=f"D{i}", category=category, type="text", upload_date=TODAY, filename="a.txt")
+                 for i, category in [(2, "Casa"), (1, "Casa"), (3, "Lavoro")]]
+    index = CategoryIndex(documents, [Deadline(id=1, title="T", date=TODAY, category="Casa")])
+    assert index.document_counts() == {"Casa": 2, "Lavoro": 1} and index.deadline_counts() == {"Casa": 1}
+    assert [doc.id for doc in index.documents_in(["Lavoro", "Casa"])] == [1, 2, 3]
+    assert index.contains_document(documents[2])
+    index.remove_document(documents[2])
+    assert index.document_counts() == {"Casa": 2} and not index.contains_document(documents[2])
+
+def test_category_index_rename_moves_records():
+    document = Document(id=1, name="A", category="Casa", type="text", upload_date=TODAY, filename="a.txt")
+    index = CategoryIndex([document])
+    index.rename("Casa", "Abitazione")
+    assert document.category == "Abitazione" and index.document_counts() == {"Abitazione": 1}
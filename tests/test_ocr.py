@@ -0,0 +1,106 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import ContractME
+import ocr
+from conftest import TODAY
+from models import Document
+
+@pytest.fixture
+def queue(store, monkeypatch):
+    """Coda con il riconoscimento simulato in un pool di thread al posto di Tesseract"""
+    recognized = []
+
+    def recognize(image):
+        recognized.append(image)
+        if image == b"illeggibile":
+            raise RuntimeError("pagina illeggibile")
+        return "testo " + image.decode()
+
+    def split_pages(doc_type, data):
+        # Ogni riga del contenuto è una pagina; "testo:" indica una pagina con il testo già presente
+        pages = []
+        for line in data.decode().splitlines():
+            if line.startswith("testo:"):
+                pages.append((line, None, line.removeprefix("testo:")))
+            else:
+                pages.append((line, line.encode(), None))
+        return pages
+
+    monkeypatch.setattr(ocr, "recognize", recognize)
+    monkeypatch.setattr(ocr, "split_pages", split_pages)
+    monkeypatch.setattr(ocr, "available", lambda doc_type: doc_type in ("image", "pdf"))
+    queue = ContractME.OcrQueue(store, workers=1)
+    queue._pool.shutdown()
+    queue._pool = ThreadPoolExecutor(max_workers=2)
+    queue.recognized = recognized
+    yield queue
+    queue.shutdown()
+
+def drain(queue):
+    queue._splitter.submit(lambda: None).result()
+    queue._pool.shutdown(wait=True)
+
+def add_scan(store, tenant_id, name, pages):
+    document = Document(name=name, category="Casa", type="pdf", upload_date=TODAY, filename=f"{name}.pdf")
+    content = "\n".join(pages).encode()
+    store.add_document(tenant_id, document, content)
+    return document.id, content
+
+def test_repeated_pages_are_recognized_once(store, queue):
+    tenant_id = store.create_tenant("acme", "alice", "pw")["tenant_id"]
+    first, first_content = add_scan(store, tenant_id, "Contratto", ["p1", "p2", "testo:già presente"])
+    second, second_content = add_scan(store, tenant_id, "Copia", ["p2", "p1"])
+    queue.enqueue(tenant_id, first, "pdf", first_content)
+    queue.enqueue(tenant_id, second, "pdf", second_content)
+    drain(queue)
+    assert sorted(queue.recognized) == [b"p1", b"p2"]
+    assert store.document_text(tenant_id, first) == "testo p1\n\ntesto p2\n\ngià presente"
+    assert store.document_text(tenant_id, second) == "testo p2\n\ntesto p1"
+    stats = queue.stats()
+    assert stats["queue_depth"] == 0 and stats["documents_waiting"] == 0 and stats["failed"] == 0
+    assert stats["pages_per_minute"] > 0
+
+def test_pages_are_not_shared_between_tenants(store, queue):
+    acme = store.create_tenant("acme", "alice", "pw")["tenant_id"]
+    globex = store.create_tenant("globex", "bob", "pw")["tenant_id"]
+    for tenant_id in (acme, globex):
+        doc_id, content = add_scan(store, tenant_id, "Contratto", ["p1"])
+        queue.enqueue(tenant_id, doc_id, "pdf", content)
+    drain(queue)
+    assert queue.recognized == [b"p1", b"p1"]
+
+def test_failed_page_does_not_block_the_queue(store, queue):
+    tenant_id = store.create_tenant("acme", "alice", "pw")["tenant_id"]
+    doc_id, content = add_scan(store, tenant_id, "Contratto", ["illeggibile", "p1"])
+    queue.enqueue(tenant_id, doc_id, "pdf", content)
+    drain(queue)
+    assert store.document_text(tenant_id, doc_id) == "testo p1"
+    assert queue.stats()["failed"] == 1 and queue.stats()["queue_depth"] == 0
+
+def test_unexpected_failure_still_clears_the_page(store, queue, monkeypatch, caplog):
+    def recognize(image):
+        raise BrokenProcessPool("processo terminato")
+
+    monkeypatch.setattr(ocr, "recognize", recognize)
+    tenant_id = store.create_tenant("acme", "alice", "pw")["tenant_id"]
+    doc_id, content = add_scan(store, tenant_id, "Contratto", ["p1"])
+    queue.enqueue(tenant_id, doc_id, "pdf", content)
+    drain(queue)
+    stats = queue.stats()
+    assert stats["failed"] == 1 and stats["queue_depth"] == 0 and stats["pages_per_minute"] > 0
+    assert "processo terminato" in caplog.text
+
+def test_reindex_queues_documents_without_pages(store, queue):
+    tenant_id = store.create_tenant("acme", "alice", "pw")["tenant_id"]
+    doc_id, _ = add_scan(store, tenant_id, "Contratto", ["p1", "p2"])
+    store.add_document(tenant_id, Document(name="Nota", category="Casa", type="text", upload_date=TODAY,
+                                           filename="nota.txt"), b"nota")
+    assert [row[0] for row in store.unindexed_documents(tenant_id)] == [doc_id]
+    assert queue.reindex(tenant_id) == 1
+    drain(queue)
+    assert store.document_text(tenant_id, doc_id) == "testo p1\n\ntesto p2"
+    assert store.unindexed_documents(tenant_id) == []
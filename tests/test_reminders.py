@@ -0,0 +1,93 @@
+import heapq
+import time
+from datetime import datetime, timedelta
+
+import ContractME
+from conftest import TODAY
+from models import Deadline
+
+class Recorder:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, notification, recipients):
+        self.sent.append((notification, recipients))
+
+def fire(scheduler, tenant_id, deadline_id, deadline_date, days=0):
+    scheduler._fire(time.time(), tenant_id, deadline_id, deadline_date.isoformat(), days)
+    scheduler._delivery.shutdown(wait=True)
+
+def test_reminder_times_keep_only_the_latest_missed():
+    deadline = TODAY + timedelta(days=3)
+    times = ContractME.reminder_times(deadline, datetime.combine(TODAY, datetime.min.time()))
+    # Il promemoria a 7 giorni è già passato: resta solo quello, seguito dai futuri
+    assert [days for _, days in times] == [7, 1, 0]
+    later = datetime.combine(deadline - timedelta(days=1), datetime.min.time()).replace(hour=ContractME.REMINDER_HOUR + 1)
+    assert [days for _, days in ContractME.reminder_times(deadline, later)] == [1, 0]
+    assert ContractME.reminder_times(TODAY - timedelta(days=1), datetime.now()) == []
+
+def test_load_collects_future_deadlines_of_every_tenant(store, tenants):
+    scheduler = ContractME.ReminderScheduler(store, [])
+    scheduler.load()
+    entries = {(tenant_id, deadline_id) for _, tenant_id, deadline_id, _, _ in scheduler._heap}
+    assert entries == {(tenant_id, deadline_id) for tenant_id in tenants for deadline_id in (1, 2, 3)}
+    assert scheduler._heap[0] == min(scheduler._heap)
+
+def test_reminder_is_sent_once_across_schedulers(store, tenants):
+    first, _ = tenants
+    store.add_user(first, "alice@example.com", "pw")
+    recorders = [Recorder(), Recorder()]
+    for recorder in recorders:
+        fire(ContractME.ReminderScheduler(store, [recorder]), first, 2, TODAY + timedelta(days=5), days=7)
+    sent = recorders[0].sent + recorders[1].sent
+    assert len(sent) == 1
+    notification, recipients = sent[0]
+    assert notification["kind"] == "renewal" and notification["title"] == "Rinnovo acme"
+    assert recipients == ["alice@example.com"]
+
+class Failing:
+    def send(self, notification, recipients):
+        raise ConnectionRefusedError("server SMTP non raggiungibile")
+
+def test_failed_reminder_is_released_and_retried(store, tenants, caplog):
+    first, _ = tenants
+    scheduler = ContractME.ReminderScheduler(store, [Failing()])
+    fire(scheduler, first, 2, TODAY + timedelta(days=5), days=7)
+    assert "server SMTP non raggiungibile" in caplog.text
+    # Il promemoria torna nell'heap per un nuovo tentativo
+    (timestamp, *entry), = scheduler._heap
+    assert entry == [first, 2, (TODAY + timedelta(days=5)).isoformat(), 7]
+    assert timestamp > time.time() + ContractME.REMINDER_RETRY - 60
+    recorder = Recorder()
+    fire(ContractME.ReminderScheduler(store, [recorder]), first, 2, TODAY + timedelta(days=5), days=7)
+    assert len(recorder.sent) == 1
+
+def test_moved_or_deleted_deadlines_are_skipped(store, tenants):
+    first, _ = tenants
+    recorder = Recorder()
+    scheduler = ContractME.ReminderScheduler(store, [recorder])
+    store.delete_subscription(first, 1)
+    scheduler._fire(time.time(), first, 2, (TODAY + timedelta(days=5)).isoformat(), 0)
+    # La data nell'heap non è più quella della scadenza
+    scheduler._fire(time.time(), first, 3, TODAY.isoformat(), 0)
+    scheduler._delivery.shutdown(wait=True)
+    assert recorder.sent == [] and scheduler.sent == 0
+
+def test_new_deadlines_wake_the_scheduler(store, tenants):
+    first, _ = tenants
+    recorder = Recorder()
+    scheduler = ContractME.ReminderScheduler(store, [recorder]).start()
+    try:
+        deadline = Deadline(title="Subito", date=TODAY, category="Casa")
+        store.add_deadline(first, deadline)
+        assert any(entry[2] == deadline.id for entry in scheduler._heap)
+        with scheduler._condition:
+            heapq.heappush(scheduler._heap, (time.time(), first, deadline.id, TODAY.isoformat(), 0))
+            scheduler._condition.notify()
+        # All'avvio partono anche i promemoria già dovuti delle altre scadenze
+        deadline_by = time.time() + 5
+        while "Subito" not in [notification["title"] for notification, _ in recorder.sent]:
+            assert time.time() < deadline_by
+            time.sleep(0.01)
+    finally:
+        scheduler.stop()
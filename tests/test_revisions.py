@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+import ContractME
+
+PAIRS = [
+    ("", ""),
+    ("", "nuovo testo\n"),
+    ("vecchio testo\n", ""),
+    ("riga 1\nriga 2\nriga 3\n", "riga 1\nriga 2 modificata\nriga 3\n"),
+    ("senza a capo finale", "senza a capo finale\ncon una riga in più"),
+    ("a\nb\nc\n", "c\nb\na\n"),
+    ("righe\r\ncon CRLF\r\n", "righe\r\ncon CRLF\r\ne una nuova\r\n"),
+    ("caffè, perché, città\n", "caffè, perché, città\n€ 12,50 — “virgolette”\n"),
+    ("ripetuta\n" * 50, "ripetuta\n" * 25 + "diversa\n" + "ripetuta\n" * 25),
+]
+
+@pytest.mark.parametrize("source, target", PAIRS)
+def test_text_delta_round_trip(source, target):
+    assert ContractME.apply_text_delta(source, ContractME.text_delta(source, target)) == target
+
+def test_text_delta_round_trip_random_edits():
+    rng = random.Random(42)
+    words = ["contratto", "scadenza", "rinnovo", "polizza", "", "importo"]
+    for _ in range(200):
+        source = [rng.choice(words) + "\n" for _ in range(rng.randint(0, 30))]
+        target = list(source)
+        for _ in range(rng.randint(0, 6)):
+            position = rng.randint(0, len(target))
+            if target and rng.random() < 0.5:
+                del target[min(position, len(target) - 1)]
+            else:
+                target.insert(position, rng.choice(words) + "\n")
+        source, target = "".join(source), "".join(target)
+        assert ContractME.apply_text_delta(source, ContractME.text_delta(source, target)) == target
+
+def test_text_delta_copies_unchanged_lines():
+    source = "".join(f"riga {i}\n" for i in range(1000))
+    target = source.replace("riga 500\n", "riga cambiata\n")
+    # Le righe uguali sono intervalli, non testo: il delta resta piccolo
+    assert len(ContractME.text_delta(target, source)) < 100
+
+def test_document_versions_rebuild_every_revision(store, tenants):
+    first, _ = tenants
+    revisions = [b"contratto acme\nseconda riga acme\n", b"contratto acme\nseconda riga cambiata\n",
+                 b"prima riga nuova\ncontratto acme\nseconda riga cambiata\n", b""]
+    for content in revisions[1:]:
+        document = next(doc for doc in store.load_tenant(first)["documents"] if doc.id == 1)
+        store.add_document_version(first, document, content)
+    for version, content in enumerate(revisions, 1):
+        assert store.document_version_content(first, 1, version) == content
+    assert store.document_version_content(first, 1, len(revisions) + 1) is None
+    with store.pool.connection() as conn:
+        # Le revisioni precedenti dei testi sono delta, senza contenuto proprio
+        assert conn.execute("SELECT COUNT(*) FROM document_versions WHERE tenant_id = ? AND blob_sha256 IS NULL",
+                            (first,)).fetchone()[0] == 3
+
+def test_binary_versions_keep_previous_content(store, tenants):
+    first, _ = tenants
+    document = next(doc for doc in store.load_tenant(first)["documents"] if doc.id == 2)
+    store.add_document_version(first, document, b"immagine nuova")
+    assert store.document_version_content(first, 2, 1) == b"immagine acme"
+    assert store.document_version_content(first, 2, 2) == b"immagine nuova"
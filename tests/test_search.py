@@ -0,0 +1,95 @@
+from datetime import timedelta
+
+import ContractME
+import search
+from conftest import TODAY
+from models import Deadline
+
+def index(*entries):
+    return search.SearchIndex((kind, record_id, title, detail, tuple(frozenset(search.terms(text)) for text in texts))
+                              for kind, record_id, title, detail, texts in entries)
+
+def test_terms_are_lowercase_without_accents():
+    assert search.terms("Perché la CITTÀ? Sì, a") == {"perche", "la", "citta", "si"}
+    assert search.query_terms("co contratto") == ["contratto", "co"]
+
+def test_prefix_matches_title_and_text():
+    found, total = index(("document", 1, "Contratto affitto", "Casa", ["canone mensile"]),
+                         ("deadline", 2, "Pagamento canone", "01/02/2030", [])).search("can")
+    assert total == 2
+    assert {(kind, record_id) for kind, record_id, _, _ in found} == {("document", 1), ("deadline", 2)}
+
+def test_every_word_must_match():
+    entries = index(("document", 1, "Contratto affitto", "Casa", []),
+                    ("document", 2, "Contratto luce", "Casa", []))
+    assert entries.search("contr aff") == ([("document", 1, "Contratto affitto", "Casa")], 1)
+    assert entries.search("contr gas") == ([], 0)
+    assert entries.search("c") == ([], 0)
+
+def test_title_matches_first_then_newest():
+    entries = index(("document", 1, "Assicurazione auto", "Auto", []),
+                    ("document", 5, "Bollo", "Auto", ["assicurazione"]),
+                    ("document", 3, "Assicurazione casa", "Casa", []))
+    found, total = entries.search("assic", limit=2)
+    assert total == 3
+    assert [record_id for _, record_id, _, _ in found] == [3, 1]
+
+def test_add_replaces_and_remove_forgets():
+    entries = index(("subscription", 1, "Netflix", "Streaming", []))
+    entries.add("subscription", 1, "Spotify", "Musica", ())
+    assert entries.search("netf") == ([], 0)
+    assert entries.search("spot")[1] == 1
+    entries.remove("subscription", 1)
+    assert entries.search("spot") == ([], 0)
+    assert len(entries) == 0 and entries.vocabulary == []
+
+def test_shared_text_removed_with_last_entry():
+    text = (frozenset(search.terms("condizioni generali")),)
+    entries = search.SearchIndex([("document", 1, "Uno", "", text), ("document", 2, "Due", "", text)])
+    entries.remove("document", 1)
+    assert entries.search("condiz")[1] == 1
+    entries.remove("document", 2)
+    assert "condizioni" not in entries.vocabulary
+
+def test_tenant_search_is_isolated_and_incremental(store, tenants):
+    first, second = tenants
+    indexes = ContractME.SearchIndexes(store)
+    found, _ = indexes.search(first, "contratto")
+    assert [title for _, _, title, _ in found] == ["Contratto acme"]
+    assert indexes.search(first, "globex") == ([], 0)
+    # Il testo dei documenti di testo e delle pagine riconosciute è cercabile
+    assert indexes.search(first, "seconda riga")[1] == 1
+    assert indexes.search(first, "riconosciuto")[0][0][:2] == ("document", 2)
+
+    store.add_deadline(first, Deadline(title="Revisione caldaia", date=TODAY + timedelta(days=9), category="Casa"))
+    found, _ = indexes.search(first, "caldaia")
+    assert [(kind, title) for kind, _, title, _ in found] == [("deadline", "Revisione caldaia")]
+    store.delete_documents(first, [1])
+    assert indexes.search(first, "contratto") == ([], 0)
+    assert indexes.search(second, "contratto")[1] == 1
+
+def test_tenant_search_sees_new_page_text(store, tenants):
+    first, _ = tenants
+    indexes = ContractME.SearchIndexes(store)
+    assert indexes.search(first, "fattura") == ([], 0)
+    store.save_page_texts(first, [("pagina-nuova", "fattura elettrica")])
+    store.set_document_pages(first, 2, ["pagina-nuova"])
+    indexes.text_changed(first, ["pagina-nuova"])
+    assert indexes.search(first, "fattura")[0][0][:2] == ("document", 2)
+
+def test_tenant_search_forgets_texts_of_removed_pages(store, tenants):
+    first, _ = tenants
+    indexes = ContractME.SearchIndexes(store)
+    indexes.search(first, "riconosciuto")
+    texts = indexes._tenant(first)["texts"]
+    assert "pagina-acme" in texts
+    store.save_page_texts(first, [("pagina-nuova", "fattura elettrica")])
+    store.set_document_pages(first, 2, ["pagina-nuova"])
+    indexes.text_changed(first, ["pagina-nuova"])
+    assert indexes.search(first, "fattura")[1] == 1
+    # La pagina sostituita non è più usata da nessuna voce
+    assert "pagina-acme" not in texts and "pagina-nuova" in texts
+    store.delete_documents(first, [2])
+    assert indexes.search(first, "fattura") == ([], 0)
+    assert "pagina-nuova" not in texts
+    assert indexes.stats()["texts"] == len(texts)
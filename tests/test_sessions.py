@@ -0,0 +1,92 @@
+import sys
+import threading
+
+import ContractME
+from conftest import TODAY
+from models import Document
+
+def test_estimate_size_counts_shared_objects_once():
+    document = Document(name="Contratto", category="Casa", type="text", upload_date=TODAY, filename="c.txt")
+    seen = set()
+    first = ContractME.estimate_size([document], seen)
+    assert first > ContractME.estimate_size([], set())
+    # Il documento è già stato contato: la seconda lista pesa solo per sé
+    assert ContractME.estimate_size([document], seen) == ContractME.estimate_size([None], set()) - 16
+
+def test_estimate_size_samples_large_collections():
+    values = [f"valore {i:06d}" for i in range(10000)]
+    exact = sum(ContractME.estimate_size(value, set()) for value in values)
+    estimate = ContractME.estimate_size(values, set()) - sys.getsizeof(values)
+    assert abs(estimate - exact) < exact * 0.05
+
+def make_state(turns=3):
+    return {"documents": ["doc"] * 3, "deadlines": [], "data_version": 7, "username": "alice",
+            "chat_history": [{"role": "user", "content": f"messaggio {i}"} for i in range(turns)]}
+
+def test_idle_sessions_release_their_state_on_the_next_run(tmp_path):
+    registry = ContractME.SessionRegistry(idle_seconds=60, spill_dir=str(tmp_path))
+    idle, recent = make_state(), make_state()
+    with registry.active("idle", idle):
+        pass
+    with registry.active("recent", recent):
+        pass
+    registry._sessions["idle"]["last_seen"] -= 120
+    registry.sweep()
+    # Il controllo segna soltanto la sessione inattiva: il suo stato resta intatto fino alla sua rerun
+    assert idle["documents"] and idle["data_version"] == 7
+    assert registry.stats()["evicted"] == 1 and registry.evictions == 0
+    with registry.active("idle", idle) as evicted:
+        assert evicted
+        # I dati del tenant vengono liberati e la chat va su disco prima che la rerun legga lo stato
+        assert "documents" not in idle and idle["data_version"] is None and idle["username"] == "alice"
+        assert idle["chat_history"] == [] and idle["chat_archived"] == 3
+    assert (tmp_path / "idle.jsonl").read_text(encoding="utf-8").count("\n") == 3
+    assert recent["documents"] and recent["data_version"] == 7
+    assert registry.stats()["evicted"] == 0 and registry.evictions == 1
+    with registry.active("idle", idle) as evicted:
+        assert not evicted
+
+def test_session_running_a_rerun_is_not_marked(tmp_path):
+    registry = ContractME.SessionRegistry(idle_seconds=0, spill_dir=str(tmp_path))
+    state = make_state()
+    with registry.active("running", state):
+        registry._sessions["running"]["last_seen"] -= 10
+        # Il controllo parte dalla rerun di un'altra sessione, in un altro thread
+        sweeper = threading.Thread(target=registry.sweep)
+        sweeper.start()
+        sweeper.join()
+        assert not registry._sessions["running"]["evict"]
+    registry.sweep(exclude="running")
+    assert not registry._sessions["running"]["evict"]
+    registry.sweep()
+    assert registry._sessions["running"]["evict"] and state["documents"]
+
+def test_measure_is_rate_limited(tmp_path):
+    registry = ContractME.SessionRegistry(spill_dir=str(tmp_path))
+    sizes = registry.measure("s", {"documents": ["a"] * 10, "username": "alice"})
+    assert sizes["documents"] > sizes["username"] > 0
+    assert registry.measure("s", {"documents": []}) is sizes
+    assert registry.measure("s", {"documents": []}, force=True).keys() == {"documents"}
+    stats = registry.stats()
+    assert stats["sessions"] == 1 and stats["bytes"] == stats["keys"]["documents"]
+
+def test_spill_chat_appends_oldest_messages(tmp_path):
+    path = str(tmp_path / "chat" / "s.jsonl")
+    state = make_state(5)
+    ContractME.spill_chat(path, state, 2)
+    ContractME.spill_chat(path, state, 1)
+    assert [message["content"] for message in state["chat_history"]] == ["messaggio 3", "messaggio 4"]
+    assert state["chat_archived"] == 3
+    with open(path, encoding="utf-8") as f:
+        assert [line.count("messaggio") for line in f] == [1, 1, 1]
+
+def test_large_previews_are_read_on_demand(store, monkeypatch):
+    monkeypatch.setattr(ContractME, "PREVIEW_INLINE_BYTES", 10)
+    tenant_id = store.create_tenant("acme", "alice", "pw")["tenant_id"]
+    for name, content in [("Breve", b"breve"), ("Lungo", b"testo lungo oltre la soglia")]:
+        store.add_document(tenant_id, Document(name=name, category="Casa", type="text", upload_date=TODAY,
+                                               filename=f"{name}.txt"), content)
+    documents = {doc.name: doc for doc in store.load_tenant(tenant_id)["documents"]}
+    assert documents["Breve"].preview == "breve" and documents["Lungo"].preview is None
+    assert store.document_preview(tenant_id, documents["Lungo"].id) == "testo lungo oltre la soglia"
+    assert store.document_preview(tenant_id, 99) is None
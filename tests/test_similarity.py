@@ -0,0 +1,79 @@
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import ContractME
+import similarity
+from conftest import TODAY
+from models import Document
+
+TEXT = " ".join(f"clausola {i} del contratto di locazione tra le parti" for i in range(40))
+
+def image_bytes(shift=0, noise=0):
+    image = Image.new("L", (200, 200), 255)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((30 + shift, 40, 120 + shift, 160), fill=0)
+    draw.ellipse((130, 20, 190, 80), fill=120)
+    if noise:
+        pixels = np.asarray(image, dtype=np.int16)
+        pixels = np.clip(pixels + np.random.default_rng(0).integers(-noise, noise, pixels.shape), 0, 255)
+        image = Image.fromarray(pixels.astype(np.uint8))
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+def test_minhash_estimates_similarity():
+    kind, signature = similarity.fingerprint("text", TEXT.encode())
+    _, edited = similarity.fingerprint("text", TEXT.replace("clausola 3 ", "clausola tre ").encode())
+    _, other = similarity.fingerprint("text", " ".join(f"fattura numero {i} del fornitore" for i in range(40)).encode())
+    assert kind == "text"
+    assert similarity.similarity(kind, signature, signature) == 1
+    assert similarity.similarity(kind, signature, edited) >= similarity.TEXT_THRESHOLD
+    assert similarity.similarity(kind, signature, other) < 0.1
+    assert similarity.fingerprint("text", b"  ...  ") is None
+
+def test_minhash_is_stable_across_blocks(monkeypatch):
+    signature = similarity.minhash(TEXT)
+    monkeypatch.setattr(similarity, "SHINGLE_BATCH", 7)
+    assert np.array_equal(similarity.minhash(TEXT), signature)
+
+def test_dhash_tolerates_noise():
+    kind, signature = similarity.fingerprint("image", image_bytes())
+    _, noisy = similarity.fingerprint("image", image_bytes(noise=20))
+    _, moved = similarity.fingerprint("image", image_bytes(shift=60))
+    assert kind == "image" and len(signature) == 8
+    assert similarity.similarity(kind, signature, noisy) >= 1 - similarity.IMAGE_MAX_DISTANCE / 64
+    assert similarity.similarity(kind, signature, moved) < 1 - similarity.IMAGE_MAX_DISTANCE / 64
+
+def test_signatures_round_trip_as_bytes():
+    for kind, signature in [similarity.fingerprint("text", TEXT.encode()), similarity.fingerprint("image", image_bytes())]:
+        restored = similarity.from_bytes(kind, similarity.to_bytes(kind, signature))
+        assert restored.dtype == signature.dtype and np.array_equal(restored, signature)
+
+def test_index_query_and_remove():
+    text = similarity.fingerprint("text", TEXT.encode())
+    image = similarity.fingerprint("image", image_bytes())
+    index = similarity.NearDuplicateIndex([(1, *text), (2, *image)])
+    assert len(index) == 2
+    assert index.query(*similarity.fingerprint("text", TEXT.replace("parti", "persone", 1).encode()))[0][0] == 1
+    assert [doc_id for doc_id, _ in index.query(*similarity.fingerprint("image", image_bytes(noise=20)))] == [2]
+    # Le firme di tipo diverso non si confrontano
+    assert index.query("image", text[1][:8].astype(np.uint8)) == []
+    index.remove(1)
+    index.remove(1)
+    assert index.query(*text) == [] and len(index) == 1
+    assert all(key[0] == "image" for key in index.buckets)
+
+def test_fingerprint_stored_documents_and_groups(store):
+    tenant_id = store.create_tenant("acme", "alice", "pw")["tenant_id"]
+    for name, content in [("Contratto", TEXT.encode()), ("Copia", TEXT.replace("parti", "persone", 1).encode()),
+                          ("Altro", b"fattura del fornitore di energia elettrica")]:
+        store.add_document(tenant_id, Document(name=name, category="Casa", type="text", upload_date=TODAY,
+                                               filename=f"{name}.txt"), content)
+    store.add_document(tenant_id, Document(name="Rotta", category="Casa", type="image", upload_date=TODAY,
+                                           filename="rotta.png"), b"non un'immagine")
+    assert ContractME.fingerprint_stored_documents(store, tenant_id) == 3
+    assert [doc_id for doc_id, _, _ in store.unfingerprinted_documents(tenant_id)] == [4]
+    groups = ContractME.duplicate_groups(store, tenant_id)
+    assert [sorted(group) for group in groups] == [[1, 2]]
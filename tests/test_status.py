@@ -0,0 +1,52 @@
+import io
+from datetime import timedelta
+
+import pytest
+
+import ContractME
+from conftest import TODAY
+
+@pytest.mark.parametrize("days, status", [(-1, "expired"), (0, "urgent"), (3, "urgent"), (4, "imminent"),
+                                          (7, "imminent"), (8, "future")])
+def test_classify_status_boundaries(days, status):
+    assert ContractME.classify_status(TODAY + timedelta(days=days), TODAY) == status
+
+def statuses(store, tenant_id):
+    data = store.load_tenant(tenant_id)
+    return {d.title: d.status for d in data["deadlines"]}, [sub.status for sub in data["subscriptions"]]
+
+def test_records_are_classified_on_write(store, tenants):
+    first, _ = tenants
+    deadlines, subscriptions = statuses(store, first)
+    assert deadlines == {"Scadenza acme": "urgent", "Rinnovo acme": "imminent", "Tasse acme": "future"}
+    assert subscriptions == ["imminent"]
+
+def test_roll_statuses_once_per_day(store, tenants):
+    first, second = tenants
+    version = store.roll_statuses(first, TODAY)
+    assert version == store.tenant_version(first)
+    assert store.roll_statuses(first, TODAY) is None
+    version = store.roll_statuses(first, TODAY + timedelta(days=3))
+    assert version == store.tenant_version(first)
+    deadlines, subscriptions = statuses(store, first)
+    assert deadlines == {"Scadenza acme": "expired", "Rinnovo acme": "urgent", "Tasse acme": "future"}
+    assert subscriptions == ["urgent"]
+    # L'altro tenant resta classificato al giorno della scrittura
+    assert statuses(store, second)[0]["Scadenza globex"] == "urgent"
+
+def test_roll_statuses_reaches_far_dates_after_a_long_pause(store, tenants):
+    first, _ = tenants
+    store.roll_statuses(first, TODAY)
+    store.roll_statuses(first, TODAY + timedelta(days=60))
+    assert set(statuses(store, first)[0].values()) == {"expired"}
+
+def test_imported_records_are_classified_on_next_roll(store, tenants):
+    first, second = tenants
+    store.roll_statuses(first, TODAY)
+    archive = io.BytesIO()
+    ContractME.export_tenant(store, second, archive)
+    archive.seek(0)
+    ContractME.import_tenant(store, first, archive)
+    assert statuses(store, first)[0]["Tasse globex"] is None
+    store.roll_statuses(first, TODAY)
+    assert statuses(store, first)[0]["Tasse globex"] == "future"
@@ -0,0 +1,237 @@
+import json
+from datetime import timedelta
+
+import pytest
+
+import ContractME
+from conftest import TODAY
+from models import Document, Deadline, Subscription
+
+def tenant_rows(store, tenant_id):
+    """Le righe del tenant in ogni tabella partizionata per tenant_id"""
+    with store.pool.snapshot() as conn:
+        tables = [row["name"] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()]
+        return {table: sorted(map(tuple, conn.execute(f"SELECT * FROM {table} WHERE tenant_id = ?", (tenant_id,))),
+                              key=repr)
+                for table in tables
+                if any(column["name"] == "tenant_id" for column in conn.execute(f"PRAGMA table_info({table})"))}
+
+def test_load_tenant_returns_only_own_records(store, tenants):
+    first, _ = tenants
+    data = store.load_tenant(first)
+    names = [doc.name for doc in data["documents"]] + [d.title for d in data["deadlines"]] + \
+            [sub.name for sub in data["subscriptions"]] + [name for name, _ in data["categories"]]
+    assert any("acme" in name for name in names)
+    assert not any("globex" in name for name in names)
+    assert data["documents"][0].preview == "contratto acme\nseconda riga acme\n"
+    assert [user["username"] for user in store.list_users(first)] == ["alice"]
+
+def test_ids_are_numbered_per_tenant(store, tenants):
+    first, second = tenants
+    for tenant_id in tenants:
+        data = store.load_tenant(tenant_id)
+        assert [doc.id for doc in data["documents"]] == [1, 2]
+        assert [d.id for d in data["deadlines"]] == [1, 2, 3]
+
+def test_reads_with_shared_ids_stay_in_tenant(store, tenants):
+    first, second = tenants
+    # Gli id 1 e 2 esistono in entrambi i tenant
+    assert "acme" in store.document_preview(first, 1)
+    assert b"globex" in store.document_version_content(second, 1, 1)
+    assert [h["filename"] for h in store.document_history(first, 1)] == ["acme.txt"]
+    assert store.document_text(first, 2) == "testo riconosciuto acme"
+    assert store.known_pages(first, ["pagina-globex"]) == set()
+    assert store.search_texts(first, ["pagina-globex"]) == {}
+    assert all("globex" not in str(row) for row in store.search_rows(first))
+    assert [doc_id for doc_id, _, _ in store.load_fingerprints(first)] == [1]
+    assert [doc_id for doc_id, _, _ in store.unfingerprinted_documents(first)] == [2]
+    assert store.unindexed_documents(first) == []
+
+@pytest.mark.parametrize("write", [
+    lambda store, tenant: store.add_category(tenant, "Nuova"),
+    lambda store, tenant: store.move_category(tenant, "Casa", "Finanza"),
+    lambda store, tenant: store.rename_category(tenant, "Casa", "Abitazione"),
+    lambda store, tenant: store.rename_category(tenant, "Casa", "Finanza"),
+    lambda store, tenant: store.add_document(tenant, Document(name="Polizza", category="Casa", type="text",
+                                                              upload_date=TODAY, filename="p.txt"), b"polizza"),
+    lambda store, tenant: store.add_deadline(tenant, Deadline(title="Nuova", date=TODAY, category="Casa")),
+    lambda store, tenant: store.add_subscription(tenant, Subscription(name="Nuovo", type="Altro", renewal_date=TODAY,
+                                                                      cost=1),
+                                                 Deadline(title="Rinnovo", date=TODAY, category="Abbonamenti")),
+    lambda store, tenant: store.delete_documents(tenant, [1, 2]),
+    lambda store, tenant: store.delete_deadlines(tenant, [1, 2, 3]),
+    lambda store, tenant: store.delete_subscriptions(tenant, [1]),
+    lambda store, tenant: store.recategorize(tenant, "documents", [1, 2], "Lavoro"),
+    lambda store, tenant: store.recategorize(tenant, "subscriptions", [1], "Software"),
+    lambda store, tenant: store.mark_deadlines_done(tenant, [1, 2]),
+    lambda store, tenant: store.reschedule(tenant, "documents", [1], 3),
+    lambda store, tenant: store.reschedule(tenant, "subscriptions", [1], -2),
+    lambda store, tenant: store.replace_document_content(tenant, 2, b"immagine normalizzata", 12,
+                                                          filename="x.webp"),
+    lambda store, tenant: store.add_document_version(
+        tenant, store.load_tenant(tenant)["documents"][0], b"nuovo testo\n"),
+    lambda store, tenant: store.set_fingerprints(tenant, []),
+    lambda store, tenant: store.roll_statuses(tenant, TODAY + timedelta(days=1)),
+], ids=["add_category", "move_category", "rename_category", "merge_category", "add_document", "add_deadline",
+        "add_subscription", "delete_documents", "delete_deadlines", "delete_subscriptions", "recategorize_documents",
+        "recategorize_subscriptions", "mark_deadlines_done", "reschedule_documents", "reschedule_subscriptions",
+        "replace_document_content", "add_document_version", "set_fingerprints", "roll_statuses"])
+def test_writes_leave_other_tenant_untouched(store, tenants, write):
+    first, second = tenants
+    before_rows, before_version = tenant_rows(store, second), store.tenant_version(second)
+    first_version = store.tenant_version(first)
+    version = write(store, first)
+    assert tenant_rows(store, second) == before_rows
+    assert store.tenant_version(second) == before_version
+    assert version == store.tenant_version(first) == first_version + 1
+
+def test_page_texts_and_pages_stay_in_tenant(store, tenants):
+    first, second = tenants
+    store.set_document_pages(first, 2, ["pagina-nuova"])
+    store.save_page_texts(first, [("pagina-nuova", "altro")])
+    assert store.document_text(second, 2) == "testo riconosciuto globex"
+    assert store.known_pages(second, ["pagina-nuova"]) == set()
+
+def test_write_bumps_version_and_reload_sees_it(store, tenants):
+    first, _ = tenants
+    loaded = store.load_tenant(first)
+    version = store.add_deadline(first, Deadline(title="Revisione", date=TODAY, category="Casa"))
+    assert version == loaded["version"] + 1
+    reloaded = store.load_tenant(first)
+    assert reloaded["version"] == version
+    assert reloaded["deadlines"][-1].title == "Revisione"
+
+def test_delete_documents_removes_linked_rows(store, tenants):
+    first, _ = tenants
+    store.add_document_version(first, store.load_tenant(first)["documents"][0], b"nuovo\n")
+    store.delete_documents(first, [1, 2])
+    data = store.load_tenant(first)
+    assert data["documents"] == []
+    assert [d.title for d in data["deadlines"]] == ["Rinnovo acme", "Tasse acme"]
+    assert store.document_history(first, 1) == []
+    assert store.load_fingerprints(first) == []
+    with store.pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM document_pages WHERE tenant_id = ?", (first,)).fetchone()[0] == 0
+
+def test_delete_subscriptions_removes_renewal_deadlines(store, tenants):
+    first, _ = tenants
+    store.delete_subscriptions(first, [1])
+    data = store.load_tenant(first)
+    assert data["subscriptions"] == []
+    assert [d.title for d in data["deadlines"]] == ["Scadenza acme", "Tasse acme"]
+
+def test_recategorize_registers_category(store, tenants):
+    first, _ = tenants
+    store.recategorize(first, "deadlines", [1, 3], "Lavoro")
+    data = store.load_tenant(first)
+    assert {d.id for d in data["deadlines"] if d.category == "Lavoro"} == {1, 3}
+    assert "Lavoro" in [name for name, _ in data["categories"]]
+
+def test_mark_deadlines_done_and_undone(store, tenants):
+    first, _ = tenants
+    store.mark_deadlines_done(first, [1, 3])
+    statuses = {d.id: d.status for d in store.load_tenant(first)["deadlines"]}
+    assert statuses[1] == statuses[3] == "done"
+    store.mark_deadlines_done(first, [1], done=False)
+    statuses = {d.id: d.status for d in store.load_tenant(first)["deadlines"]}
+    assert statuses[1] == "urgent" and statuses[3] == "done"
+
+def test_reschedule_moves_linked_deadlines(store, tenants):
+    first, _ = tenants
+    moved = []
+    store.listeners.append(lambda tenant_id, deadlines: moved.extend(deadlines))
+    store.reschedule(first, "subscriptions", [1], 30)
+    data = store.load_tenant(first)
+    assert data["subscriptions"][0].renewal_date == TODAY + timedelta(days=35)
+    renewal = next(d for d in data["deadlines"] if d.subscription_id == 1)
+    assert renewal.date == TODAY + timedelta(days=35) and renewal.status == "future"
+    assert [d.id for d in moved] == [renewal.id]
+
+def test_reschedule_document_moves_only_its_expiry_deadline(store, tenants):
+    first, _ = tenants
+    reminder = Deadline(title="Disdetta", date=TODAY + timedelta(days=1), category="Casa", document_id=1)
+    store.add_deadline(first, reminder)
+    moved = []
+    store.listeners.append(lambda tenant_id, deadlines: moved.extend(deadlines))
+    store.reschedule(first, "documents", [1], 3)
+    dates = {d.title: d.date for d in store.load_tenant(first)["deadlines"]}
+    assert dates["Scadenza acme"] == TODAY + timedelta(days=5)
+    assert dates["Disdetta"] == TODAY + timedelta(days=1)
+    assert [d.title for d in moved] == ["Scadenza acme"]
+
+def test_bulk_selection_is_a_json_array(store, tenants):
+    first, _ = tenants
+    # Un id non numerico non deve diventare SQL
+    store.delete_deadlines(first, [json.dumps("1 OR 1=1")])
+    assert len(store.load_tenant(first)["deadlines"]) == 3
+
+def test_users_log_in_to_their_own_tenant(store, tenants):
+    first, _ = tenants
+    store.add_user(first, "carla", "segreta")
+    user = store.authenticate("carla", "segreta")
+    assert user["tenant_id"] == first and user["tenant_name"] == "acme" and user["role"] == "member"
+    assert store.authenticate("carla", "sbagliata") is None
+    with pytest.raises(ValueError):
+        store.add_user(first, "bob", "pw")
+    with pytest.raises(ValueError):
+        store.create_tenant("acme", "dario", "pw")
+
+def test_stores_share_the_database_file(store, tenants):
+    first, _ = tenants
+    # Un secondo processo apre lo stesso file con il proprio pool
+    other = type(store)(store.pool.path)
+    version = other.add_deadline(first, Deadline(title="Da un altro processo", date=TODAY + timedelta(days=1),
+                                                 category="Casa"))
+    assert store.tenant_version(first) == version
+    assert store.load_tenant(first)["deadlines"][-1].title == "Da un altro processo"
+
+def categories(store, tenant_id):
+    return dict(store.load_tenant(tenant_id)["categories"])
+
+def test_new_tenants_start_with_default_categories(store):
+    tenant_id = store.create_tenant("vuoto", "carla", "pw")["tenant_id"]
+    assert [name for name, _ in store.load_tenant(tenant_id)["categories"]] == ContractME.DEFAULT_CATEGORIES
+
+def test_categories_used_by_records_are_registered(store, tenants):
+    first, _ = tenants
+    store.add_deadline(first, Deadline(title="Visita", date=TODAY, category="Medico"))
+    assert "Medico" in categories(store, first)
+    assert "Medico" not in categories(store, tenants[1])
+
+def test_move_category_rejects_own_subcategory(store, tenants):
+    first, _ = tenants
+    store.add_category(first, "Mutuo", "Casa")
+    store.add_category(first, "Rate", "Mutuo")
+    with pytest.raises(ValueError):
+        store.move_category(first, "Casa", "Rate")
+    store.move_category(first, "Mutuo", None)
+    assert categories(store, first)["Mutuo"] is None
+
+def test_rename_category_moves_records_and_subcategories(store, tenants):
+    first, _ = tenants
+    store.add_category(first, "Mutuo", "Casa")
+    store.rename_category(first, "Casa", "Abitazione")
+    data = store.load_tenant(first)
+    assert "Casa" not in dict(data["categories"]) and dict(data["categories"])["Mutuo"] == "Abitazione"
+    assert [d.title for d in data["deadlines"] if d.category == "Abitazione"] == ["Scadenza acme"]
+    assert [doc.name for doc in data["documents"] if doc.category == "Abitazione"] == ["Scansione acme"]
+
+def test_rename_category_to_existing_merges(store, tenants):
+    first, _ = tenants
+    names = [name for name, _ in store.load_tenant(first)["categories"]]
+    store.rename_category(first, "Casa", "Finanza")
+    data = store.load_tenant(first)
+    assert [name for name, _ in data["categories"]] == [name for name in names if name != "Casa"]
+    assert {d.title for d in data["deadlines"] if d.category == "Finanza"} == {"Scadenza acme", "Tasse acme"}
+
+def test_rename_category_to_itself_keeps_it(store, tenants):
+    first, _ = tenants
+    version = store.rename_category(first, "Casa", "Casa")
+    assert version == store.tenant_version(first)
+    assert "Casa" in [name for name, _ in store.load_tenant(first)["categories"]]
+
+def test_rename_category_rejects_own_subcategory(store, tenants):
+    first, _ = tenants
+    store.add_category(first, "Mutuo", "Casa")
+    with pytest.raises(ValueError):
+        store.rename_category(first, "Casa", "Mutuo")
@@ -0,0 +1,42 @@
+from datetime import datetime
+
+import templates
+from templates import Markup, Template, escape, join
+
+def test_values_are_escaped():
+    html = Template("<p>{name}</p>").render(name="<script>alert(1)</script>")
+    assert html == "<p>&lt;script&gt;alert(1)&lt;/script&gt;</p>"
+    assert isinstance(html, Markup)
+
+def test_markup_is_inserted_as_is():
+    inner = Template("<b>{text}</b>").render(text="a & b")
+    assert Template("<div>{inner}</div>").render(inner=inner) == "<div><b>a &amp; b</b></div>"
+    assert escape(Markup("<i>x</i>")) == "<i>x</i>"
+    assert join([inner, Markup("<br>")]) == "<b>a &amp; b</b><br>"
+
+def test_format_spec_and_whitespace():
+    template = Template("""
+    <div>
+        <span>{cost:.2f}</span>
+        <span>{date:%d/%m/%Y}</span>
+    </div>
+    """)
+    assert template.render(cost=3.456, date=datetime(2026, 3, 1)) == "<div><span>3.46</span><span>01/03/2026</span></div>"
+
+def test_minify_css():
+    css = """
+    /* commento */
+    .card {
+        padding: 10px;
+        color : red ;
+    }
+    """
+    assert templates.minify_css(css) == ".card{padding:10px;color:red;}"
+
+def test_cards_are_cached_and_escaped():
+    args = ("<Contratto>", "Casa", datetime(2026, 1, 2), "atto.pdf", None, 1)
+    card = templates.document_card(*args)
+    assert "&lt;Contratto&gt;" in card and "PDF" in card and "Data scadenza" not in card and "Versione" not in card
+    assert templates.document_card(*args) is card
+    assert "02/02/2026" in templates.document_card(*args[:4], datetime(2026, 2, 2), 1)
+    assert "<strong>Versione:</strong> 3" in templates.document_card(*args[:5], 3)